@@ -0,0 +1,218 @@
+"""
+End-to-end throughput benchmark of the detection pipeline on recorded streams,
+without a live ESP32-CAM:
+
+    python benchmark.py --source recordings/sawah1.mjpeg --backends torch onnx openvino --imgsz 640 480
+
+Every backend and resolution replays the recordings through the code main()
+runs: the reduced-scale decode of the sources, fit_to_input, main.detect()
+(motion gate, tracker and the batched model), the detection record and the
+broadcaster's JPEG encode. It reports FPS, p50/p95/p99 latency, CPU and RSS.
+The results are written as JSON so releases can be compared.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import platform
+import numpy as np
+import cv2 as cv
+import psutil
+from main import MOTION_THRESHOLD, MOTION_KEYFRAME_INTERVAL, DETECT_INTERVAL, TRACK_MIN_CONFIDENCE, detect
+from replay_source import ReplaySource
+from mjpeg_stream import fit_to_input
+from inference_backend import create_backend
+from detections import BIRD_CLASS_ID, draw_detections, to_record
+from motion_gate import MotionGate
+from tracker import BirdTracker
+from metrics import CameraMetrics
+from websocket_server import FrameBroadcaster
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGES = ("decode", "resize", "predict", "postprocess", "record", "annotate", "encode")
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    ms = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3),
+            "mean": round(float(ms.mean()), 3)}
+
+
+class StageRecorder(CameraMetrics):
+    """
+    Keeps every stage timing of detect() and the broadcaster instead of a histogram.
+    """
+    def __init__(self, stage_times):
+        super().__init__(None, None)
+        self.stage_times = stage_times
+
+    def observe(self, stage, seconds):
+        self.stage_times.setdefault(stage, []).append(seconds)
+
+
+def run_pipeline(backend, sources, imgsz, max_frames=None, motion_gate=True, tracking=True, encode=False, warmup=5):
+    """
+    Replay the sources through the detection path of main() and measure every frame.
+        :param backend: InferenceBackend
+        :param sources: List of ReplaySource, read round-robin like the cameras in main()
+        :param imgsz: Long side of the model input
+        :param max_frames: Stop after this many frames, None replays the whole recordings
+        :param motion_gate: Skip the model on static frames
+        :param tracking: Run the model every few frames and track in between
+        :param encode: Draw and JPEG-encode every frame like an annotated stream
+        :param warmup: Frames run through the model before the measurement
+        :return: Dictionary with the measurements
+    """
+    stage_times = {stage: [] for stage in STAGES}
+    camera_metrics = [StageRecorder(stage_times) for _ in sources]
+    gates = [MotionGate(MOTION_THRESHOLD, MOTION_KEYFRAME_INTERVAL) for _ in sources]
+    trackers = [BirdTracker(DETECT_INTERVAL, min_confidence=TRACK_MIN_CONFIDENCE) for _ in sources]
+    # Not started, only its encode() is used
+    broadcasters = [FrameBroadcaster(metrics=metrics) for metrics in camera_metrics]
+    last_detections = [None] * len(sources)
+    latencies = []
+    skipped_frames = 0
+
+    # Warm up the backend so lazy initialization is not measured
+    warmup_frame = np.zeros((imgsz * 9 // 16, imgsz, 3), dtype=np.uint8)
+    for _ in range(warmup):
+        backend.predict([warmup_frame])
+
+    process = psutil.Process()
+    cpu_start = process.cpu_times()
+    rss_peak = process.memory_info().rss
+    wall_start = time.perf_counter()
+    frames = 0
+    rounds = 0
+    active = list(range(len(sources)))
+    for source in sources:
+        source.open()
+    while active and (max_frames is None or frames < max_frames):
+        # One frame per camera, like the newest frames main() takes from the mailboxes
+        items = []
+        timestamps = {}
+        for index in list(active):
+            if max_frames is not None and frames >= max_frames:
+                break
+            captured = sources[index].read()
+            if captured is None:
+                active.remove(index)
+                continue
+            if captured.image is None:
+                skipped_frames += 1
+                continue
+            if captured.jpeg is not None:
+                camera_metrics[index].observe("decode", sources[index].last_decode_time)
+            with camera_metrics[index].timer("resize"):
+                frame = fit_to_input(captured.image, imgsz)
+            items.append((index, frame, frames, captured.jpeg))
+            timestamps[index] = captured.timestamp
+            frames += 1
+
+        for index, frame, seq, jpeg, detections, _ in detect(backend, items, gates, trackers, last_detections,
+                                                             camera_metrics, motion_gate=motion_gate,
+                                                             tracking=tracking):
+            with camera_metrics[index].timer("record"):
+                json.dumps(to_record(detections, f"camera{index + 1}", seq, timestamps[index], frame.shape),
+                           separators=(",", ":"))
+            # Same as CameraPipeline: annotated frames are encoded, otherwise the camera JPEG is passed through
+            if encode or jpeg is None:
+                if encode and len(detections.scores):
+                    with camera_metrics[index].timer("annotate"):
+                        draw_detections(frame, detections, backend.names)
+                broadcasters[index].encode(frame)
+            # From the moment the frame was received (before decode) until its record and JPEG are ready
+            latencies.append(time.time() - timestamps[index])
+
+        rounds += 1
+        if rounds % 10 == 0:
+            rss_peak = max(rss_peak, process.memory_info().rss)
+    wall = time.perf_counter() - wall_start
+    cpu_end = process.cpu_times()
+    for source in sources:
+        source.close()
+
+    cpu_seconds = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    return {
+        "frames": frames,
+        "inferred": len(stage_times["predict"]),
+        "invalid_frames": skipped_frames,
+        "replay_skipped": sum(source.skipped for source in sources),
+        "wall_seconds": round(wall, 3),
+        "fps": round(frames / wall, 2) if wall else 0.0,
+        "latency_ms": percentiles(latencies),
+        "stages_ms": {stage: percentiles(values) for stage, values in stage_times.items() if values},
+        "cpu_seconds": round(cpu_seconds, 3),
+        "cpu_percent": round(cpu_seconds / wall * 100, 1) if wall else 0.0,
+        "rss_peak_mb": round(max(rss_peak, process.memory_info().rss) / 2 ** 20, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the detection pipeline on recorded streams")
+    parser.add_argument("--source", nargs="+", required=True,
+                        help="Recorded MJPEG files, video files or image directories, one per simulated camera")
+    parser.add_argument("--backends", nargs="+", default=["torch"], choices=["torch", "onnx", "openvino"])
+    parser.add_argument("--precision", nargs="+", default=["int8"], choices=["int8", "fp32"],
+                        help="Model precision of the exported backends, torch always runs FP32")
+    parser.add_argument("--imgsz", nargs="+", type=int, default=[640], help="Model input sizes to compare")
+    parser.add_argument("--max-frames", type=int, default=None)
+    parser.add_argument("--realtime", action="store_true", help="Replay at the recording frame rate instead of as fast as possible")
+    parser.add_argument("--fps", type=float, default=None, help="Replay frame rate for MJPEG files and image directories")
+    parser.add_argument("--no-motion-gate", action="store_true")
+    parser.add_argument("--no-tracking", action="store_true")
+    parser.add_argument("--encode", action="store_true", help="Draw and JPEG-encode every frame (annotated stream)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.backends:
+        precisions = ["fp32"] if name == "torch" else args.precision
+        for precision in precisions:
+            for imgsz in args.imgsz:
+                label = f"{name}-{precision}@{imgsz}"
+                entry = {"backend": name, "precision": precision, "imgsz": imgsz}
+                try:
+                    backend = create_backend(name, int8=precision == "int8", imgsz=imgsz, batch=1, classes=[BIRD_CLASS_ID])
+                    sources = [ReplaySource(path, imgsz, fps=args.fps, realtime=args.realtime) for path in args.source]
+                    entry.update(run_pipeline(backend, sources, imgsz, args.max_frames,
+                                              motion_gate=not args.no_motion_gate,
+                                              tracking=not args.no_tracking, encode=args.encode))
+                    logger.info("%-20s %7.1f FPS  p50 %.1f ms  p95 %.1f ms  p99 %.1f ms  CPU %.0f%%  RSS %.0f MB",
+                                label, entry["fps"], entry["latency_ms"]["p50"] or 0, entry["latency_ms"]["p95"] or 0,
+                                entry["latency_ms"]["p99"] or 0, entry["cpu_percent"], entry["rss_peak_mb"])
+                except Exception as e:
+                    # A missing export or a static model of another size must not stop the other runs
+                    logger.error("%s failed: %s", label, e)
+                    entry["error"] = str(e)
+                results.append(entry)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": sys.version.split()[0],
+            "opencv": cv.__version__,
+        },
+        "sources": args.source,
+        "realtime": args.realtime,
+        "motion_gate": not args.no_motion_gate,
+        "tracking": not args.no_tracking,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Benchmark results written to %s", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+Emulator of the ESP32-CAM web server (ESP32AIThinkerCamera/app_httpd.cpp) for
+load tests without hardware. Every instance serves /status, /control, /xclk and
+/capture on the control port and /stream on the next port, from recorded
+footage or a synthetic scene:
+
+    python camera_emulator.py --source recordings/sawah1.mjpeg --count 20 --host 127.0.0.10
+
+starts 20 cameras on 127.0.0.10 ... 127.0.0.29, ports 80 and 81 like the real
+cameras. Binding port 80 needs root (or net.ipv4.ip_unprivileged_port_start=80);
+use --port 8080 to serve on 8080/8081 instead. The printed IP_ADDRESS_CAMERA<n>
+lines carry the port and can be pasted into the detector's .env. All instances
+run in one asyncio loop and share one frame cache, so dozens of cameras fit in
+one process.
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import ipaddress
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import cv2 as cv
+from mjpeg_stream import STREAM_CONTENT_TYPE, multipart_part
+from replay_source import iter_recording
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# framesize_t of the esp32-camera driver: index -> (width, height)
+FRAME_SIZES = {
+    0: (96, 96), 1: (160, 120), 2: (176, 144), 3: (240, 176), 4: (240, 240), 5: (320, 240),
+    6: (400, 296), 7: (480, 320), 8: (640, 480), 9: (800, 600), 10: (1024, 768),
+    11: (1280, 720), 12: (1280, 1024), 13: (1600, 1200),
+}
+# Largest frame size of the OV2640 on the AI Thinker board (UXGA)
+MAX_FRAMESIZE = 13
+# CameraWebServer.ino drops the sensor to QVGA after init
+DEFAULT_FRAMESIZE = 5
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+def synthetic_frames(count=100, size=(1600, 1200)):
+    """
+    Synthetic footage when no recording is given: a field with a bird-sized
+    blob crossing it, so the motion gate and the detector have something to do.
+        :return: List of BGR frames
+    """
+    width, height = size
+    background = np.zeros((height, width, 3), dtype=np.uint8)
+    background[:, :] = (60, 140, 90)
+    background[: height // 3] = (200, 170, 120)
+    frames = []
+    for i in range(count):
+        frame = background.copy()
+        x = int(width * i / count)
+        y = height // 2 + int(height / 8 * np.sin(i / 8))
+        cv.ellipse(frame, (x, y), (width // 40, height // 60), 0, 0, 360, (40, 40, 40), -1)
+        cv.putText(frame, f"{i:04d}", (20, height - 20), cv.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+        frames.append(frame)
+    return frames
+
+
+class FootageLibrary:
+    """
+    Footage shared by all emulated cameras. The source frames are kept as
+    JPEG; every frame size and quality is encoded once on first use and cached.
+    """
+    def __init__(self, source=None, max_frames=300):
+        """
+        :param source: Recorded MJPEG file, video file or image directory, None for synthetic footage
+        :param max_frames: Maximum number of frames loaded from the recording
+        """
+        self.originals = []
+        if source:
+            for jpeg, image in iter_recording(source):
+                if jpeg is None:
+                    jpeg = cv.imencode('.jpg', image, [int(cv.IMWRITE_JPEG_QUALITY), 95])[1].tobytes()
+                self.originals.append(jpeg)
+                if len(self.originals) >= max_frames:
+                    break
+        else:
+            for image in synthetic_frames():
+                self.originals.append(cv.imencode('.jpg', image, [int(cv.IMWRITE_JPEG_QUALITY), 95])[1].tobytes())
+        if not self.originals:
+            raise ValueError(f"No frames in {source}")
+        self._cache = {}
+        logger.info("Loaded %d frames of footage", len(self.originals))
+
+    def __len__(self):
+        return len(self.originals)
+
+    def cached(self, framesize, quality, index):
+        return self._cache.get((framesize, quality, index))
+
+    def frame(self, framesize, quality, index):
+        """
+        JPEG of a frame at the given frame size, encoded on first use.
+            :param framesize: framesize_t index
+            :param quality: ESP32 JPEG quality (0-63, lower is better)
+            :param index: Frame index
+            :return: JPEG bytes
+        """
+        key = (framesize, quality, index)
+        jpeg = self._cache.get(key)
+        if jpeg is None:
+            image = cv.imdecode(np.frombuffer(self.originals[index], dtype=np.uint8), cv.IMREAD_COLOR)
+            image = cv.resize(image, FRAME_SIZES[framesize], interpolation=cv.INTER_AREA)
+            cv_quality = int(np.clip(100 - quality * 1.5, 10, 95))
+            jpeg = cv.imencode('.jpg', image, [int(cv.IMWRITE_JPEG_QUALITY), cv_quality])[1].tobytes()
+            self._cache[key] = jpeg
+        return jpeg
+
+
+class EmulatedCamera:
+    """
+    One emulated ESP32-CAM: the control server and the stream server on the next port.
+    """
+    def __init__(self, library, host, port=80, fps=10, latency=0.0, jitter=0.0, drop_rate=0.0, offset=0):
+        """
+        :param library: Shared FootageLibrary
+        :param host: Address to bind, e.g. 127.0.0.10
+        :param port: Control port, the stream is served on port + 1 like app_httpd.cpp
+        :param fps: Frame rate of the stream
+        :param latency: Extra delay in seconds before every response and frame
+        :param jitter: Random extra delay of up to this many seconds
+        :param drop_rate: Probability per frame that the stream connection is dropped
+        :param offset: First frame of the footage, so cameras do not show the same frame
+        """
+        self.library = library
+        self.host = host
+        self.port = port
+        self.fps = fps
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.offset = offset
+        self.started = time.time()
+        self.status = {
+            "xclk": 20, "pixformat": 4, "framesize": DEFAULT_FRAMESIZE, "quality": 10,
+            "brightness": 0, "contrast": 0, "saturation": 0, "sharpness": 0, "special_effect": 0,
+            "wb_mode": 0, "awb": 1, "awb_gain": 1, "aec": 1, "aec2": 0, "ae_level": 0, "aec_value": 168,
+            "agc": 1, "agc_gain": 0, "gainceiling": 0, "bpc": 0, "wpc": 1, "raw_gma": 1, "lenc": 1,
+            "hmirror": 0, "dcw": 1, "colorbar": 0, "led_intensity": -1,
+        }
+        self.streams = 0
+        self.frames_sent = 0
+        self.dropped = 0
+        self.servers = []
+
+    async def delay(self):
+        wait = self.latency + random.uniform(0, self.jitter)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def start(self):
+        self.servers.append(await asyncio.start_server(self.handle_control, self.host, self.port))
+        self.servers.append(await asyncio.start_server(self.handle_stream, self.host, self.port + 1))
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+    @staticmethod
+    async def read_request(reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None, None
+        # Skip the request headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) < 2:
+            return None, None
+        url = urlsplit(parts[1])
+        return url.path, {key: values[0] for key, values in parse_qs(url.query).items()}
+
+    @staticmethod
+    async def respond(writer, status, body=b"", content_type="text/html", headers=None):
+        head = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Type: {content_type}",
+                f"Content-Length: {len(body)}", "Access-Control-Allow-Origin: *", "Connection: close"]
+        for name, value in (headers or {}).items():
+            head.append(f"{name}: {value}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    def set_control(self, variable, value):
+        # Mirrors cmd_handler: returns False when the sensor rejects the value
+        if variable not in self.status or variable in ("xclk", "pixformat", "led_intensity"):
+            return False
+        if variable == "framesize":
+            if value not in FRAME_SIZES or value > MAX_FRAMESIZE:
+                return False
+            logger.info("Camera %s frame size %s", self.host, FRAME_SIZES[value])
+        if variable == "quality" and not 4 <= value <= 63:
+            return False
+        self.status[variable] = value
+        return True
+
+    async def handle_control(self, reader, writer):
+        try:
+            path, query = await self.read_request(reader)
+            if path is None:
+                return
+            await self.delay()
+            if path == "/status":
+                await self.respond(writer, 200, json.dumps(self.status, separators=(",", ":")).encode(), "application/json")
+            elif path == "/control":
+                if "var" not in query or "val" not in query:
+                    await self.respond(writer, 404)
+                    return
+                try:
+                    ok = self.set_control(query["var"], int(query["val"]))
+                except ValueError:
+                    ok = False
+                await self.respond(writer, 200 if ok else 500)
+            elif path == "/xclk":
+                if "xclk" not in query:
+                    await self.respond(writer, 404)
+                    return
+                try:
+                    self.status["xclk"] = int(query["xclk"])
+                    await self.respond(writer, 200)
+                except ValueError:
+                    await self.respond(writer, 500)
+            elif path == "/capture":
+                jpeg = await self.next_jpeg(int((time.time() - self.started) * self.fps))
+                timestamp = time.time() - self.started
+                await self.respond(writer, 200, jpeg, "image/jpeg", {
+                    "Content-Disposition": "inline; filename=capture.jpg",
+                    "X-Timestamp": f"{int(timestamp)}.{int(timestamp % 1 * 1000000):06d}",
+                })
+            else:
+                await self.respond(writer, 404)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def next_jpeg(self, index):
+        framesize, quality = self.status["framesize"], self.status["quality"]
+        index = (index + self.offset) % len(self.library)
+        jpeg = self.library.cached(framesize, quality, index)
+        if jpeg is None:
+            # First use of this frame size: encode in a worker thread, the other cameras keep streaming
+            jpeg = await asyncio.get_running_loop().run_in_executor(None, self.library.frame, framesize, quality, index)
+        return jpeg
+
+    async def handle_stream(self, reader, writer):
+        try:
+            path, _ = await self.read_request(reader)
+            if path != "/stream":
+                if path is not None:
+                    await self.respond(writer, 404)
+                return
+            await self.delay()
+            writer.write(("HTTP/1.1 200 OK\r\n"
+                          f"Content-Type: {STREAM_CONTENT_TYPE}\r\n"
+                          "Transfer-Encoding: chunked\r\n"
+                          "Access-Control-Allow-Origin: *\r\n"
+                          f"X-Framerate: {self.fps}\r\n\r\n").encode())
+            self.streams += 1
+            interval = 1.0 / self.fps
+            start = time.time()
+            index = 0
+            while True:
+                if self.drop_rate and random.random() < self.drop_rate:
+                    self.dropped += 1
+                    logger.info("Camera %s dropping stream connection", self.host)
+                    writer.transport.abort()
+                    return
+                jpeg = await self.next_jpeg(index)
+                data = multipart_part(jpeg, time.time() - self.started) + jpeg
+                # httpd_resp_send_chunk uses chunked transfer encoding
+                writer.write(b"%x\r\n" % len(data) + data + b"\r\n")
+                await writer.drain()
+                self.frames_sent += 1
+                index += 1
+                await self.delay()
+                # Keep the frame rate, but never send faster to catch up with a slow client
+                wait = start + index * interval - time.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                else:
+                    start = time.time() - index * interval
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.streams = max(0, self.streams - 1)
+            writer.close()
+
+
+async def run(args):
+    library = FootageLibrary(args.source, args.max_frames)
+    first = ipaddress.ip_address(args.host)
+    cameras = []
+    for i in range(args.count):
+        # Spread the cameras over the footage so they do not all show the same frame
+        offset = i * len(library) // args.count
+        camera = EmulatedCamera(library, str(first + i), args.port, args.fps, args.latency / 1000,
+                                args.jitter / 1000, args.drop_rate, offset)
+        await camera.start()
+        cameras.append(camera)
+    for n, camera in enumerate(cameras, start=1):
+        # The detector reads the control port from the address and streams from the next port
+        address = camera.host if camera.port == 80 else f"{camera.host}:{camera.port}"
+        print(f"IP_ADDRESS_CAMERA{n}={address}")
+    logger.info("%d cameras running on %s ports %d/%d", len(cameras), args.host, args.port, args.port + 1)
+    try:
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            streams = sum(camera.streams for camera in cameras)
+            frames = sum(camera.frames_sent for camera in cameras)
+            dropped = sum(camera.dropped for camera in cameras)
+            logger.info("Open streams: %d, frames sent: %d, dropped connections: %d", streams, frames, dropped)
+    finally:
+        for camera in cameras:
+            await camera.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate ESP32-CAM web servers for load testing")
+    parser.add_argument("--source", default=None, help="Recorded MJPEG file, video file or image directory, default synthetic footage")
+    parser.add_argument("--count", type=int, default=1, help="Number of cameras")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the first camera, the others use the next addresses")
+    parser.add_argument("--port", type=int, default=80, help="Control port, the stream uses port + 1")
+    parser.add_argument("--fps", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0, help="Extra delay per response and frame in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="Random extra delay up to this many ms")
+    parser.add_argument("--drop-rate", type=float, default=0, help="Probability per frame of dropping the stream connection")
+    parser.add_argument("--max-frames", type=int, default=300, help="Frames loaded from the recording")
+    parser.add_argument("--stats-interval", type=float, default=30)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        logger.info("Emulator stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import time
+import logging
+from contextlib import nullcontext
+import cv2 as cv
+from detections import draw_detections, to_record
+
+logger = logging.getLogger(__name__)
+
+
+class CameraPipeline:
+    """
+    Per-camera output pipeline. It receives the detection result of its own
+    camera from the shared inference loop and handles the deterrent,
+    the Ubidots telemetry and the WebSocket stream of that camera.
+    """
+    def __init__(self, camera_id, camera_ip, field, deterrent, ubidots_client, broadcaster, ubidots_variable="bird_detected",
+                 annotate=False, show_preview=True, metrics=None, recorder=None):
+        """
+        :param camera_id: Name of the camera, used for logging and the preview window
+        :param camera_ip: IP address of the ESP32-CAM
+        :param field: Field (sawah) covered by the camera, e.g. "sawah1"
+        :param deterrent: Shared DeterrentController
+        :param ubidots_client: Shared ubidots client instance
+        :param broadcaster: FrameBroadcaster of this camera
+        :param ubidots_variable: Ubidots variable label for the detection state
+        :param annotate: Draw the detections into the WebSocket frames as well, viewers can
+                         also draw them from the metadata channel. HTTP and HLS frames are always annotated
+        :param show_preview: Show the annotated frames in a local OpenCV window
+        :param metrics: Optional CameraMetrics for the notify and annotate stages
+        :param recorder: Optional ClipRecorder, a clip is saved around every detection
+        """
+        self.camera_id = camera_id
+        self.camera_ip = camera_ip
+        self.field = field
+        self.deterrent = deterrent
+        self.ubidots_client = ubidots_client
+        self.broadcaster = broadcaster
+        self.ubidots_variable = ubidots_variable
+        self.annotate = annotate
+        self.show_preview = show_preview
+        self.metrics = metrics
+        self.recorder = recorder
+        self.last_detection_time = 0
+        self.bird_detected = False
+
+    def send_detection_to_ubidots(self, detected, new_birds=None):
+        """
+        Fungsi untuk mengirim data deteksi burung ke Ubidots.
+        :param detected: Boolean, True jika burung terdeteksi, False jika tidak.
+        :param new_birds: Boolean dari tracker, True jika ada burung baru. None jika tracker tidak aktif.
+        """
+        current_time = time.time()
+
+        if detected:
+            # Dengan tracker hanya burung baru yang dikirim, tanpa tracker paling cepat tiap 2 detik
+            if new_birds or (new_birds is None and current_time - self.last_detection_time >= 2):
+                self.ubidots_client.send_bird_detection(3, variable=self.ubidots_variable)
+                self.last_detection_time = current_time
+                self.bird_detected = True
+        else:
+            # Jika sebelumnya terdeteksi dan sekarang tidak, kirim 0
+            if self.bird_detected:
+                self.ubidots_client.send_bird_detection(1, variable=self.ubidots_variable)
+                self.bird_detected = False
+
+    def handle(self, frame, detections, names, new_track_ids=None, frame_id=0, jpeg=None):
+        """
+        Process the detections of one frame of this camera.
+            :param frame: Frame that was passed to the model (BGR numpy array)
+            :param detections: Detections of the frame (bird class only)
+            :param names: Class names of the model
+            :param new_track_ids: Track ids that appeared on this frame, None when tracking is disabled
+            :param frame_id: Sequence number of the frame
+            :param jpeg: Original JPEG bytes from the camera, passed through to viewers when annotating is off
+        """
+        detected = len(detections.scores) > 0
+        new_birds = None if new_track_ids is None else len(new_track_ids) > 0
+        with self._timer("notify"):
+            # With tracking the deterrent reacts to new birds only, not to every frame.
+            # The controller thread applies the cooldowns and publishes
+            if new_birds or (new_birds is None and detected):
+                self.deterrent.trigger(self.field, self.camera_id)
+            # Every frame with birds extends the clip until the post-roll has passed
+            if detected and self.recorder is not None:
+                self.recorder.trigger()
+
+            self.send_detection_to_ubidots(detected, new_birds)
+
+        # Drawing only happens when someone looks at the annotated frames
+        annotate = detected and self.annotate and self.broadcaster.has_frame_clients()
+        annotated = None
+        with self._timer("annotate"):
+            if annotate:
+                draw_detections(frame, detections, names)
+            elif detected and (self.show_preview or self.broadcaster.wants_annotated()):
+                # HTTP and HLS viewers cannot draw the records, they get a drawn copy
+                annotated = frame.copy()
+                draw_detections(annotated, detections, names)
+            if self.show_preview:
+                cv.imshow(f'YOLO Detection {self.camera_id}', annotated if annotated is not None else frame)
+
+        record = to_record(detections, self.camera_id, frame_id, time.time(), frame.shape)
+        # Tells metadata viewers not to draw the boxes a second time
+        record["annotated"] = annotate
+        # WebSocket viewers get the camera JPEG untouched, no re-encode. With ANNOTATE_FRAMES every
+        # frame is encoded from the model input, so the size does not change when a bird appears
+        self.broadcaster.publish(frame, record, jpeg=None if self.annotate else jpeg, annotated=annotated)
+        if self.metrics is not None:
+            self.metrics.frame_done()
+
+    def _timer(self, stage):
+        return self.metrics.timer(stage) if self.metrics is not None else nullcontext()
@@ -0,0 +1,197 @@
+import os
+import glob
+import time
+import queue
+import logging
+import threading
+from collections import deque
+import cv2 as cv
+from mjpeg_stream import multipart_part
+
+logger = logging.getLogger(__name__)
+
+
+class PreRollBuffer:
+    """
+    Ring buffer of the last seconds of a camera as compressed JPEG bytes,
+    bounded by age and by total size.
+    """
+    def __init__(self, seconds=5, max_bytes=32 * 1024 * 1024):
+        """
+        :param seconds: Keep the frames of the last this many seconds
+        :param max_bytes: Upper bound of the buffered JPEG bytes
+        """
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.bytes = 0
+
+    def append(self, timestamp, jpeg):
+        self.frames.append((timestamp, jpeg))
+        self.bytes += len(jpeg)
+        while self.frames and (self.frames[0][0] < timestamp - self.seconds or self.bytes > self.max_bytes):
+            self.bytes -= len(self.frames.popleft()[1])
+
+    def snapshot(self):
+        return list(self.frames)
+
+
+class ClipWriter(threading.Thread):
+    """
+    Background thread that writes finished clips to disk and enforces the
+    retention time and the disk quota of the clip directory. Clips are saved
+    in the multipart format of the camera stream, so they can be replayed
+    with ReplaySource or served by camera_emulator.py.
+    """
+    def __init__(self, directory="clips", retention_days=7, quota_bytes=2 * 1024 ** 3, max_pending=8):
+        """
+        :param directory: Directory of the clip files
+        :param retention_days: Delete clips older than this many days, 0 keeps them
+        :param quota_bytes: Delete the oldest clips when the directory grows above this size, 0 disables
+        :param max_pending: Clips waiting to be written, further clips are dropped
+        """
+        super().__init__(daemon=True, name="clip-writer")
+        self.directory = directory
+        self.retention_days = retention_days
+        self.quota_bytes = quota_bytes
+        self.queue = queue.Queue(max_pending)
+        self.clips_written = 0
+        self.clips_dropped = 0
+        self.clips_evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, camera_id, frames):
+        """
+        Queue a clip without blocking.
+            :param camera_id: Name of the camera
+            :param frames: List of tuples (timestamp, jpeg)
+        """
+        try:
+            self.queue.put_nowait((camera_id, frames))
+        except queue.Full:
+            self.clips_dropped += 1
+            logger.warning("Clip writer busy, dropping clip of %s", camera_id)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            camera_id, frames = item
+            try:
+                self.write(camera_id, frames)
+                self.evict()
+            except OSError as e:
+                logger.error(f"Error writing clip of {camera_id}: {e}")
+
+    def write(self, camera_id, frames):
+        start = frames[0][0]
+        name = f"{camera_id}_{time.strftime('%Y%m%d_%H%M%S', time.localtime(start))}_{int(start * 1000) % 1000:03d}.mjpeg"
+        path = os.path.join(self.directory, name)
+        # Write to a temporary name first, a half-written clip is never picked up
+        with open(path + ".part", "wb") as f:
+            for timestamp, jpeg in frames:
+                f.write(multipart_part(jpeg, timestamp))
+                f.write(jpeg)
+        os.replace(path + ".part", path)
+        self.clips_written += 1
+        logger.info("Saved clip %s: %d frames, %.1f s", path, len(frames), frames[-1][0] - start)
+
+    def evict(self):
+        clips = []
+        for path in glob.glob(os.path.join(self.directory, "*.mjpeg")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            clips.append((stat.st_mtime, stat.st_size, path))
+        clips.sort()
+        total = sum(size for _, size, _ in clips)
+        expire = time.time() - self.retention_days * 86400
+        for mtime, size, path in clips:
+            expired = self.retention_days and mtime < expire
+            over_quota = self.quota_bytes and total > self.quota_bytes
+            if not expired and not over_quota:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.clips_evicted += 1
+                logger.info("Removed clip %s (%s)", path, "retention" if expired else "disk quota")
+            except OSError as e:
+                logger.warning(f"Cannot remove clip {path}: {e}")
+
+
+class ClipRecorder:
+    """
+    Event clip recorder of one camera. The capture thread adds every frame to
+    the pre-roll buffer; a detection starts a clip with the pre-roll and
+    keeps recording until the post-roll has passed. Finished clips go to the
+    ClipWriter, so neither the capture thread nor the inference loop touch the disk.
+    """
+    def __init__(self, camera_id, writer, pre_roll=5, post_roll=10, max_duration=60, jpeg_quality=80):
+        """
+        :param camera_id: Name of the camera, used in the clip file names
+        :param writer: Shared ClipWriter
+        :param pre_roll: Seconds before the detection included in the clip
+        :param post_roll: Seconds recorded after the last detection
+        :param max_duration: Upper bound of the clip length in seconds
+        :param jpeg_quality: JPEG quality for sources without JPEG bytes
+        """
+        self.camera_id = camera_id
+        self.writer = writer
+        self.post_roll = post_roll
+        self.max_duration = max_duration
+        self.jpeg_quality = jpeg_quality
+        self.buffer = PreRollBuffer(pre_roll)
+        self.clip = None
+        self.clip_end = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, timestamp, jpeg=None, image=None):
+        """
+        Add a frame from the capture thread.
+            :param timestamp: Capture time of the frame
+            :param jpeg: JPEG bytes from the camera
+            :param image: Decoded frame, only encoded when there are no JPEG bytes
+        """
+        if jpeg is None:
+            if image is None:
+                return
+            jpeg = cv.imencode('.jpg', image, [int(cv.IMWRITE_JPEG_QUALITY), self.jpeg_quality])[1].tobytes()
+        finished = None
+        with self._lock:
+            self.buffer.append(timestamp, jpeg)
+            if self.clip is not None:
+                self.clip.append((timestamp, jpeg))
+                if timestamp >= self.clip_end or timestamp - self.clip[0][0] >= self.max_duration:
+                    finished, self.clip = self.clip, None
+        if finished:
+            self.writer.submit(self.camera_id, finished)
+
+    def trigger(self, timestamp=None):
+        """
+        Start a clip on a detection, or extend the running clip.
+            :param timestamp: Time of the detection, defaults to now
+        """
+        timestamp = timestamp or time.time()
+        with self._lock:
+            if self.clip is None:
+                self.clip = self.buffer.snapshot()
+            self.clip_end = timestamp + self.post_roll
+
+    def flush(self):
+        """
+        Hand the running clip to the writer, e.g. on shutdown.
+        """
+        with self._lock:
+            finished, self.clip = self.clip, None
+        if finished:
+            self.writer.submit(self.camera_id, finished)
+
+    @property
+    def recording(self):
+        return self.clip is not None
@@ -0,0 +1,98 @@
+import logging
+from collections import namedtuple
+import numpy as np
+import cv2 as cv
+
+logger = logging.getLogger(__name__)
+
+BIRD_CLASS_ID = 14
+
+# Detections of one frame as compact NumPy arrays:
+# boxes (N, 4) int32 xyxy pixels, scores (N,) float32, classes (N,) int32,
+# track_ids (N,) int64 when the boxes come from the tracker, otherwise None
+Detections = namedtuple("Detections", ["boxes", "scores", "classes", "track_ids"], defaults=(None,))
+
+EMPTY_DETECTIONS = Detections(
+    np.empty((0, 4), dtype=np.int32),
+    np.empty((0,), dtype=np.float32),
+    np.empty((0,), dtype=np.int32),
+)
+
+
+def from_result(result, class_id=BIRD_CLASS_ID):
+    """
+    Convert an Ultralytics result to Detections with one device-to-host copy per tensor.
+        :param result: Ultralytics result of one frame
+        :param class_id: Only keep boxes of this class, None keeps all classes
+        :return: Detections
+    """
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return EMPTY_DETECTIONS
+    data = boxes.data.cpu().numpy()
+    classes = data[:, 5].astype(np.int32)
+    if class_id is not None:
+        data = data[classes == class_id]
+        classes = classes[classes == class_id]
+    return Detections(data[:, :4].astype(np.int32), data[:, 4].astype(np.float32), classes)
+
+
+def to_record(detections, camera_id, frame_id, timestamp, frame_shape):
+    """
+    Compact, JSON-serializable detection record of one frame for the metadata channel.
+        :param detections: Detections of the frame
+        :param camera_id: Name of the camera
+        :param frame_id: Sequence number of the frame
+        :param timestamp: Capture time of the frame (epoch seconds)
+        :param frame_shape: Shape of the frame the boxes refer to
+        :return: Dictionary
+    """
+    return {
+        "camera": camera_id,
+        "frame_id": frame_id,
+        "timestamp": round(timestamp, 3),
+        "width": frame_shape[1],
+        "height": frame_shape[0],
+        "boxes": detections.boxes.tolist(),
+        "scores": np.round(detections.scores, 3).tolist(),
+        "classes": detections.classes.tolist(),
+        "track_ids": detections.track_ids.tolist() if detections.track_ids is not None else None,
+    }
+
+
+def box_iou(a, b):
+    """
+    IoU matrix between two sets of xyxy boxes.
+        :param a: (N, 4) boxes
+        :param b: (M, 4) boxes
+        :return: (N, M) IoU matrix
+    """
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def draw_detections(frame, detections, names, color=(0, 255, 0)):
+    """
+    Draw the boxes and labels of the detections on the frame in place.
+        :param frame: BGR frame
+        :param detections: Detections of the frame
+        :param names: Class names of the model
+    """
+    track_ids = detections.track_ids.tolist() if detections.track_ids is not None else [None] * len(detections.scores)
+    for (x1, y1, x2, y2), score, cls, track_id in zip(detections.boxes.tolist(), detections.scores.tolist(),
+                                                      detections.classes.tolist(), track_ids):
+        # Validate class name
+        class_name = names.get(cls, "Unknown")
+        if not isinstance(class_name, str):
+            logger.warning(f"Invalid class name for cls={cls}: {class_name}")
+            class_name = "Unknown"
+        label = f"{class_name} {score:.2f}" if track_id is None else f"#{track_id} {class_name} {score:.2f}"
+        cv.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+        try:
+            cv.putText(frame, label, (x1, y1 - 10), cv.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+        except Exception as e:
+            logger.error(f"Error in cv.putText: {e}")
@@ -0,0 +1,152 @@
+import time
+import queue
+import logging
+import threading
+from common.mqtt_topics import COMMANDS, DEFAULT_SPEAKER
+
+logger = logging.getLogger(__name__)
+
+# Serialized once, every play command sends the same bytes
+PLAY_PAYLOAD = COMMANDS["play"][2].encode()
+
+
+class DeterrentController(threading.Thread):
+    """
+    Plays the deterrent sound on its own thread. The camera pipelines only
+    put detection events into a queue; the controller coalesces the events of
+    all cameras of a field that arrive within coalesce_window, applies the
+    field and speaker cooldowns and publishes the play command to every
+    speaker of the field.
+
+    With metrics it records per camera the time from the detection to the
+    publish ("publish" stage) and to the PUBACK of the broker ("ack" stage).
+    """
+    def __init__(self, mqtt_client, speakers=None, field_cooldown=5, speaker_cooldown=5, coalesce_window=0.2,
+                 max_pending=100, metrics=None):
+        """
+        :param mqtt_client: Shared MyMQTTClient instance
+        :param speakers: Dict field -> list of speaker names, see common.mqtt_topics.parse_speakers;
+                         fields without an entry use DEFAULT_SPEAKER
+        :param field_cooldown: Minimum seconds between two deterrent actions on a field
+        :param speaker_cooldown: Minimum seconds between two play commands to one speaker
+        :param coalesce_window: Seconds detections of other cameras are merged into the same action
+        :param max_pending: Detection events waiting in the queue, further events are dropped
+        :param metrics: Optional MetricsRegistry for the publish and ack latencies
+        """
+        super().__init__(daemon=True, name="deterrent")
+        self.mqtt_client = mqtt_client
+        self.speakers = speakers or {}
+        self.field_cooldown = field_cooldown
+        self.speaker_cooldown = speaker_cooldown
+        self.coalesce_window = coalesce_window
+        self.metrics = metrics
+        self.queue = queue.Queue(max_pending)
+        self.triggers = 0
+        self.coalesced = 0
+        self.suppressed = 0
+        self.published = 0
+        self.failed = 0
+        self.acked = 0
+        self.lost = 0
+        self.pending_acks = 0
+        self.events_dropped = 0
+        self._field_times = {}
+        self._speaker_times = {}
+        self._ack_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def trigger(self, field, camera_id, timestamp=None):
+        """
+        Report a detection without blocking.
+            :param field: Field (sawah) of the camera
+            :param camera_id: Name of the camera
+            :param timestamp: Time of the detection, defaults to now
+        """
+        try:
+            self.queue.put_nowait((field, camera_id, timestamp or time.time()))
+        except queue.Full:
+            self.events_dropped += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.queue.put(None)
+
+    def run(self):
+        while not self._stopped.is_set():
+            event = self.queue.get()
+            if event is None:
+                break
+            events = {event[0]: [event]}
+            # Collect the detections of the other cameras of the field
+            deadline = time.time() + self.coalesce_window
+            while True:
+                try:
+                    event = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if event is None:
+                    self._stopped.set()
+                    break
+                events.setdefault(event[0], []).append(event)
+            for field, field_events in events.items():
+                self.triggers += 1
+                self.coalesced += len(field_events) - 1
+                self._deter(field, field_events)
+
+    def _deter(self, field, events):
+        now = time.time()
+        if now - self._field_times.get(field, 0) < self.field_cooldown:
+            self.suppressed += 1
+            return
+        for speaker in self.speakers.get(field, [DEFAULT_SPEAKER]):
+            topic = f"control/{field}/{speaker}/play"
+            if now - self._speaker_times.get(topic, 0) < self.speaker_cooldown:
+                continue
+            # A play command replayed after an outage would scare nothing, it is not buffered
+            future = self.mqtt_client.publish(topic, PLAY_PAYLOAD, qos=1, buffer=False)
+            publish_time = time.time()
+            if future.done() and future.exception() is not None:
+                self.failed += 1
+                logger.warning(f"Failed to send play command to {topic}: {future.exception()}")
+                continue
+            self.published += 1
+            self._speaker_times[topic] = publish_time
+            self._field_times[field] = publish_time
+            with self._ack_lock:
+                self.pending_acks += 1
+            future.add_done_callback(lambda future, events=events: self._on_ack(future, events))
+            self._observe(events, "publish", publish_time)
+            logger.info("Deterrent played on %s (%d detections)", topic, len(events))
+
+    def _on_ack(self, future, events):
+        # Runs on the MQTT network thread, or right away if the PUBACK came before add_done_callback
+        with self._ack_lock:
+            self.pending_acks -= 1
+            if future.exception() is not None:
+                self.lost += 1
+            else:
+                self.acked += 1
+        if future.exception() is not None:
+            logger.warning(f"Play command to {future.topic} not acknowledged: {future.exception()}")
+            return
+        # The future resolves with the publish-to-ack latency
+        self._observe(events, "ack", future.sent_at + future.result())
+
+    def _observe(self, events, stage, end):
+        if self.metrics is None:
+            return
+        for _, camera_id, timestamp in events:
+            self.metrics.observe(camera_id, stage, max(end - timestamp, 0.0))
+
+    def stats(self):
+        return {
+            "triggers": self.triggers,
+            "coalesced": self.coalesced,
+            "suppressed": self.suppressed,
+            "published": self.published,
+            "failed": self.failed,
+            "acked": self.acked,
+            "pending_acks": self.pending_acks,
+            "lost": self.lost,
+            "events_dropped": self.events_dropped,
+        }
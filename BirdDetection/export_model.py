@@ -0,0 +1,272 @@
+"""
+Export the bird detection model for the ONNX Runtime and OpenVINO backends.
+
+Produces a static-shape FP32 model and an INT8-quantized model per backend,
+calibrated on frames sampled from our own recordings:
+
+    python export_model.py --frames recordings/ --formats onnx openvino --verify
+"""
+import os
+import glob
+import time
+import random
+import argparse
+import logging
+import numpy as np
+import cv2 as cv
+import yaml
+from ultralytics import YOLO
+from inference_backend import MODEL_DIR, MODEL_NAME, create_backend
+from detections import box_iou
+from mjpeg_stream import fit_to_input
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".mjpeg", ".mjpg")
+
+
+def iter_recorded_frames(frames_dir, video_stride=15):
+    """
+    Iterate over the frames of a recording directory.
+        :param frames_dir: Directory with images and/or video files
+        :param video_stride: Only every n-th frame of a video is used
+        :return: Generator of BGR frames
+    """
+    for path in sorted(glob.glob(os.path.join(frames_dir, "**", "*"), recursive=True)):
+        ext = os.path.splitext(path)[1].lower()
+        if ext in IMAGE_EXTENSIONS:
+            frame = cv.imread(path)
+            if frame is not None:
+                yield frame
+        elif ext in VIDEO_EXTENSIONS:
+            cap = cv.VideoCapture(path)
+            index = 0
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if index % video_stride == 0:
+                    yield frame
+                index += 1
+            cap.release()
+
+
+def build_calibration_set(frames_dir, out_dir, names, size=300, imgsz=640, seed=0):
+    """
+    Sample a calibration set from recorded frames and write it as an Ultralytics dataset.
+    Frames are scaled like in main() so the calibration matches production input.
+        :param frames_dir: Directory with recorded images and/or videos
+        :param out_dir: Output directory of the calibration set
+        :param names: Class names of the model
+        :param size: Number of frames in the calibration set
+        :param imgsz: Input size of the model
+        :param seed: Random seed of the sampling
+        :return: Tuple (path of data.yaml, list of image paths)
+    """
+    rng = random.Random(seed)
+    # Reservoir sampling over JPEG bytes keeps memory low for long recordings
+    reservoir = []
+    for count, frame in enumerate(iter_recorded_frames(frames_dir)):
+        if len(reservoir) < size:
+            slot = len(reservoir)
+            reservoir.append(None)
+        else:
+            slot = rng.randint(0, count)
+            if slot >= size:
+                continue
+        frame = fit_to_input(frame, imgsz)
+        reservoir[slot] = cv.imencode(".jpg", frame, [int(cv.IMWRITE_JPEG_QUALITY), 95])[1].tobytes()
+    if not reservoir:
+        raise ValueError(f"No recorded frames found in {frames_dir}")
+
+    image_dir = os.path.join(out_dir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    image_paths = []
+    for i, jpeg in enumerate(reservoir):
+        path = os.path.join(image_dir, f"calib_{i:05d}.jpg")
+        with open(path, "wb") as f:
+            f.write(jpeg)
+        image_paths.append(path)
+
+    data_yaml = os.path.join(out_dir, "data.yaml")
+    with open(data_yaml, "w") as f:
+        yaml.safe_dump({
+            "path": os.path.abspath(out_dir),
+            "train": "images",
+            "val": "images",
+            "names": dict(names),
+        }, f)
+    logger.info("Calibration set with %d frames written to %s", len(image_paths), out_dir)
+    return data_yaml, image_paths
+
+
+def preprocess(frame, imgsz):
+    """
+    Convert a BGR frame to the NCHW float input of the exported model,
+    letterboxed with the Ultralytics gray padding.
+    """
+    frame = fit_to_input(frame, imgsz)
+    height, width = frame.shape[:2]
+    top, left = (imgsz - height) // 2, (imgsz - width) // 2
+    frame = cv.copyMakeBorder(frame, top, imgsz - height - top, left, imgsz - width - left,
+                              cv.BORDER_CONSTANT, value=(114, 114, 114))
+    image = cv.cvtColor(frame, cv.COLOR_BGR2RGB).transpose(2, 0, 1)
+    return np.ascontiguousarray(image, dtype=np.float32) / 255.0
+
+
+def detect_head_nodes(onnx_model):
+    """
+    Nodes of the box decoding in the Detect head (the last module). They are
+    kept in FP32, quantizing the DFL/concat arithmetic costs a lot of accuracy.
+    """
+    prefixes = sorted({node.name.split("/")[1] for node in onnx_model.graph.node
+                       if node.name.startswith("/model.")}, key=lambda p: int(p.split(".")[1]))
+    if not prefixes:
+        return []
+    head = f"/{prefixes[-1]}/"
+    return [node.name for node in onnx_model.graph.node
+            if node.name.startswith(head) and node.op_type != "Conv"]
+
+
+def quantize_onnx(fp32_path, int8_path, image_paths, imgsz=640, batch=1):
+    """
+    Static INT8 quantization of an ONNX model with ONNX Runtime.
+        :param fp32_path: Path of the static-shape FP32 ONNX model
+        :param int8_path: Output path of the INT8 model
+        :param image_paths: Calibration images
+        :param imgsz: Input size of the model
+        :param batch: Batch size of the static-shape model
+        :return: int8_path
+    """
+    import onnx
+    from onnxruntime.quantization import quantize_static, CalibrationDataReader, QuantFormat, QuantType
+
+    fp32_model = onnx.load(fp32_path)
+    input_name = fp32_model.graph.input[0].name
+
+    class FrameCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self.index = 0
+
+        def get_next(self):
+            if self.index + batch > len(image_paths):
+                return None
+            frames = [cv.imread(p) for p in image_paths[self.index:self.index + batch]]
+            self.index += batch
+            return {input_name: np.stack([preprocess(f, imgsz) for f in frames])}
+
+    quantize_static(
+        fp32_path, int8_path, FrameCalibrationReader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+        nodes_to_exclude=detect_head_nodes(fp32_model),
+    )
+
+    # Ultralytics reads stride, imgsz and class names from the model metadata
+    int8_model = onnx.load(int8_path)
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, int8_path)
+    logger.info("INT8 ONNX model written to %s", int8_path)
+    return int8_path
+
+
+def export_models(weights, frames_dir, formats, imgsz=640, batch=1, calib_size=300):
+    """
+    Export static-shape FP32 and INT8 models for the selected backends.
+        :return: Tuple (dictionary backend name -> {"fp32": path, "int8": path}, calibration image paths)
+    """
+    model = YOLO(weights)
+    data_yaml, image_paths = build_calibration_set(
+        frames_dir, os.path.join(MODEL_DIR, "calibration"), model.names, calib_size, imgsz)
+
+    exported = {}
+    if "onnx" in formats:
+        fp32_path = model.export(format="onnx", imgsz=imgsz, batch=batch, dynamic=False, simplify=True)
+        int8_path = quantize_onnx(fp32_path, fp32_path.replace(".onnx", "_int8.onnx"), image_paths, imgsz, batch)
+        exported["onnx"] = {"fp32": fp32_path, "int8": int8_path}
+    if "openvino" in formats:
+        fp32_path = model.export(format="openvino", imgsz=imgsz, batch=batch, dynamic=False)
+        # Ultralytics runs NNCF post-training quantization on the calibration dataset
+        int8_path = model.export(format="openvino", imgsz=imgsz, batch=batch, dynamic=False, int8=True, data=data_yaml)
+        exported["openvino"] = {"fp32": fp32_path, "int8": int8_path}
+    return exported, image_paths
+
+
+def compare_backends(backends, image_paths, iou_threshold=0.5, warmup=3):
+    """
+    Compare detections and latency of every backend with the first one (the reference).
+        :param backends: Dictionary label -> InferenceBackend, the first entry is the reference
+        :param image_paths: Images used for the comparison
+        :return: Dictionary label -> metrics
+    """
+    frames = [cv.imread(p) for p in image_paths]
+    outputs = {}
+    for label, backend in backends.items():
+        for frame in frames[:warmup]:
+            backend.predict([frame])
+        boxes, latencies = [], []
+        for frame in frames:
+            start = time.perf_counter()
+            result = backend.predict([frame])[0]
+            latencies.append(time.perf_counter() - start)
+            boxes.append(result.boxes.xyxy.cpu().numpy())
+        outputs[label] = (boxes, latencies)
+
+    reference_label = next(iter(backends))
+    reference_boxes, reference_latencies = outputs[reference_label]
+    reference_ms = np.median(reference_latencies) * 1000
+    report = {}
+    for label, (boxes, latencies) in outputs.items():
+        matched, ious, total_ref, total = 0, [], 0, 0
+        for ref, cand in zip(reference_boxes, boxes):
+            total_ref += len(ref)
+            total += len(cand)
+            if len(ref) and len(cand):
+                iou = box_iou(ref, cand)
+                best = iou.max(axis=1)
+                matched += int(np.count_nonzero(best >= iou_threshold))
+                ious.extend(best[best >= iou_threshold])
+        median_ms = np.median(latencies) * 1000
+        report[label] = {
+            "median_latency_ms": median_ms,
+            "speedup": reference_ms / median_ms if median_ms else 0.0,
+            "detections": total,
+            "recall_vs_reference": matched / total_ref if total_ref else 1.0,
+            "mean_iou": float(np.mean(ious)) if ious else 0.0,
+        }
+        logger.info("%-16s %8.1f ms  x%.1f  detections=%d  recall=%.3f  mean IoU=%.3f",
+                    label, median_ms, report[label]["speedup"], total,
+                    report[label]["recall_vs_reference"], report[label]["mean_iou"])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the bird detection model for ONNX Runtime and OpenVINO")
+    parser.add_argument("--weights", default=os.path.join(MODEL_DIR, f"{MODEL_NAME}.pt"))
+    parser.add_argument("--frames", required=True, help="Directory with recorded frames or videos for calibration")
+    parser.add_argument("--formats", nargs="+", default=["onnx", "openvino"], choices=["onnx", "openvino"])
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--batch", type=int, default=1, help="Static batch size, use the number of cameras")
+    parser.add_argument("--calib-size", type=int, default=300)
+    parser.add_argument("--verify", action="store_true", help="Compare detections and latency with the PyTorch model")
+    args = parser.parse_args()
+
+    exported, image_paths = export_models(args.weights, args.frames, args.formats, args.imgsz, args.batch, args.calib_size)
+    for name, paths in exported.items():
+        logger.info("%s: fp32=%s int8=%s", name, paths["fp32"], paths["int8"])
+
+    if args.verify:
+        backends = {"torch": create_backend("torch", args.weights, imgsz=args.imgsz)}
+        for name, paths in exported.items():
+            for precision, path in paths.items():
+                backends[f"{name}-{precision}"] = create_backend(name, path, imgsz=args.imgsz, batch=args.batch)
+        compare_backends(backends, image_paths)
+
+
+if __name__ == "__main__":
+    main()
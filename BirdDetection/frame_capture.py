@@ -0,0 +1,184 @@
+import threading
+import time
+import logging
+import numpy as np
+import cv2 as cv
+from mjpeg_stream import Frame
+
+logger = logging.getLogger(__name__)
+
+
+class LatestFrameMailbox:
+    """
+    Single-slot mailbox between the capture stage and the inference loop.
+    The writer always overwrites the slot, so the reader only ever sees the
+    newest frame; frames overwritten before being read are counted as dropped.
+    """
+    def __init__(self, cond=None):
+        """
+        :param cond: Optional threading.Condition shared by several mailboxes,
+                     required by get_latest_frames
+        """
+        self._cond = cond or threading.Condition()
+        self._frame = None
+        self._seq = 0
+        self._read_seq = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        """
+        Publish a new frame, replacing any frame that has not been read yet.
+            :param frame: Frame from the source
+        """
+        with self._cond:
+            self._frame = frame
+            self._seq += 1
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Wait for a frame newer than the last one returned.
+            :param timeout: Maximum time to wait in seconds, None waits forever
+            :return: Tuple (frame, seq, dropped_since_last_get), frame is None on timeout
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > self._read_seq, timeout):
+                return None, self._read_seq, 0
+            dropped = self._seq - self._read_seq - 1
+            self._read_seq = self._seq
+            self.dropped += dropped
+            return self._frame, self._seq, dropped
+
+    def has_new_frame(self):
+        return self._seq > self._read_seq
+
+
+def get_latest_frames(mailboxes, cond, timeout=None):
+    """
+    Wait until at least one mailbox has a new frame and take the newest frame
+    of every mailbox that has one.
+        :param mailboxes: List of LatestFrameMailbox sharing the same condition
+        :param cond: The threading.Condition shared by the mailboxes
+        :param timeout: Maximum time to wait in seconds, None waits forever
+        :return: List of tuples (index, frame, seq, dropped), empty on timeout
+    """
+    with cond:
+        if not cond.wait_for(lambda: any(mb.has_new_frame() for mb in mailboxes), timeout):
+            return []
+        # The condition is reentrant, so get() does not block here
+        return [(i, *mb.get(timeout=0)) for i, mb in enumerate(mailboxes) if mb.has_new_frame()]
+
+
+class VideoCaptureSource:
+    """
+    Frame source on top of cv.VideoCapture, for streams and files that are
+    not ESP32 MJPEG streams. It has the same interface as MjpegStreamReader.
+    """
+    def __init__(self, url):
+        """
+        :param url: Stream URL or video file path
+        """
+        self.url = url
+        self._cap = None
+
+    @property
+    def is_open(self):
+        return self._cap is not None and self._cap.isOpened()
+
+    def open(self):
+        self.close()
+        self._cap = cv.VideoCapture(self.url)
+        # Keep the internal buffer as small as possible, we only want the latest frame
+        self._cap.set(cv.CAP_PROP_BUFFERSIZE, 1)
+        return self._cap.isOpened()
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def read(self):
+        ret, image = self._cap.read()
+        if not ret or image is None or not isinstance(image, np.ndarray) or image.size == 0:
+            self.close()
+            return None
+        return Frame(image, None, time.time())
+
+
+class CaptureThread(threading.Thread):
+    """
+    Background thread that keeps draining a frame source and publishes
+    only the newest frame into a LatestFrameMailbox.
+    """
+    def __init__(self, source, mailbox, reconnect_delay=0.2, max_reconnect_delay=5, name="capture", metrics=None,
+                 recorder=None):
+        """
+        :param source: Frame source, MjpegStreamReader, VideoCaptureSource or ReplaySource
+        :param mailbox: LatestFrameMailbox that receives the frames
+        :param reconnect_delay: Initial delay before reopening the stream in seconds
+        :param max_reconnect_delay: Upper bound of the reconnect backoff in seconds
+        :param name: Name of the thread
+        :param metrics: Optional CameraMetrics for the read and decode stages
+        :param recorder: Optional ClipRecorder, receives every frame for the pre-roll
+        """
+        super().__init__(daemon=True, name=name)
+        self.source = source
+        self.mailbox = mailbox
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.metrics = metrics
+        self.recorder = recorder
+        self.frames_read = 0
+        self.invalid_frames = 0
+        self._stop_event = threading.Event()
+
+    def open(self):
+        """
+        Open the frame source.
+            :return: True if the source is opened
+        """
+        return self.source.open()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        delay = self.reconnect_delay
+        try:
+            while not self._stop_event.is_set():
+                if not self.source.is_open:
+                    if getattr(self.source, "finished", False):
+                        logger.info("Frame source %s finished", self.source.url)
+                        break
+                    if not self.source.open():
+                        logger.warning("Cannot open camera stream %s, retrying in %.1f seconds", self.source.url, delay)
+                        self._stop_event.wait(delay)
+                        delay = min(delay * 2, self.max_reconnect_delay)
+                        continue
+                    logger.info("Camera stream %s opened", self.source.url)
+
+                start = time.perf_counter()
+                frame = self.source.read()
+                if frame is None:
+                    logger.warning("Camera stream %s broken, attempting to reconnect", self.source.url)
+                    self._stop_event.wait(delay)
+                    continue
+                if frame.image is None:
+                    self.invalid_frames += 1
+                    continue
+
+                if self.metrics is not None:
+                    decode_time = getattr(self.source, "last_decode_time", 0.0)
+                    self.metrics.observe("read", time.perf_counter() - start - decode_time)
+                    if decode_time:
+                        self.metrics.observe("decode", decode_time)
+
+                delay = self.reconnect_delay
+                self.frames_read += 1
+                self.mailbox.put(frame)
+                if self.recorder is not None:
+                    # Every frame goes to the pre-roll, also those the inference loop skips
+                    self.recorder.add(frame.timestamp, frame.jpeg, frame.image)
+        finally:
+            self.source.close()
+            logger.info("Capture thread for %s stopped", self.source.url)
@@ -0,0 +1,136 @@
+import os
+import glob
+import shutil
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST = "index.m3u8"
+# Files written by the HLS muxer, the only files served from the directory
+HLS_EXTENSIONS = {".m3u8": "application/vnd.apple.mpegurl", ".m4s": "video/iso.segment", ".mp4": "video/mp4"}
+
+
+class H264Encoder(threading.Thread):
+    """
+    Encodes the broadcast JPEG frames of one camera to H.264 with an ffmpeg
+    process and writes them as HLS with fragmented MP4 segments into a
+    directory, which the broadcaster serves at /hls/. The JPEGs are piped to
+    ffmpeg on this thread; the broadcaster only hands over the newest frame,
+    so a slow encoder skips frames instead of delaying the viewers. ffmpeg is
+    restarted when it exits.
+    """
+    def __init__(self, directory, bitrate="300k", fps=10, keyint=20, height=480, segment_seconds=2,
+                 playlist_size=6, ffmpeg="ffmpeg"):
+        """
+        :param directory: Output directory of the playlist and segments
+        :param bitrate: Target video bitrate, e.g. "300k"
+        :param fps: Output frame rate, frames are duplicated or dropped to reach it
+        :param keyint: Frames between two keyframes, segments start on a keyframe
+        :param height: Output height (aspect ratio kept), 0 keeps the input size
+        :param segment_seconds: Target segment duration
+        :param playlist_size: Segments kept in the playlist, older ones are deleted
+        :param ffmpeg: ffmpeg executable
+        """
+        super().__init__(daemon=True, name=f"h264-{os.path.basename(directory)}")
+        self.directory = os.path.abspath(directory)
+        self.bitrate = bitrate
+        self.fps = fps
+        self.keyint = keyint
+        self.height = height
+        self.segment_seconds = segment_seconds
+        self.playlist_size = playlist_size
+        self.ffmpeg = ffmpeg
+        self.process = None
+        self.frames_written = 0
+        self.frames_skipped = 0
+        self.restarts = 0
+        self._jpeg = None
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+
+    def command(self):
+        command = [self.ffmpeg, "-hide_banner", "-loglevel", "error",
+                   "-f", "mjpeg", "-use_wallclock_as_timestamps", "1", "-i", "pipe:0"]
+        if self.height:
+            command += ["-vf", f"scale=-2:{self.height}"]
+        command += ["-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency", "-pix_fmt", "yuv420p",
+                    "-b:v", self.bitrate, "-maxrate", self.bitrate, "-bufsize", self.bitrate,
+                    "-g", str(self.keyint), "-keyint_min", str(self.keyint), "-sc_threshold", "0",
+                    "-r", str(self.fps),
+                    "-f", "hls", "-hls_time", str(self.segment_seconds), "-hls_list_size", str(self.playlist_size),
+                    "-hls_flags", "delete_segments+independent_segments+omit_endlist",
+                    "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", "init.mp4",
+                    "-hls_segment_filename", os.path.join(self.directory, "segment%06d.m4s"),
+                    os.path.join(self.directory, PLAYLIST)]
+        return command
+
+    def put(self, jpeg, frame_time=None):
+        """
+        Hand over the newest JPEG frame without blocking.
+        """
+        with self._condition:
+            if self._jpeg is not None:
+                self.frames_skipped += 1
+            self._jpeg = jpeg
+            self._condition.notify()
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify()
+
+    def run(self):
+        if shutil.which(self.ffmpeg) is None:
+            logger.error("ffmpeg not found (%s), H.264 output disabled", self.ffmpeg)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Segments of a previous run would be listed by no playlist
+        for path in glob.glob(os.path.join(self.directory, "*")):
+            if os.path.splitext(path)[1] in HLS_EXTENSIONS:
+                os.remove(path)
+        delay = 1
+        while not self._stopped.is_set():
+            with self._condition:
+                while self._jpeg is None and not self._stopped.is_set():
+                    self._condition.wait()
+                jpeg, self._jpeg = self._jpeg, None
+            if jpeg is None:
+                break
+            if self.process is None or self.process.poll() is not None:
+                if self.process is not None:
+                    self.restarts += 1
+                    logger.warning("ffmpeg exited with %s, restarting in %d s", self.process.returncode, delay)
+                    if self._stopped.wait(delay):
+                        break
+                    delay = min(delay * 2, 30)
+                self.process = subprocess.Popen(self.command(), stdin=subprocess.PIPE)
+                logger.info("H.264 output started in %s (%s, keyframe every %d frames)",
+                            self.directory, self.bitrate, self.keyint)
+            try:
+                self.process.stdin.write(jpeg)
+                self.process.stdin.flush()
+                self.frames_written += 1
+                delay = 1
+            except (BrokenPipeError, OSError) as e:
+                logger.error(f"Failed to write frame to ffmpeg: {e}")
+        self._close_process()
+
+    def _close_process(self):
+        if self.process is None:
+            return
+        try:
+            # Closing stdin lets ffmpeg finish the last segment
+            self.process.stdin.close()
+            self.process.wait(5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+    def stats(self):
+        return {
+            "running": self.process is not None and self.process.poll() is None,
+            "frames_written": self.frames_written,
+            "frames_skipped": self.frames_skipped,
+            "restarts": self.restarts,
+        }
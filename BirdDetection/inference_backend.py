@@ -0,0 +1,113 @@
+import os
+import logging
+from ultralytics import YOLO
+
+logger = logging.getLogger(__name__)
+
+MODEL_DIR = "Model"
+MODEL_NAME = "yolo11m-birds-detection"
+
+
+class InferenceBackend:
+    """
+    Base class of the detection backends. Every backend loads its own model
+    format through Ultralytics, so pre- and post-processing (letterbox, NMS,
+    class names) are identical and detections stay comparable between backends.
+    """
+    name = None
+
+    def __init__(self, model_path, imgsz=640, conf=0.5, batch=None, classes=None):
+        """
+        :param model_path: Path of the model weights for this backend
+        :param imgsz: Input size of the model
+        :param conf: Confidence threshold
+        :param batch: Fixed batch size of a static-shape model, None for dynamic batch
+        :param classes: Class ids kept by the model NMS, None keeps all classes
+        """
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Model for backend {self.name} not found: {model_path}, run export_model.py first")
+        self.model_path = model_path
+        self.imgsz = imgsz
+        self.conf = conf
+        self.batch = batch
+        self.classes = classes
+        self.model = YOLO(model_path, task="detect")
+        logger.info("Loaded %s backend from %s", self.name, model_path)
+
+    @property
+    def names(self):
+        return self.model.names
+
+    def predict(self, frames):
+        """
+        Run the detector on a batch of frames.
+            :param frames: List of BGR frames
+            :return: List of Ultralytics results, one per frame
+        """
+        if not self.batch:
+            return self.model.predict(source=frames, conf=self.conf, imgsz=self.imgsz, classes=self.classes, show=False, save=False, verbose=False)
+        # Static-shape models only accept their exported batch size
+        results = []
+        for i in range(0, len(frames), self.batch):
+            chunk = frames[i:i + self.batch]
+            count = len(chunk)
+            # Pad the last chunk with copies, their results are discarded
+            chunk = chunk + [chunk[-1]] * (self.batch - count)
+            results.extend(self.model.predict(source=chunk, conf=self.conf, imgsz=self.imgsz, classes=self.classes, show=False, save=False, verbose=False)[:count])
+        return results
+
+
+class TorchBackend(InferenceBackend):
+    name = "torch"
+
+    @staticmethod
+    def default_model_path(int8=False):
+        # PyTorch weights are never quantized
+        return os.path.join(MODEL_DIR, f"{MODEL_NAME}.pt")
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    name = "onnx"
+
+    @staticmethod
+    def default_model_path(int8=False):
+        suffix = "_int8" if int8 else ""
+        return os.path.join(MODEL_DIR, f"{MODEL_NAME}{suffix}.onnx")
+
+
+class OpenVINOBackend(InferenceBackend):
+    name = "openvino"
+
+    @staticmethod
+    def default_model_path(int8=False):
+        suffix = "_int8" if int8 else ""
+        return os.path.join(MODEL_DIR, f"{MODEL_NAME}{suffix}_openvino_model")
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    OnnxRuntimeBackend.name: OnnxRuntimeBackend,
+    OpenVINOBackend.name: OpenVINOBackend,
+}
+
+
+def create_backend(name="torch", model_path=None, int8=True, imgsz=640, conf=0.5, batch=None, classes=None):
+    """
+    Create the inference backend selected in the configuration.
+        :param name: Backend name: "torch", "onnx" or "openvino"
+        :param model_path: Path of the model, defaults to the file written by export_model.py
+        :param int8: Use the INT8-quantized model when model_path is not given
+        :param imgsz: Input size of the model
+        :param conf: Confidence threshold
+        :param batch: Fixed batch size of a static-shape model, ignored for torch
+        :param classes: Class ids kept by the model NMS, None keeps all classes
+        :return: InferenceBackend instance
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {name}, choose one of {list(BACKENDS)}")
+    backend_cls = BACKENDS[name]
+    if model_path is None:
+        model_path = backend_cls.default_model_path(int8)
+    if backend_cls is TorchBackend:
+        batch = None
+    return backend_cls(model_path, imgsz=imgsz, conf=conf, batch=batch, classes=classes)
@@ -1,18 +1,29 @@
-import numpy as np
+import os
+import sys
+# The modules shared with the Dashboard are in the common package at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import threading
+import time
 import cv2 as cv
-from ultralytics import YOLO
 from camera_control import control_camera_esp_ai_thinker_to_hd, cek_camera_esp_ai_thinker
 from dotenv import load_dotenv
-import os
 from mqtt_control import MyMQTTClient
-import asyncio
-import websockets
-import base64
-import threading
-import time
-import janus
 import logging
 from ubidots_client import ubidots
+from frame_capture import LatestFrameMailbox, CaptureThread, VideoCaptureSource, get_latest_frames
+from mjpeg_stream import MjpegStreamReader, fit_to_input
+from replay_source import ReplaySource
+from websocket_server import FrameBroadcaster
+from h264_output import H264Encoder
+from camera_pipeline import CameraPipeline
+from motion_gate import MotionGate
+from inference_backend import create_backend
+from detections import BIRD_CLASS_ID, from_result
+from tracker import BirdTracker
+from metrics import MetricsRegistry, MetricsServer
+from clip_recorder import ClipRecorder, ClipWriter
+from deterrent import DeterrentController
+from common.mqtt_topics import parse_speakers
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -21,111 +32,218 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv(override=True)
 
-# Set of WebSocket clients
-ws_clients = set()
-frame_queue = None
+WEBSOCKET_PORT = int(os.environ.get("WEBSOCKET_PORT", 8765))
+# MJPEG /stream and /snapshot for browsers and NVRs, camera n on STREAM_PORT + n - 1; 0 disables it
+STREAM_HOST = os.environ.get("STREAM_HOST", "0.0.0.0")
+STREAM_PORT = int(os.environ.get("STREAM_PORT", 8081))
+# Optional H.264 HLS output (needs ffmpeg), served at /hls/index.m3u8 on the stream port
+H264_STREAM = os.environ.get("H264_STREAM", "0") == "1"
+H264_BITRATE = os.environ.get("H264_BITRATE", "300k")
+H264_FPS = int(os.environ.get("H264_FPS", 10))
+H264_KEYINT = int(os.environ.get("H264_KEYINT", 20))
+H264_HEIGHT = int(os.environ.get("H264_HEIGHT", 480))
+H264_SEGMENT = float(os.environ.get("H264_SEGMENT", 2))
+HLS_DIR = os.environ.get("HLS_DIR", "hls")
+MOTION_GATE = os.environ.get("MOTION_GATE", "1") == "1"
+MOTION_THRESHOLD = float(os.environ.get("MOTION_THRESHOLD", 0.005))
+MOTION_KEYFRAME_INTERVAL = int(os.environ.get("MOTION_KEYFRAME_INTERVAL", 30))
+STATS_LOG_INTERVAL = int(os.environ.get("STATS_LOG_INTERVAL", 60))
+METRICS_HOST = os.environ.get("METRICS_HOST", "localhost")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+INFERENCE_INT8 = os.environ.get("INFERENCE_INT8", "1") == "1"
+INFERENCE_BATCH = int(os.environ.get("INFERENCE_BATCH", 1))
+MODEL_PATH = os.environ.get("MODEL_PATH") or None
+TRACKING = os.environ.get("TRACKING", "1") == "1"
+DETECT_INTERVAL = int(os.environ.get("DETECT_INTERVAL", 5))
+TRACK_MIN_CONFIDENCE = float(os.environ.get("TRACK_MIN_CONFIDENCE", 0.3))
+# Also draw the detections into the WebSocket frames, HTTP and HLS frames always carry them
+ANNOTATE_FRAMES = os.environ.get("ANNOTATE_FRAMES", "0") == "1"
+SHOW_PREVIEW = os.environ.get("SHOW_PREVIEW", "1") == "1"
+STREAM_READER = os.environ.get("STREAM_READER", "mjpeg")
+INPUT_SIDE = 640
+RECORD_CLIPS = os.environ.get("RECORD_CLIPS", "1") == "1"
+CLIP_DIR = os.environ.get("CLIP_DIR", "clips")
+CLIP_PRE_ROLL = float(os.environ.get("CLIP_PRE_ROLL", 5))
+CLIP_POST_ROLL = float(os.environ.get("CLIP_POST_ROLL", 10))
+CLIP_RETENTION_DAYS = float(os.environ.get("CLIP_RETENTION_DAYS", 7))
+CLIP_QUOTA_MB = int(os.environ.get("CLIP_QUOTA_MB", 2048))
+REPLAY_PATH = os.environ.get("REPLAY_PATH")
+REPLAY_REALTIME = os.environ.get("REPLAY_REALTIME", "1") == "1"
+REPLAY_LOOP = os.environ.get("REPLAY_LOOP", "1") == "1"
+DETERRENT_SPEAKERS = parse_speakers(os.environ.get("DETERRENT_SPEAKERS"))
+DETERRENT_COOLDOWN = float(os.environ.get("DETERRENT_COOLDOWN", 5))
+SPEAKER_COOLDOWN = float(os.environ.get("SPEAKER_COOLDOWN", 5))
+DETERRENT_COALESCE = float(os.environ.get("DETERRENT_COALESCE", 0.2))
+UBIDOTS_FLUSH_INTERVAL = float(os.environ.get("UBIDOTS_FLUSH_INTERVAL", 1))
+UBIDOTS_BACKLOG = os.environ.get("UBIDOTS_BACKLOG", "ubidots_backlog.jsonl") or None
 
-last_detection_time = 0
-bird_detected = False
 
-def send_detection_to_ubidots(client, detected):
+def load_camera_config():
     """
-    Fungsi untuk mengirim data deteksi burung ke Ubidots.
-    :param client: Instance dari ubidots client.
-    :param detected: Boolean, True jika burung terdeteksi, False jika tidak.
+    Read the cameras from the environment: IP_ADDRESS_CAMERA1, IP_ADDRESS_CAMERA2, ...
+    The address can carry the control port ("127.0.0.1:8080", default 80); the camera's
+    own /stream is on the next port like app_httpd.cpp, or on STREAM_PORT_CAMERA<n>.
+    Every camera can set its field with FIELD_CAMERA<n> (default "sawah1") and
+    gets its own WebSocket port starting from WEBSOCKET_PORT and HTTP stream port
+    starting from STREAM_PORT.
+    With REPLAY_PATH (comma-separated recordings) every recording replaces a camera.
+        :return: List of camera configurations
     """
-    global last_detection_time, bird_detected
-    current_time = time.time()
+    cameras = []
+    if REPLAY_PATH:
+        for n, path in enumerate(REPLAY_PATH.split(","), start=1):
+            cameras.append({
+                "id": f"camera{n}",
+                "ip": None,
+                "replay": path.strip(),
+                "field": os.environ.get(f"FIELD_CAMERA{n}", "sawah1"),
+                "ws_port": WEBSOCKET_PORT + n - 1,
+                "stream_port": STREAM_PORT + n - 1 if STREAM_PORT else None,
+            })
+        return cameras
+    n = 1
+    while os.environ.get(f"IP_ADDRESS_CAMERA{n}"):
+        address = os.environ.get(f"IP_ADDRESS_CAMERA{n}")
+        host, _, control_port = address.partition(":")
+        control_port = int(control_port or 80)
+        cameras.append({
+            "id": f"camera{n}",
+            "ip": address,
+            "host": host,
+            "camera_stream_port": int(os.environ.get(f"STREAM_PORT_CAMERA{n}", control_port + 1)),
+            "field": os.environ.get(f"FIELD_CAMERA{n}", "sawah1"),
+            "ws_port": WEBSOCKET_PORT + n - 1,
+            "stream_port": STREAM_PORT + n - 1 if STREAM_PORT else None,
+        })
+        n += 1
+    return cameras
 
-    if detected:
-        if current_time - last_detection_time >= 2:
-            client.send_bird_detection(3)
-            last_detection_time = current_time
-            bird_detected = True
-    else:
-        # Jika sebelumnya terdeteksi dan sekarang tidak, kirim 0
-        if bird_detected:
-            client.send_bird_detection(1)
-            bird_detected = False
 
-async def send_frame_to_websocket(frame):
-    try:
-        if frame is None or not isinstance(frame, np.ndarray) or frame.size == 0:
-            logger.warning("Invalid frame, skipping WebSocket send")
-            return
-        ret, buffer = cv.imencode('.jpg', frame, [int(cv.IMWRITE_JPEG_QUALITY), 85])
-        if not ret:
-            logger.warning("Failed to encode frame as JPEG")
-            return
-        jpg_as_text = base64.b64encode(buffer).decode('utf-8')
-        to_remove = set()
-        for websocket in ws_clients:
-            try:
-                await websocket.send(jpg_as_text)
-            except websockets.exceptions.ConnectionClosed:
-                to_remove.add(websocket)
-            except Exception as e:
-                logger.error(f"Error sending frame to client: {e}")
-                to_remove.add(websocket)
-        for ws in to_remove:
-            ws_clients.discard(ws)
-            logger.info("Removed disconnected WebSocket client")
-    except Exception as e:
-        logger.error(f"Error in send_frame_to_websocket: {e}")
-
-async def websocket_server():
-    async def handle_connection(websocket):
-        logger.info("New WebSocket client connected")
-        ws_clients.add(websocket)
-        try:
-            async for _ in websocket:
-                await asyncio.sleep(0.1)
-        except websockets.exceptions.ConnectionClosed:
-            logger.info("WebSocket client disconnected")
-        except Exception as e:
-            logger.error(f"Error in handle_connection: {e}")
-        finally:
-            ws_clients.discard(websocket)
-    try:
-        server = await websockets.serve(handle_connection, "localhost", 8765, ping_interval=10, ping_timeout=20)
-        logger.info("WebSocket server started on ws://localhost:8765")
-        await server.wait_closed()
-    except Exception as e:
-        logger.error(f"WebSocket server error: {e}")
-
-async def websocket_frame_sender(async_q):
-    while True:
-        try:
-            frame = await async_q.get()
-            if frame is None:
-                logger.warning("Received None frame, skipping")
-                continue
-            await send_frame_to_websocket(frame)
-            async_q.task_done()
-        except Exception as e:
-            logger.error(f"Error in websocket_frame_sender: {e}")
-            await asyncio.sleep(0.1)
-
-def start_async_loop():
-    global frame_queue
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        queue = janus.Queue(maxsize=10)
-        frame_queue = queue
-        loop.run_until_complete(asyncio.gather(
-            websocket_server(),
-            websocket_frame_sender(queue.async_q)
-        ))
-    except Exception as e:
-        logger.error(f"Async loop error: {e}")
-    finally:
-        loop.close()
-        logger.info("Async loop closed")
+def camera_collector(camera_id, capture, mailbox, gate, broadcaster, recorder=None):
+    """
+    Metrics collector of one camera: dropped frames, queue depths, motion gate and viewer counters.
+        :return: Callable for MetricsRegistry.add_collector
+    """
+    labels = {"camera": camera_id}
 
-def main():
-    # Define variables
-    camera_ip = os.environ.get("IP_ADDRESS_CAMERA1")
+    def collect():
+        gate_stats = gate.stats()
+        clients = broadcaster.stats()
+        samples = []
+        if recorder is not None:
+            samples.append(("preroll_bytes", "gauge", "JPEG bytes in the pre-roll buffer", labels, recorder.buffer.bytes))
+            samples.append(("clip_recording", "gauge", "1 while an event clip is being recorded", labels,
+                            int(recorder.recording)))
+        for output in broadcaster.outputs:
+            output_stats = output.stats()
+            samples += [
+                ("h264_running", "gauge", "1 while the ffmpeg process of the H.264 output runs", labels,
+                 int(output_stats["running"])),
+                ("h264_frames_total", "counter", "Frames piped to the H.264 encoder", labels,
+                 output_stats["frames_written"]),
+                ("h264_frames_skipped_total", "counter", "Frames skipped by a busy H.264 encoder", labels,
+                 output_stats["frames_skipped"]),
+                ("h264_restarts_total", "counter", "Restarts of the ffmpeg process", labels, output_stats["restarts"]),
+            ]
+        return samples + [
+            ("frames_read_total", "counter", "Frames read from the camera", labels, capture.frames_read),
+            ("frames_invalid_total", "counter", "Invalid JPEG parts skipped by the capture thread", labels, capture.invalid_frames),
+            ("frames_dropped_total", "counter", "Frames overwritten in the mailbox before inference", labels, mailbox.dropped),
+            ("stream_reconnects_total", "counter", "Connections opened to the camera stream", labels,
+             getattr(capture.source, "reconnects", 0)),
+            ("mailbox_depth", "gauge", "Frames waiting in the mailbox (0 or 1)", labels, int(mailbox.has_new_frame())),
+            ("motion_frames_skipped_total", "counter", "Frames skipped by the motion gate", labels, gate_stats["skipped"]),
+            ("motion_cpu_saved_seconds", "gauge", "Estimated CPU time saved by the motion gate", labels,
+             round(gate_stats["cpu_saved_seconds"], 3)),
+            ("websocket_clients", "gauge", "Connected WebSocket viewers", labels,
+             sum(1 for client in clients if client["channel"] != "mjpeg")),
+            ("mjpeg_clients", "gauge", "Connected MJPEG stream viewers", labels,
+             sum(1 for client in clients if client["channel"] == "mjpeg")),
+            ("websocket_queue_depth", "gauge", "Frames waiting to be encoded or sent to viewers", labels,
+             broadcaster.queue_depth()),
+            ("websocket_frames_encoded_total", "counter", "Frames JPEG-encoded by the broadcaster", labels,
+             broadcaster.frames_encoded),
+            ("websocket_frames_skipped_total", "counter", "Frames replaced in a slow viewer's slot", labels,
+             sum(client["frames_skipped"] for client in clients)),
+        ]
+    return collect
+
+
+def mqtt_collector(connection):
+    def collect():
+        stats = connection.stats()
+        return [
+            ("mqtt_connected", "gauge", "1 while the MQTT broker is connected", {}, int(stats["connected"])),
+            ("mqtt_reconnects_total", "counter", "MQTT reconnects after a lost connection", {}, stats["reconnects"]),
+            ("mqtt_last_reconnect_seconds", "gauge", "Time from the last disconnect until connected again", {},
+             round(stats["last_reconnect_seconds"], 3)),
+            ("mqtt_buffered", "gauge", "Messages buffered while disconnected", {}, stats["buffered"]),
+            ("mqtt_dropped_total", "counter", "Messages dropped from the full buffer", {}, stats["dropped"]),
+            ("mqtt_in_flight", "gauge", "Messages waiting for the PUBACK of the broker", {}, stats["in_flight"]),
+            ("mqtt_acked_total", "counter", "Messages acknowledged by the broker", {}, stats["acked"]),
+            ("mqtt_ack_timeouts_total", "counter", "Messages not acknowledged within the ack timeout", {},
+             stats["ack_timeouts"]),
+        ]
+    return collect
+
+
+def mqtt_ack_collector(connection):
+    def collect():
+        return [("mqtt_ack_seconds", "Time from publish to the PUBACK of the broker", {"topic": topic},
+                 stats["buckets"], stats["counts"], stats["sum"], stats["count"])
+                for topic, stats in sorted(connection.ack_stats().items())]
+    return collect
+
+
+def ubidots_collector(uploader):
+    def collect():
+        stats = uploader.stats()
+        return [
+            ("ubidots_pending", "gauge", "Ubidots values waiting for upload", {}, stats["pending"]),
+            ("ubidots_sent_total", "counter", "Ubidots values uploaded", {}, stats["sent"]),
+            ("ubidots_dropped_total", "counter", "Ubidots values dropped", {}, stats["dropped"]),
+            ("ubidots_failed_requests_total", "counter", "Failed Ubidots requests", {}, stats["failed_requests"]),
+            ("ubidots_backlog_batches", "gauge", "Batches in the Ubidots backlog file", {}, stats["backlog_batches"]),
+        ]
+    return collect
+
+
+def check_cameras(cameras):
+    """
+    Check that every camera answers and switch it to HD, recordings are skipped.
+        :param cameras: List of camera configurations
+    """
+    if not cameras:
+        logger.error("No camera configured, set IP_ADDRESS_CAMERA1")
+        raise ValueError("No camera configured")
+    for camera in cameras:
+        if camera.get("replay"):
+            continue
+        if not cek_camera_esp_ai_thinker(camera["ip"]):
+            logger.error(f"Camera {camera['id']} not connected")
+            raise ValueError("Camera not connected")
+        control_camera_esp_ai_thinker_to_hd(camera["ip"])
+        logger.info(f"Camera at {camera['ip']} set to HD")
+
+
+def create_source(camera):
+    """
+    :return: Frame source of the camera: ReplaySource, MjpegStreamReader or VideoCaptureSource
+    """
+    if camera.get("replay"):
+        return ReplaySource(camera["replay"], INPUT_SIDE, realtime=REPLAY_REALTIME, loop=REPLAY_LOOP)
+    stream_url = f'http://{camera["host"]}:{camera["camera_stream_port"]}/stream'
+    if STREAM_READER == "mjpeg":
+        return MjpegStreamReader(stream_url, INPUT_SIDE)
+    return VideoCaptureSource(stream_url)
+
+
+def connect_clients():
+    """
+    Connect the MQTT client and create the Ubidots client from the environment.
+        :return: Tuple (MyMQTTClient, ubidots client)
+    """
     broker = os.environ.get("BROKER")
     username = os.environ.get("BROKER_USERNAME")
     port = int(os.environ.get("BROKER_PORT"))
@@ -133,109 +251,276 @@ def main():
     ubidots_token = os.environ.get("UBIDOTS_TOKEN")
     ubidots_device_id = os.environ.get("UBIDOTS_CLIENT_ID")
 
-    # Check camera
-    if not cek_camera_esp_ai_thinker(camera_ip):
-        logger.error("Camera not connected")
-        raise ValueError("Camera not connected")
-    control_camera_esp_ai_thinker_to_hd(camera_ip)
-    logger.info(f"Camera at {camera_ip} set to HD")
-
-    # Connect MQTT
     client = MyMQTTClient(broker, port, username, password)
-    ubidots_client = ubidots(ubidots_token, ubidots_device_id)
+    ubidots_client = ubidots(ubidots_token, ubidots_device_id, flush_interval=UBIDOTS_FLUSH_INTERVAL,
+                             backlog_path=UBIDOTS_BACKLOG)
     if not client:
         logger.error("MQTT Broker not connected")
         raise ValueError("MQTT Broker not connected")
-    logger.info("MQTT client connected")
-
-    # Load YOLO model
-    model_bird = YOLO('Model/yolo11m-birds-detection.pt')
-    logger.info("YOLO model loaded")
-
-    # Start camera
-    cap = cv.VideoCapture(f'http://{camera_ip}:81/stream')
-    if not cap.isOpened():
-        logger.error("Cannot open camera")
-        raise RuntimeError("Cannot open camera")
-    logger.info("Camera stream opened")
-
-    # Start WebSocket background thread
-    thread = threading.Thread(target=start_async_loop, daemon=True)
-    thread.start()
-    logger.info("WebSocket thread started")
-
-    # Wait for queue initialization
-    for _ in range(10):
-        if frame_queue is not None:
-            break
-        time.sleep(0.1)
-    else:
-        logger.error("Failed to initialize frame queue")
-        raise RuntimeError("Failed to initialize frame queue")
+    logger.info("MQTT client started, connecting in the background")
+    return client, ubidots_client
 
+
+def load_model():
+    """
+    Load the detector configured in the environment, shared by all cameras.
+    """
+    model = create_backend(INFERENCE_BACKEND, MODEL_PATH, int8=INFERENCE_INT8, imgsz=INPUT_SIDE, conf=0.5,
+                           batch=INFERENCE_BATCH, classes=[BIRD_CLASS_ID])
+    logger.info(f"YOLO model loaded with {INFERENCE_BACKEND} backend")
+    return model
+
+
+def start_metrics(mqtt_client=None, ubidots_client=None):
+    """
+    :param mqtt_client: Optional MyMQTTClient whose connection state is exported
+    :param ubidots_client: Optional ubidots client whose uploader counters are exported
+    :return: Tuple (MetricsRegistry, MetricsServer or None when disabled)
+    """
+    metrics = MetricsRegistry()
+    if mqtt_client is not None:
+        metrics.add_collector(mqtt_collector(mqtt_client.connection))
+        metrics.add_histogram_collector(mqtt_ack_collector(mqtt_client.connection))
+    if ubidots_client is not None:
+        metrics.add_collector(ubidots_collector(ubidots_client.uploader))
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT)
+        metrics_server.start()
+    return metrics, metrics_server
+
+
+def start_deterrent(client, metrics):
+    """
+    :return: Running DeterrentController publishing through the MQTT client
+    """
+    deterrent = DeterrentController(client, DETERRENT_SPEAKERS, DETERRENT_COOLDOWN, SPEAKER_COOLDOWN,
+                                    DETERRENT_COALESCE, metrics=metrics)
+    deterrent.start()
+
+    def collect():
+        stats = deterrent.stats()
+        return [
+            ("deterrent_triggers_total", "counter", "Deterrent actions requested per field", {}, stats["triggers"]),
+            ("deterrent_coalesced_total", "counter", "Detections merged into another action", {}, stats["coalesced"]),
+            ("deterrent_suppressed_total", "counter", "Actions skipped by the field cooldown", {}, stats["suppressed"]),
+            ("deterrent_published_total", "counter", "Play commands published", {}, stats["published"]),
+            ("deterrent_failed_total", "counter", "Play commands that could not be published", {}, stats["failed"]),
+            ("deterrent_acked_total", "counter", "Play commands acknowledged by the broker", {}, stats["acked"]),
+            ("deterrent_pending_acks", "gauge", "Play commands waiting for the broker", {}, stats["pending_acks"]),
+            ("deterrent_lost_total", "counter", "Play commands dropped or not acknowledged in time", {},
+             stats["lost"]),
+        ]
+    metrics.add_collector(collect)
+    return deterrent
+
+
+def start_clip_writer(metrics):
+    """
+    :return: Running ClipWriter, None when clip recording is disabled
+    """
+    if not RECORD_CLIPS:
+        return None
+    clip_writer = ClipWriter(CLIP_DIR, CLIP_RETENTION_DAYS, CLIP_QUOTA_MB * 1024 * 1024)
+    clip_writer.start()
+    metrics.add_collector(lambda: [
+        ("clips_written_total", "counter", "Event clips saved", {}, clip_writer.clips_written),
+        ("clips_dropped_total", "counter", "Event clips dropped because the writer was busy", {}, clip_writer.clips_dropped),
+        ("clips_evicted_total", "counter", "Event clips removed by retention or disk quota", {}, clip_writer.clips_evicted),
+    ])
+    return clip_writer
+
+
+def create_pipeline(camera, camera_count, deterrent, ubidots_client, camera_metric, recorder):
+    """
+    Start the WebSocket broadcaster (with the MJPEG stream and the optional H.264 output) of a camera and
+    create its output pipeline.
+        :return: CameraPipeline
+    """
+    encoder = None
+    if H264_STREAM:
+        encoder = H264Encoder(os.path.join(HLS_DIR, camera["id"]), H264_BITRATE, H264_FPS, H264_KEYINT,
+                              H264_HEIGHT, H264_SEGMENT)
+        encoder.start()
+    broadcaster = FrameBroadcaster("localhost", camera["ws_port"], metrics=camera_metric, http_host=STREAM_HOST,
+                                   http_port=camera.get("stream_port"),
+                                   hls_dir=encoder.directory if encoder is not None else None)
+    if encoder is not None:
+        broadcaster.add_output(encoder)
+    broadcaster.start()
+    # Keep the original variable label for a single camera setup
+    ubidots_variable = "bird_detected" if camera_count == 1 else f"bird_detected_{camera['id']}"
+    return CameraPipeline(camera["id"], camera["ip"], camera["field"], deterrent,
+                          ubidots_client, broadcaster, ubidots_variable,
+                          annotate=ANNOTATE_FRAMES, show_preview=SHOW_PREVIEW,
+                          metrics=camera_metric, recorder=recorder)
+
+
+def detect(model, items, gates, trackers, last_detections, camera_metrics, motion_gate=MOTION_GATE, tracking=TRACKING):
+    """
+    Detection step shared by the threaded and the multi-process layout and the
+    benchmark: motion gate, tracker and one batched forward pass for the
+    cameras that need it.
+        :param model: InferenceBackend
+        :param items: List of tuples (index, frame, seq, jpeg), the newest frame of each camera
+        :param gates: MotionGate per camera
+        :param trackers: BirdTracker per camera
+        :param last_detections: Detections of the last inferred frame per camera, updated in place
+        :param camera_metrics: CameraMetrics per camera
+        :param motion_gate: Skip the model on static frames
+        :param tracking: Run the model every few frames and track in between
+        :return: List of tuples (index, frame, seq, jpeg, detections, new_track_ids),
+                 new_track_ids is None when tracking is disabled
+    """
+    outputs = []
+    pending = []
+    for index, frame, seq, jpeg in items:
+        # The gate is checked on every frame to keep its background up to date
+        motion = not motion_gate or gates[index].check(frame)
+        if motion and (not tracking or trackers[index].needs_detection()):
+            pending.append((index, frame, seq, jpeg))
+        elif tracking:
+            # Carry the tracked boxes forward without running the model
+            outputs.append((index, frame, seq, jpeg, trackers[index].predict(), []))
+        elif last_detections[index] is not None:
+            # Static scene, reuse the detections of the last inferred frame
+            outputs.append((index, frame, seq, jpeg, last_detections[index], None))
+
+    if pending:
+        # One forward pass for the newest frame of every camera that needs it
+        cpu_start = time.process_time()
+        predict_start = time.perf_counter()
+        results = model.predict([frame for _, frame, _, _ in pending])
+        predict_time = time.perf_counter() - predict_start
+        cpu_per_frame = (time.process_time() - cpu_start) / len(pending)
+        for (index, frame, seq, jpeg), result in zip(pending, results):
+            gates[index].record_inference(cpu_per_frame)
+            camera_metrics[index].observe("predict", predict_time)
+            new_track_ids = None
+            with camera_metrics[index].timer("postprocess"):
+                detections = from_result(result, BIRD_CLASS_ID)
+                last_detections[index] = detections
+                if tracking:
+                    detections, new_track_ids = trackers[index].update(detections)
+            outputs.append((index, frame, seq, jpeg, detections, new_track_ids))
+    return outputs
+
+
+def log_stats(metrics, cameras, gates, pipelines):
+    for line in metrics.summary():
+        logger.info("Pipeline %s", line)
+    for camera, gate, pipeline in zip(cameras, gates, pipelines):
+        if MOTION_GATE and gate is not None:
+            stats = gate.stats()
+            logger.info("Motion gate %s: skipped %d/%d frames (%.1f%%), CPU saved %.1f s",
+                        camera["id"], stats["skipped"], stats["frames"],
+                        stats["skipped_fraction"] * 100, stats["cpu_saved_seconds"])
+        for stats in pipeline.broadcaster.stats():
+            logger.info("WebSocket %s client %s: sent %d, skipped %d, queue age %.1f ms, send latency %.1f ms",
+                        camera["id"], stats["address"], stats["frames_sent"], stats["frames_skipped"],
+                        stats["queue_age_ms"], stats["send_latency_ms"])
+
+
+def main():
+    # Define variables
+    cameras = load_camera_config()
+    check_cameras(cameras)
+    client, ubidots_client = connect_clients()
+    model_bird = load_model()
+    metrics, metrics_server = start_metrics(client, ubidots_client)
+    deterrent = start_deterrent(client, metrics)
+    clip_writer = start_clip_writer(metrics)
+
+    # Start camera capture threads, all mailboxes share one condition
+    # so the inference loop can wait for a frame from any camera
+    frame_cond = threading.Condition()
+    mailboxes = []
+    captures = []
+    pipelines = []
+    gates = []
+    trackers = []
+    camera_metrics = []
+    recorders = []
+    for camera in cameras:
+        camera_metric = metrics.camera(camera["id"])
+        mailbox = LatestFrameMailbox(frame_cond)
+        recorder = None
+        if clip_writer is not None:
+            recorder = ClipRecorder(camera["id"], clip_writer, CLIP_PRE_ROLL, CLIP_POST_ROLL)
+            recorders.append(recorder)
+        capture = CaptureThread(create_source(camera), mailbox, name=f"capture-{camera['id']}", metrics=camera_metric,
+                                recorder=recorder)
+        if not capture.open():
+            logger.error(f"Cannot open camera {camera['id']}")
+            raise RuntimeError("Cannot open camera")
+        capture.start()
+        logger.info(f"Camera stream {camera['id']} opened")
+
+        pipeline = create_pipeline(camera, len(cameras), deterrent, ubidots_client, camera_metric, recorder)
+        gate = MotionGate(MOTION_THRESHOLD, MOTION_KEYFRAME_INTERVAL)
+        mailboxes.append(mailbox)
+        captures.append(capture)
+        gates.append(gate)
+        camera_metrics.append(camera_metric)
+        trackers.append(BirdTracker(DETECT_INTERVAL, min_confidence=TRACK_MIN_CONFIDENCE))
+        pipelines.append(pipeline)
+        metrics.add_collector(camera_collector(camera["id"], capture, mailbox, gate, pipeline.broadcaster, recorder))
+
+    last_detections = [None] * len(cameras)
+    last_stats_log = time.time()
     try:
         while True:
-            start_time = time.time()
-            ret, frame = cap.read()
-            if not ret or frame is None or not isinstance(frame, np.ndarray) or frame.size == 0:
-                logger.warning("Invalid frame from camera, attempting to reconnect")
-                cap.release()
-                cap = cv.VideoCapture(f'http://{camera_ip}:81/stream')
-                if not cap.isOpened():
-                    logger.error("Cannot reopen camera, exiting")
+            batch = get_latest_frames(mailboxes, frame_cond, timeout=5)
+            if not batch:
+                if not any(capture.is_alive() for capture in captures):
+                    logger.error("All capture threads stopped, exiting")
                     break
-                time.sleep(0.2)
+                logger.warning("No frame received from any camera in the last 5 seconds")
                 continue
 
-            frame = cv.resize(frame, (640, 640))
-            results = model_bird.predict(source=frame, conf=0.5, show=False, save=False, stream=True)
-            detected = False
-            for result in results:
-                for box in result.boxes:
-                    if int(box.cls[0]) == 14:
-                        detected = True
-                        x1, y1, x2, y2 = map(int, box.xyxy[0])
-                        conf = box.conf[0]
-                        cls = int(box.cls[0])
-                        # Validate class name
-                        class_name = model_bird.names.get(cls, "Unknown")
-                        if not isinstance(class_name, str):
-                            logger.warning(f"Invalid class name for cls={cls}: {class_name}")
-                            class_name = "Unknown"
-                        label = f"{class_name} {conf:.2f}"
-                        client.publish_play_sound()
-                        cv.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                        try:
-                            cv.putText(frame, label, (x1, y1 - 10), cv.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-                        except Exception as e:
-                            logger.error(f"Error in cv.putText: {e}")
-
-            send_detection_to_ubidots(ubidots_client, detected)
-
-            # Remove cv.imshow since Streamlit is the primary display
-            cv.imshow('YOLO Detection', frame)
-            cv.waitKey(1)
-
-            if frame_queue is not None:
-                try:
-                    frame_queue.sync_q.put_nowait(frame)
-                except janus.SyncQueueFull:
-                    logger.debug("Frame queue full, dropping frame")
-                    pass
-
-            
-            time.sleep(0.033)  # Approx 30 FPS
+            items = []
+            for index, captured, seq, dropped in batch:
+                if dropped:
+                    logger.debug("Camera %s dropped %d stale frames before frame %d", cameras[index]["id"], dropped, seq)
+                # Already decoded at reduced scale, usually no resize is left to do
+                with camera_metrics[index].timer("resize"):
+                    frame = fit_to_input(captured.image, INPUT_SIDE)
+                items.append((index, frame, seq, captured.jpeg))
+
+            for index, frame, seq, jpeg, detections, new_track_ids in detect(model_bird, items, gates, trackers,
+                                                                              last_detections, camera_metrics):
+                pipelines[index].handle(frame, detections, model_bird.names, new_track_ids, seq, jpeg)
+
+            if STATS_LOG_INTERVAL and time.time() - last_stats_log >= STATS_LOG_INTERVAL:
+                last_stats_log = time.time()
+                log_stats(metrics, cameras, gates, pipelines)
+
+            if SHOW_PREVIEW:
+                cv.waitKey(1)
 
     except KeyboardInterrupt:
         logger.info("Program interrupted by user")
     except Exception as e:
         logger.error(f"Main loop error: {e}")
     finally:
-        cap.release()
+        for capture, mailbox in zip(captures, mailboxes):
+            capture.stop()
+            capture.join(timeout=2)
+            logger.info("%s frames read: %d, dropped before inference: %d", capture.name, capture.frames_read, mailbox.dropped)
         # cv.destroyAllWindows()  # Removed since no cv.imshow
-        if frame_queue is not None:
-            frame_queue.close()
+        if clip_writer is not None:
+            for recorder in recorders:
+                recorder.flush()
+            clip_writer.stop()
+            clip_writer.join(timeout=10)
+        for pipeline in pipelines:
+            pipeline.broadcaster.close()
+        deterrent.stop()
+        client.close()
+        ubidots_client.close()
+        if metrics_server is not None:
+            metrics_server.close()
         logger.info("Resources cleaned up")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,287 @@
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from common.histograms import bucket_quantile
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "birddetection"
+
+# Upper bounds of the latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Stages of a frame, in pipeline order:
+#   read         waiting for and reading the JPEG from the camera
+#   decode       JPEG decode (MJPEG reader only, VideoCapture decodes inside read)
+#   resize       scaling the decoded frame to the model input
+#   predict      model forward pass (batch time, recorded for every frame of the batch)
+#   postprocess  conversion of the result and tracker update
+#   notify       queuing the deterrent and Ubidots events
+#   annotate     drawing the overlays and the local preview
+#   encode       JPEG encode in the broadcaster (skipped for pass-through frames)
+#   queue        time a frame waited in a viewer's slot
+#   send         WebSocket send to one viewer
+# and of the deterrent, measured from the detection:
+#   publish      until the play command was handed to MQTT
+#   ack          until the broker acknowledged the play command
+STAGES = ("read", "decode", "resize", "predict", "postprocess", "notify", "annotate", "encode", "queue", "send",
+          "publish", "ack")
+
+
+class Histogram:
+    """
+    Thread-safe latency histogram with fixed buckets, like a Prometheus histogram.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last slot counts the values above the largest bucket (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        :return: Tuple (per-bucket counts, sum, count)
+        """
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class CameraMetrics:
+    """
+    Metrics handle of one camera, passed to the capture thread, the pipeline and the broadcaster.
+    """
+    def __init__(self, registry, camera_id):
+        self.registry = registry
+        self.camera_id = camera_id
+        self.frames = 0
+        self.fps = 0.0
+        self._fps_frames = 0
+        self._fps_start = time.time()
+
+    def observe(self, stage, seconds):
+        self.registry.observe(self.camera_id, stage, seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def frame_done(self):
+        """
+        Count a frame that went through the whole pipeline and update the FPS estimate.
+        """
+        self.frames += 1
+        self._fps_frames += 1
+        now = time.time()
+        elapsed = now - self._fps_start
+        if elapsed >= 1.0:
+            self.fps = self._fps_frames / elapsed
+            self._fps_frames = 0
+            self._fps_start = now
+
+
+class MetricsRegistry:
+    """
+    Collects the stage histograms of all cameras and renders them, together
+    with the values of the registered collectors, in Prometheus text format.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.cameras = {}
+        self.collectors = []
+        self.histogram_collectors = []
+        self._lock = threading.Lock()
+        self._last_summary = {}
+        self._last_summary_time = time.time()
+
+    def camera(self, camera_id):
+        """
+        :return: CameraMetrics of the camera, created on first use
+        """
+        with self._lock:
+            if camera_id not in self.cameras:
+                self.cameras[camera_id] = CameraMetrics(self, camera_id)
+            return self.cameras[camera_id]
+
+    def observe(self, camera_id, stage, seconds):
+        key = (camera_id, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram(self.buckets))
+        histogram.observe(seconds)
+
+    def add_collector(self, collector):
+        """
+        Register a function that is called on every scrape.
+            :param collector: Callable returning a list of tuples (name, type, help, labels, value),
+                              type is "counter" or "gauge"
+        """
+        self.collectors.append(collector)
+
+    def add_histogram_collector(self, collector):
+        """
+        Register a function returning histograms that are kept elsewhere, called on every scrape.
+            :param collector: Callable returning a list of tuples (name, help, labels, buckets, counts, sum, count),
+                              counts has one more entry than buckets for +Inf
+        """
+        self.histogram_collectors.append(collector)
+
+    def render(self):
+        """
+        :return: All metrics in Prometheus text exposition format
+        """
+        lines = []
+        name = f"{METRIC_PREFIX}_stage_seconds"
+        lines.append(f"# HELP {name} Latency of each pipeline stage per frame")
+        lines.append(f"# TYPE {name} histogram")
+        # observe() adds histograms from the pipeline threads while a scrape runs
+        with self._lock:
+            stage_histograms = list(self.histograms.items())
+        for (camera_id, stage), histogram in sorted(stage_histograms):
+            counts, total, count = histogram.snapshot()
+            labels = f'camera="{camera_id}",stage="{stage}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+
+        histograms = {}
+        for collector in self.histogram_collectors:
+            try:
+                for metric, help_text, labels, buckets, counts, total, count in collector():
+                    histograms.setdefault(metric, (help_text, []))[1].append((labels, buckets, counts, total, count))
+            except Exception as e:
+                logger.error(f"Metrics histogram collector failed: {e}")
+        for metric, (help_text, values) in histograms.items():
+            name = f"{METRIC_PREFIX}_{metric}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, buckets, counts, total, count in values:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                cumulative = 0
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{label_text},le="+Inf"}} {count}')
+                lines.append(f"{name}_sum{{{label_text}}} {total:.6f}")
+                lines.append(f"{name}_count{{{label_text}}} {count}")
+
+        samples = []
+        for camera_id, camera in list(self.cameras.items()):
+            samples.append(("frames_processed_total", "counter", "Frames that went through the whole pipeline",
+                            {"camera": camera_id}, camera.frames))
+            samples.append(("fps", "gauge", "Processed frames per second", {"camera": camera_id}, round(camera.fps, 2)))
+        for collector in self.collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+
+        # Group the samples of a metric under one HELP/TYPE header
+        families = {}
+        for metric, kind, help_text, labels, value in samples:
+            families.setdefault(metric, (kind, help_text, []))[2].append((labels, value))
+        for metric, (kind, help_text, values) in families.items():
+            name = f"{METRIC_PREFIX}_{metric}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in values:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Summary of the interval since the previous call: FPS and p50/p95 of every stage per camera.
+            :return: List of log lines
+        """
+        now = time.time()
+        elapsed = max(now - self._last_summary_time, 1e-9)
+        self._last_summary_time = now
+        lines = []
+        for camera_id, camera in sorted(self.cameras.items()):
+            previous_frames = self._last_summary.get((camera_id, None), 0)
+            self._last_summary[(camera_id, None)] = camera.frames
+            parts = []
+            for stage in STAGES:
+                histogram = self.histograms.get((camera_id, stage))
+                if histogram is None:
+                    continue
+                counts, _, _ = histogram.snapshot()
+                previous = self._last_summary.get((camera_id, stage), [0] * len(counts))
+                self._last_summary[(camera_id, stage)] = counts
+                window = [c - p for c, p in zip(counts, previous)]
+                p50 = bucket_quantile(self.buckets, window, 0.5)
+                if p50 is None:
+                    continue
+                p95 = bucket_quantile(self.buckets, window, 0.95)
+                parts.append(f"{stage} {p50 * 1000:.1f}/{p95 * 1000:.1f}")
+            lines.append(f"{camera_id}: {(camera.frames - previous_frames) / elapsed:.1f} FPS, "
+                         f"p50/p95 ms: {', '.join(parts) or 'no data'}")
+        return lines
+
+
+class MetricsServer:
+    """
+    Small HTTP server in a background thread that serves the registry at /metrics.
+    """
+    def __init__(self, registry, host="localhost", port=9108):
+        """
+        :param registry: MetricsRegistry to expose
+        :param host: Host to bind the HTTP server
+        :param port: Port to bind the HTTP server
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format, *args)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name="metrics")
+        self.thread.start()
+        logger.info(f"Metrics endpoint started on http://{self.host}:{self.port}/metrics")
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
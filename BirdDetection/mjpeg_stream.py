@@ -0,0 +1,258 @@
+import time
+import logging
+from collections import namedtuple
+from urllib.request import urlopen, Request
+import numpy as np
+import cv2 as cv
+
+logger = logging.getLogger(__name__)
+
+# Frame from a source: decoded BGR image (reduced scale), the original JPEG
+# bytes when available (None otherwise) and the receive time (epoch seconds)
+Frame = namedtuple("Frame", ["image", "jpeg", "timestamp"])
+
+# Boundary used by stream_handler in ESP32AIThinkerCamera/app_httpd.cpp
+ESP32_BOUNDARY = b"123456789000000000000987654321"
+
+REDUCED_FLAGS = ((8, cv.IMREAD_REDUCED_COLOR_8), (4, cv.IMREAD_REDUCED_COLOR_4), (2, cv.IMREAD_REDUCED_COLOR_2))
+
+# Content type of the stream, as sent by stream_handler
+STREAM_CONTENT_TYPE = "multipart/x-mixed-replace;boundary=" + ESP32_BOUNDARY.decode()
+
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(jpeg):
+    """
+    Read the image size from the SOF header without decoding the JPEG.
+        :param jpeg: JPEG bytes
+        :return: Tuple (width, height), None if no SOF header is found
+    """
+    i = 2
+    n = len(jpeg)
+    while i + 9 < n:
+        if jpeg[i] != 0xFF:
+            i += 1
+            continue
+        marker = jpeg[i + 1]
+        if marker in SOF_MARKERS:
+            height = int.from_bytes(jpeg[i + 5:i + 7], "big")
+            width = int.from_bytes(jpeg[i + 7:i + 9], "big")
+            return width, height
+        if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 1 if marker == 0xFF else 2
+            continue
+        i += 2 + int.from_bytes(jpeg[i + 2:i + 4], "big")
+    return None
+
+
+def decode_reduced(jpeg, input_side=640):
+    """
+    Decode a JPEG directly at the smallest DCT scale (1/2, 1/4, 1/8) whose
+    long side still covers the inference input, e.g. SXGA (1280x1024) is decoded at 640x512.
+        :param jpeg: JPEG bytes
+        :param input_side: Long side of the inference input
+        :return: BGR image, None if the JPEG cannot be decoded
+    """
+    flag = cv.IMREAD_COLOR
+    size = jpeg_size(jpeg)
+    if size is not None:
+        for factor, reduced_flag in REDUCED_FLAGS:
+            if max(size) // factor >= input_side:
+                flag = reduced_flag
+                break
+    return cv.imdecode(np.frombuffer(jpeg, dtype=np.uint8), flag)
+
+
+def fit_to_input(image, input_side=640):
+    """
+    Scale an image so its long side equals the inference input, keeping the
+    aspect ratio; the model letterboxes it to a square input itself.
+        :param image: BGR image
+        :param input_side: Long side of the inference input
+        :return: BGR image
+    """
+    height, width = image.shape[:2]
+    if max(height, width) == input_side:
+        return image
+    scale = input_side / max(height, width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv.resize(image, size, interpolation=cv.INTER_AREA if scale < 1 else cv.INTER_LINEAR)
+
+
+def is_jpeg(data):
+    """
+    Cheap validity check on the SOI/EOI markers.
+    """
+    return len(data) > 4 and data[:2] == b"\xff\xd8" and data[-2:] == b"\xff\xd9"
+
+
+def multipart_part(jpeg, timestamp, boundary=ESP32_BOUNDARY):
+    """
+    Boundary and part headers of one JPEG in the exact format of the
+    ESP32-CAM stream_handler, the JPEG bytes follow them unchanged.
+        :param jpeg: JPEG bytes (only the length is used)
+        :param timestamp: Capture time in seconds, sent as X-Timestamp
+        :param boundary: Multipart boundary
+        :return: Bytes to write before the JPEG
+    """
+    seconds = int(timestamp)
+    micros = int((timestamp - seconds) * 1000000)
+    return (b"\r\n--" + boundary + b"\r\n"
+            b"Content-Type: image/jpeg\r\n"
+            b"Content-Length: %d\r\n"
+            b"X-Timestamp: %d.%06d\r\n\r\n" % (len(jpeg), seconds, micros))
+
+
+def iter_jpegs(stream, chunk_size=64 * 1024):
+    """
+    Split a recorded MJPEG file into its JPEG images. Works for raw
+    concatenated JPEGs as well as for a saved multipart stream.
+        :param stream: Binary file object
+        :param chunk_size: Read size in bytes
+        :return: Generator of JPEG bytes
+    """
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+        while True:
+            start = buffer.find(b"\xff\xd8")
+            if start < 0:
+                # Keep the last byte, it may be the first half of a marker
+                del buffer[:-1]
+                break
+            end = buffer.find(b"\xff\xd9", start + 2)
+            if end < 0:
+                del buffer[:start]
+                break
+            yield bytes(buffer[start:end + 2])
+            del buffer[:end + 2]
+
+
+class MjpegStreamReader:
+    """
+    Reader for the multipart/x-mixed-replace stream of the ESP32-CAM. It keeps
+    the raw JPEG bytes of every part, so they can be passed through to viewers
+    without re-encoding, and decodes them at reduced scale for inference.
+    The reader reconnects its HTTP connection itself when the stream breaks.
+    """
+    def __init__(self, url, input_side=640, timeout=5, max_part_size=2 * 1024 * 1024):
+        """
+        :param url: URL of the MJPEG stream, e.g. http://<ip>:81/stream
+        :param input_side: Long side of the inference input the frames are decoded for
+        :param timeout: Socket timeout for connecting and reading in seconds
+        :param max_part_size: Parts larger than this are treated as a broken stream
+        """
+        self.url = url
+        self.input_side = input_side
+        self.timeout = timeout
+        self.max_part_size = max_part_size
+        self.boundary = ESP32_BOUNDARY
+        self.response = None
+        self.reconnects = 0
+        self.last_decode_time = 0.0
+
+    @property
+    def is_open(self):
+        return self.response is not None
+
+    def open(self):
+        """
+        Open (or reopen) the HTTP connection to the stream.
+            :return: True if the stream is opened
+        """
+        self.close()
+        try:
+            request = Request(self.url, method='GET')
+            request.add_header('Accept', 'multipart/x-mixed-replace')
+            response = urlopen(request, timeout=self.timeout)
+            content_type = response.headers.get("Content-Type", "")
+            if "multipart" not in content_type:
+                response.close()
+                logger.error("Unexpected content type from %s: %s", self.url, content_type)
+                return False
+            if "boundary=" in content_type:
+                self.boundary = content_type.split("boundary=", 1)[1].split(";")[0].strip().strip('"').encode()
+            self.response = response
+            self.reconnects += 1
+            return True
+        except Exception as e:
+            logger.warning("Cannot open MJPEG stream %s: %s", self.url, e)
+            return False
+
+    def close(self):
+        if self.response is not None:
+            try:
+                self.response.close()
+            except Exception:
+                pass
+            self.response = None
+
+    def read_jpeg(self):
+        """
+        Read the next JPEG part from the stream.
+            :return: JPEG bytes
+        """
+        delimiter = b"--" + self.boundary
+        # Skip to the boundary line
+        while True:
+            line = self.response.readline(1024)
+            if not line:
+                raise EOFError("MJPEG stream closed")
+            if line.strip() == delimiter:
+                break
+        # Part headers
+        length = None
+        while True:
+            line = self.response.readline(1024)
+            if not line:
+                raise EOFError("MJPEG stream closed")
+            line = line.strip()
+            if not line:
+                break
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value.strip())
+        if length is not None:
+            if length > self.max_part_size:
+                raise ValueError(f"MJPEG part too large: {length} bytes")
+            data = self.response.read(length)
+            if len(data) != length:
+                raise EOFError("MJPEG stream closed inside a part")
+            return data
+        # No Content-Length, read until the end of image marker
+        data = bytearray()
+        while not data.endswith(b"\xff\xd9"):
+            chunk = self.response.read(1)
+            if not chunk:
+                raise EOFError("MJPEG stream closed inside a part")
+            data += chunk
+            if len(data) > self.max_part_size:
+                raise ValueError("MJPEG part without end of image marker")
+        return bytes(data)
+
+    def read(self):
+        """
+        Read and decode the next frame. On a broken stream the connection is
+        closed and None is returned; call open() again to reconnect.
+            :return: Frame, None if no valid frame could be read
+        """
+        if self.response is None:
+            return None
+        try:
+            jpeg = self.read_jpeg()
+        except Exception as e:
+            logger.warning("MJPEG stream %s broken: %s", self.url, e)
+            self.close()
+            return None
+        timestamp = time.time()
+        if not is_jpeg(jpeg):
+            logger.debug("Skipping invalid JPEG part of %d bytes", len(jpeg))
+            return Frame(None, None, timestamp)
+        start = time.perf_counter()
+        image = decode_reduced(jpeg, self.input_side)
+        self.last_decode_time = time.perf_counter() - start
+        return Frame(image, jpeg, timestamp)
@@ -0,0 +1,87 @@
+import logging
+import numpy as np
+import cv2 as cv
+
+logger = logging.getLogger(__name__)
+
+
+class MotionGate:
+    """
+    Cheap pre-filter in front of the YOLO model. Each frame is downscaled to a
+    small grayscale image and compared with a running-average background; the
+    model only runs when enough pixels changed or when a periodic keyframe is due.
+    """
+    def __init__(self, threshold=0.005, keyframe_interval=30, width=160, pixel_threshold=25, learning_rate=0.05):
+        """
+        :param threshold: Fraction of changed pixels (0-1) needed to run the model
+        :param keyframe_interval: Run the model at least once every this many frames
+        :param width: Width of the downscaled frame used for differencing
+        :param pixel_threshold: Minimum gray level difference for a pixel to count as changed
+        :param learning_rate: Update rate of the running-average background
+        """
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.learning_rate = learning_rate
+        self._background = None
+        self.frames_since_inference = 0
+        self.last_motion = 0.0
+        self.frames = 0
+        self.skipped = 0
+        self.inferences = 0
+        self.inference_cpu_time = 0.0
+
+    def _prepare(self, frame):
+        height = max(1, int(frame.shape[0] * self.width / frame.shape[1]))
+        small = cv.resize(frame, (self.width, height), interpolation=cv.INTER_AREA)
+        gray = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        return cv.GaussianBlur(gray, (5, 5), 0)
+
+    def check(self, frame):
+        """
+        Decide whether the model has to run on this frame.
+            :param frame: Frame from the camera (BGR numpy array)
+            :return: True if the model should run, False if the frame can be skipped
+        """
+        self.frames += 1
+        gray = self._prepare(frame)
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray.astype(np.float32)
+            self.last_motion = 1.0
+        else:
+            diff = cv.absdiff(gray, cv.convertScaleAbs(self._background))
+            self.last_motion = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+            cv.accumulateWeighted(gray, self._background, self.learning_rate)
+
+        keyframe_due = self.frames_since_inference + 1 >= self.keyframe_interval
+        if self.last_motion >= self.threshold or keyframe_due:
+            self.frames_since_inference = 0
+            return True
+        self.frames_since_inference += 1
+        self.skipped += 1
+        return False
+
+    def record_inference(self, cpu_time):
+        """
+        Record the CPU time of one model invocation, used to estimate the CPU time saved.
+        Frames passed by the gate but served by the tracker are not invocations, so the
+        average is taken over the recorded calls and not over frames - skipped.
+            :param cpu_time: CPU seconds spent on the frame
+        """
+        self.inferences += 1
+        self.inference_cpu_time += cpu_time
+
+    def stats(self):
+        """
+        :return: Dictionary with frames seen, frames skipped, model invocations, skipped fraction and estimated CPU seconds saved
+        """
+        avg_cpu = self.inference_cpu_time / self.inferences if self.inferences else 0.0
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "inferences": self.inferences,
+            "skipped_fraction": self.skipped / self.frames if self.frames else 0.0,
+            "cpu_saved_seconds": self.skipped * avg_cpu,
+            "last_motion": self.last_motion,
+        }
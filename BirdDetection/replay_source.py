@@ -0,0 +1,157 @@
+import os
+import glob
+import time
+import logging
+import cv2 as cv
+from mjpeg_stream import Frame, decode_reduced, iter_jpegs, is_jpeg
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+MJPEG_EXTENSIONS = (".mjpeg", ".mjpg")
+
+
+def iter_recording(path):
+    """
+    Iterate over the frames of a recording.
+        :param path: Recorded MJPEG file, video file or image directory
+        :return: Generator of tuples (jpeg, image); JPEG recordings yield the
+                 undecoded bytes and image None, other recordings image only
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path):
+        paths = sorted(p for p in glob.glob(os.path.join(path, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+        for image_path in paths:
+            if image_path.lower().endswith((".jpg", ".jpeg")):
+                with open(image_path, "rb") as f:
+                    yield f.read(), None
+            else:
+                yield None, cv.imread(image_path)
+    elif ext in MJPEG_EXTENSIONS:
+        with open(path, "rb") as f:
+            for jpeg in iter_jpegs(f):
+                yield jpeg, None
+    else:
+        cap = cv.VideoCapture(path)
+        try:
+            while True:
+                ret, image = cap.read()
+                if not ret:
+                    break
+                yield None, image
+        finally:
+            cap.release()
+
+
+def recording_fps(path):
+    """
+    :return: Frame rate stored in a video file, None for other recordings
+    """
+    if os.path.isdir(path) or os.path.splitext(path)[1].lower() in MJPEG_EXTENSIONS:
+        return None
+    cap = cv.VideoCapture(path)
+    fps = cap.get(cv.CAP_PROP_FPS)
+    cap.release()
+    return fps or None
+
+
+class ReplaySource:
+    """
+    Frame source that replays a recording instead of a live ESP32-CAM, with
+    the same interface as MjpegStreamReader. It accepts a recorded MJPEG
+    stream, a video file or a directory of images. In real-time mode the
+    frames are paced at the recording frame rate and, like a live camera,
+    frames are skipped when the reader falls behind; otherwise frames are
+    returned as fast as they are read.
+    """
+    def __init__(self, path, input_side=640, fps=None, realtime=True, loop=False):
+        """
+        :param path: MJPEG file, video file or image directory
+        :param input_side: Long side of the inference input the JPEGs are decoded for
+        :param fps: Replay frame rate, defaults to the video frame rate or 25
+        :param realtime: Pace the frames at the frame rate, False replays as fast as possible
+        :param loop: Start again at the end of the recording
+        """
+        self.url = path
+        self.input_side = input_side
+        self.fps = fps
+        self.realtime = realtime
+        self.loop = loop
+        self.finished = False
+        self.reconnects = 0
+        self.skipped = 0
+        self.last_decode_time = 0.0
+        self._frames = None
+        self._start = 0.0
+        self._index = 0
+
+    @property
+    def is_open(self):
+        return self._frames is not None
+
+    def open(self):
+        """
+        Start (or restart) the replay.
+            :return: True if the recording can be read
+        """
+        self.close()
+        if self.finished:
+            return False
+        if not os.path.exists(self.url):
+            logger.error("Replay source %s not found", self.url)
+            return False
+        if self.fps is None:
+            self.fps = recording_fps(self.url)
+        self._frames = iter_recording(self.url)
+        self._start = time.time()
+        self._index = 0
+        self.reconnects += 1
+        return True
+
+    def close(self):
+        if self._frames is not None:
+            self._frames.close()
+            self._frames = None
+
+    def _next(self):
+        item = next(self._frames, None)
+        if item is None and self.loop:
+            self.open()
+            item = next(self._frames, None)
+        return item
+
+    def read(self):
+        """
+        Read the next frame of the recording. At the end of the recording the
+        source is closed and None is returned; without loop it cannot be reopened.
+            :return: Frame, None at the end of the recording
+        """
+        if self._frames is None:
+            return None
+        item = self._next()
+        if self.realtime:
+            interval = 1.0 / (self.fps or 25)
+            due = self._start + self._index * interval
+            # Behind schedule: skip frames like a live camera would
+            while item is not None and time.time() - due > interval:
+                self.skipped += 1
+                self._index += 1
+                due += interval
+                item = self._next()
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        if item is None:
+            self.finished = not self.loop
+            self.close()
+            return None
+        self._index += 1
+        jpeg, image = item
+        timestamp = time.time()
+        if jpeg is not None:
+            if not is_jpeg(jpeg):
+                return Frame(None, None, timestamp)
+            start = time.perf_counter()
+            image = decode_reduced(jpeg, self.input_side)
+            self.last_decode_time = time.perf_counter() - start
+        return Frame(image, jpeg, timestamp)
@@ -0,0 +1,140 @@
+import struct
+import logging
+from collections import namedtuple
+import numpy as np
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+# Ring header: sequence number of the newest complete frame, then the layout
+# (slots, max image bytes, max JPEG bytes) so readers attach without configuration
+RING_HEADER = struct.Struct("<QIII")
+# Slot header: seq, capture timestamp, read time, decode time, height, width, channels, JPEG length
+SLOT_HEADER = struct.Struct("<QdddIIII")
+# Slots start on cache-line boundaries
+ALIGN = 64
+
+SharedFrame = namedtuple("SharedFrame", ["seq", "image", "jpeg", "timestamp", "read_time", "decode_time"])
+
+
+def _aligned(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+class SharedFrameRing:
+    """
+    Ring buffer of frames in shared memory between one writer process (the
+    camera capture) and any number of reader processes. Every slot holds the
+    decoded frame, the original JPEG and a sequence number; frames are copied
+    into the slot instead of being pickled.
+
+    Each slot is protected like a seqlock. The writer zeroes the slot's
+    sequence number before writing and sets it when the frame is complete.
+    A reader checks that number before and after copying, and drops the
+    copy if the writer was inside the slot.
+    """
+    def __init__(self, name, slots=4, max_image_bytes=640 * 640 * 3, max_jpeg_bytes=1024 * 1024, create=False):
+        """
+        :param name: Name of the shared memory block
+        :param slots: Number of frames kept, readers can fetch any of the last slots frames by seq
+        :param max_image_bytes: Maximum size of a decoded frame
+        :param max_jpeg_bytes: Maximum size of a JPEG, larger JPEGs are not stored
+        :param create: Create the block (supervisor), otherwise attach to it (workers)
+                       and take the layout from the ring header
+        """
+        self.name = name
+        if create:
+            self._set_layout(slots, max_image_bytes, max_jpeg_bytes)
+            size = _aligned(RING_HEADER.size) + slots * self.slot_size
+            try:
+                # Left over from a crashed run
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            RING_HEADER.pack_into(self.shm.buf, 0, 0, slots, max_image_bytes, max_jpeg_bytes)
+            for slot in range(slots):
+                SLOT_HEADER.pack_into(self.shm.buf, self._offset(slot), 0, 0.0, 0.0, 0.0, 0, 0, 0, 0)
+        else:
+            # The workers are children of the supervisor and share its resource
+            # tracker, so the block is only unlinked by the supervisor
+            self.shm = shared_memory.SharedMemory(name=name)
+            self._set_layout(*RING_HEADER.unpack_from(self.shm.buf, 0)[1:])
+        self.owner = create
+
+    def _set_layout(self, slots, max_image_bytes, max_jpeg_bytes):
+        self.slots = slots
+        self.max_image_bytes = max_image_bytes
+        self.max_jpeg_bytes = max_jpeg_bytes
+        self.slot_size = _aligned(SLOT_HEADER.size + max_image_bytes + max_jpeg_bytes)
+
+    def _offset(self, slot):
+        return _aligned(RING_HEADER.size) + slot * self.slot_size
+
+    def latest_seq(self):
+        return struct.unpack_from("<Q", self.shm.buf, 0)[0]
+
+    def write(self, image, jpeg=None, timestamp=0.0, read_time=0.0, decode_time=0.0):
+        """
+        Write a frame into the next slot. Only one process may write a ring.
+            :param image: Decoded frame (uint8 numpy array)
+            :param jpeg: Original JPEG bytes, None if not available
+            :param timestamp: Capture time of the frame
+            :param read_time: Seconds spent reading the frame
+            :param decode_time: Seconds spent decoding the frame
+            :return: Sequence number of the frame
+        """
+        if image.nbytes > self.max_image_bytes:
+            raise ValueError(f"Frame of {image.nbytes} bytes does not fit the shared ring ({self.max_image_bytes})")
+        seq = self.latest_seq() + 1
+        offset = self._offset(seq % self.slots)
+        buf = self.shm.buf
+        # Mark the slot as being written
+        struct.pack_into("<Q", buf, offset, 0)
+        data = offset + SLOT_HEADER.size
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim == 3 else 1
+        np.ndarray(image.shape, dtype=np.uint8, buffer=buf, offset=data)[...] = image
+        jpeg_len = 0
+        if jpeg is not None and len(jpeg) <= self.max_jpeg_bytes:
+            jpeg_len = len(jpeg)
+            buf[data + self.max_image_bytes:data + self.max_image_bytes + jpeg_len] = jpeg
+        SLOT_HEADER.pack_into(buf, offset, seq, timestamp, read_time, decode_time, height, width, channels, jpeg_len)
+        struct.pack_into("<Q", buf, 0, seq)
+        return seq
+
+    def read(self, seq=None, with_image=True):
+        """
+        Copy a frame out of the ring.
+            :param seq: Sequence number of the frame, None for the newest frame
+            :param with_image: Also copy the decoded frame, otherwise image is None
+            :return: SharedFrame, None if the frame was overwritten or is being written
+        """
+        if seq is None:
+            seq = self.latest_seq()
+        if seq == 0:
+            return None
+        offset = self._offset(seq % self.slots)
+        buf = self.shm.buf
+        header = SLOT_HEADER.unpack_from(buf, offset)
+        if header[0] != seq:
+            return None
+        _, timestamp, read_time, decode_time, height, width, channels, jpeg_len = header
+        data = offset + SLOT_HEADER.size
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        image = np.ndarray(shape, dtype=np.uint8, buffer=buf, offset=data).copy() if with_image else None
+        jpeg = bytes(buf[data + self.max_image_bytes:data + self.max_image_bytes + jpeg_len]) if jpeg_len else None
+        # The writer reused the slot while we were copying
+        if struct.unpack_from("<Q", buf, offset)[0] != seq:
+            return None
+        return SharedFrame(seq, image, jpeg, timestamp, read_time, decode_time)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,385 @@
+"""
+Multi-process layout of the detector, one entry point for the whole edge box:
+
+    python supervisor.py
+
+- one capture process per camera: reads the stream, decodes and resizes the frames
+  and writes them into a shared-memory ring buffer (SharedFrameRing);
+- one inference process: motion gate, tracker and the model over the newest
+  frame of every ring, sends the (small) detection results to the output process;
+- one output process: deterrent, Ubidots, WebSocket broadcasters, clip recorder
+  and metrics, reading the frames from the same rings.
+
+Frames never go through pickling, only their sequence numbers do. The
+supervisor restarts a crashed process with backoff. The configuration is the
+same as for main.py, which keeps the single-process threaded layout.
+"""
+import os
+import sys
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing as mp
+import cv2 as cv
+from main import (INPUT_SIDE, MOTION_THRESHOLD, MOTION_KEYFRAME_INTERVAL, DETECT_INTERVAL, TRACK_MIN_CONFIDENCE,
+                  CLIP_PRE_ROLL, CLIP_POST_ROLL, SHOW_PREVIEW, STATS_LOG_INTERVAL,
+                  load_camera_config, check_cameras, create_source, connect_clients, load_model, start_metrics,
+                  start_deterrent, start_clip_writer, create_pipeline, detect, log_stats)
+from frame_capture import CaptureThread
+from mjpeg_stream import fit_to_input
+from shared_frames import SharedFrameRing
+from motion_gate import MotionGate
+from tracker import BirdTracker
+from metrics import CameraMetrics
+from clip_recorder import ClipRecorder
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FRAME_RING_SLOTS = int(os.environ.get("FRAME_RING_SLOTS", 8))
+RESULT_QUEUE_SIZE = 64
+MAX_RESTART_DELAY = 30
+# A process that ran this long before exiting is restarted with the shortest delay again
+STABLE_UPTIME = 60
+
+
+def worker_setup():
+    # Ctrl+C reaches the whole process group, only the supervisor handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+
+
+class RingMailbox:
+    """
+    Takes the place of LatestFrameMailbox in a capture process: resizes the
+    frame to the model input, writes it into the shared ring and wakes the
+    consumer processes. It also collects the read and decode times that
+    CaptureThread reports, they are stored with the frame.
+    """
+    def __init__(self, ring, events, input_side=640):
+        self.ring = ring
+        self.events = events
+        self.input_side = input_side
+        self.read_time = 0.0
+        self.decode_time = 0.0
+
+    def observe(self, stage, seconds):
+        if stage == "read":
+            self.read_time = seconds
+            self.decode_time = 0.0
+        elif stage == "decode":
+            self.decode_time = seconds
+
+    def put(self, frame):
+        image = fit_to_input(frame.image, self.input_side)
+        self.ring.write(image, frame.jpeg, frame.timestamp, self.read_time, self.decode_time)
+        for event in self.events:
+            event.set()
+
+
+class ForwardedMetrics(CameraMetrics):
+    """
+    Stage timings of the inference process, sent to the output process with each result.
+    """
+    def __init__(self):
+        super().__init__(None, None)
+        self.times = {}
+
+    def observe(self, stage, seconds):
+        self.times[stage] = seconds
+
+    def pop_times(self):
+        times, self.times = self.times, {}
+        return times
+
+
+class RestartBackoff:
+    """
+    Restart schedule of the worker processes: the delay doubles with every
+    crash up to max_delay and starts over once a process stayed up for
+    stable_after seconds.
+    """
+    def __init__(self, max_delay=MAX_RESTART_DELAY, stable_after=STABLE_UPTIME):
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.restarts = {}
+        self.restart_at = {}
+        self.started_at = {}
+
+    def started(self, name, now):
+        self.started_at[name] = now
+        self.restart_at.pop(name, None)
+
+    def exited(self, name, now):
+        """
+        Schedule the restart of a process that exited.
+            :return: Delay in seconds, None when the restart is already scheduled
+        """
+        if name in self.restart_at:
+            return None
+        if now - self.started_at.get(name, now) >= self.stable_after:
+            self.restarts[name] = 0
+        self.restarts[name] = self.restarts.get(name, 0) + 1
+        delay = min(2 ** (self.restarts[name] - 1), self.max_delay)
+        self.restart_at[name] = now + delay
+        return delay
+
+    def due(self, name, now):
+        return name in self.restart_at and now >= self.restart_at[name]
+
+
+def run_capture(camera, ring_name, events, stop_event):
+    worker_setup()
+    ring = SharedFrameRing(ring_name)
+    mailbox = RingMailbox(ring, events, INPUT_SIDE)
+    capture = CaptureThread(create_source(camera), mailbox, name=f"capture-{camera['id']}", metrics=mailbox)
+    capture.start()
+    while capture.is_alive() and not stop_event.wait(1):
+        pass
+    capture.stop()
+    capture.join(timeout=2)
+    logger.info("Capture %s stopped after %d frames", camera["id"], capture.frames_read)
+    ring.close()
+    if not stop_event.is_set() and not getattr(capture.source, "finished", False):
+        # Only the end of a replayed recording is a clean exit, the supervisor restarts anything else
+        logger.error("Capture %s died before the end of the stream", camera["id"])
+        sys.exit(1)
+
+
+def run_inference(cameras, ring_names, frame_event, result_queue, names_event, stop_event):
+    worker_setup()
+    rings = [SharedFrameRing(name) for name in ring_names]
+    model = load_model()
+    names_event.clear()
+    result_queue.put(("names", model.names))
+    gates = [MotionGate(MOTION_THRESHOLD, MOTION_KEYFRAME_INTERVAL) for _ in cameras]
+    trackers = [BirdTracker(DETECT_INTERVAL, min_confidence=TRACK_MIN_CONFIDENCE) for _ in cameras]
+    camera_metrics = [ForwardedMetrics() for _ in cameras]
+    last_detections = [None] * len(cameras)
+    last_seqs = [ring.latest_seq() for ring in rings]
+    results_dropped = 0
+    last_stats_log = time.time()
+    try:
+        while not stop_event.is_set():
+            if names_event.is_set():
+                # A restarted output process asks for the class names again
+                names_event.clear()
+                result_queue.put(("names", model.names))
+            if not frame_event.wait(1):
+                continue
+            frame_event.clear()
+            items = []
+            dropped = {}
+            for index, ring in enumerate(rings):
+                seq = ring.latest_seq()
+                if seq <= last_seqs[index]:
+                    continue
+                frame = ring.read(seq)
+                if frame is None:
+                    # Torn read, the writer already signals the next frame
+                    continue
+                dropped[index] = seq - last_seqs[index] - 1
+                last_seqs[index] = seq
+                items.append((index, frame.image, seq, None))
+
+            for index, _, seq, _, detections, new_track_ids in detect(model, items, gates, trackers,
+                                                                      last_detections, camera_metrics):
+                message = ("result", index, seq, detections, new_track_ids,
+                           camera_metrics[index].pop_times(), dropped.get(index, 0))
+                try:
+                    result_queue.put_nowait(message)
+                except queue.Full:
+                    results_dropped += 1
+
+            if STATS_LOG_INTERVAL and time.time() - last_stats_log >= STATS_LOG_INTERVAL:
+                last_stats_log = time.time()
+                for camera, gate in zip(cameras, gates):
+                    stats = gate.stats()
+                    logger.info("Motion gate %s: skipped %d/%d frames (%.1f%%), CPU saved %.1f s",
+                                camera["id"], stats["skipped"], stats["frames"],
+                                stats["skipped_fraction"] * 100, stats["cpu_saved_seconds"])
+                if results_dropped:
+                    logger.warning("%d results dropped, the output process is too slow", results_dropped)
+    finally:
+        for ring in rings:
+            ring.close()
+
+
+def run_output(cameras, ring_names, frame_event, result_queue, names_event, stop_event):
+    worker_setup()
+    names_event.set()
+    rings = [SharedFrameRing(name) for name in ring_names]
+    client, ubidots_client = connect_clients()
+    metrics, metrics_server = start_metrics(client, ubidots_client)
+    deterrent = start_deterrent(client, metrics)
+    clip_writer = start_clip_writer(metrics)
+    camera_metrics = []
+    recorders = []
+    pipelines = []
+    dropped = [0] * len(cameras)
+    for camera in cameras:
+        camera_metric = metrics.camera(camera["id"])
+        recorder = ClipRecorder(camera["id"], clip_writer, CLIP_PRE_ROLL, CLIP_POST_ROLL) if clip_writer else None
+        camera_metrics.append(camera_metric)
+        recorders.append(recorder)
+        pipelines.append(create_pipeline(camera, len(cameras), deterrent, ubidots_client, camera_metric, recorder))
+
+    def collect():
+        samples = []
+        for camera, ring, count in zip(cameras, rings, dropped):
+            labels = {"camera": camera["id"]}
+            samples.append(("frames_read_total", "counter", "Frames read from the camera", labels, ring.latest_seq()))
+            samples.append(("frames_dropped_total", "counter", "Frames overwritten in the ring before inference",
+                            labels, count))
+        return samples
+    metrics.add_collector(collect)
+
+    def tail_rings():
+        # Every frame of the rings goes to the pre-roll, also those the inference skips
+        seen = [ring.latest_seq() for ring in rings]
+        while not stop_event.is_set():
+            if not frame_event.wait(1):
+                continue
+            frame_event.clear()
+            for index, ring in enumerate(rings):
+                latest = ring.latest_seq()
+                for seq in range(max(seen[index] + 1, latest - ring.slots + 1), latest + 1):
+                    frame = ring.read(seq, with_image=False)
+                    if frame is None:
+                        continue
+                    camera_metrics[index].observe("read", frame.read_time)
+                    if frame.decode_time:
+                        camera_metrics[index].observe("decode", frame.decode_time)
+                    if recorders[index] is not None:
+                        if frame.jpeg is None:
+                            frame = ring.read(seq)
+                        if frame is not None:
+                            recorders[index].add(frame.timestamp, frame.jpeg, frame.image)
+                seen[index] = latest
+
+    tail = threading.Thread(target=tail_rings, daemon=True, name="ring-tail")
+    tail.start()
+
+    names = {}
+    last_stats_log = time.time()
+    try:
+        while not stop_event.is_set():
+            try:
+                message = result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if message[0] == "names":
+                names = message[1]
+                continue
+            if not names:
+                # Results queued before the class names arrived would be mislabelled
+                continue
+            _, index, seq, detections, new_track_ids, times, frames_dropped = message
+            dropped[index] += frames_dropped
+            for stage, seconds in times.items():
+                camera_metrics[index].observe(stage, seconds)
+            # The frame normally is still in the ring, otherwise use the newest one
+            frame = rings[index].read(seq) or rings[index].read()
+            if frame is None:
+                continue
+            pipelines[index].handle(frame.image, detections, names, new_track_ids, seq, frame.jpeg)
+
+            if STATS_LOG_INTERVAL and time.time() - last_stats_log >= STATS_LOG_INTERVAL:
+                last_stats_log = time.time()
+                log_stats(metrics, cameras, [None] * len(cameras), pipelines)
+            if SHOW_PREVIEW:
+                cv.waitKey(1)
+    finally:
+        if clip_writer is not None:
+            for recorder in recorders:
+                recorder.flush()
+            clip_writer.stop()
+            clip_writer.join(timeout=10)
+        for pipeline in pipelines:
+            pipeline.broadcaster.close()
+        deterrent.stop()
+        client.close()
+        ubidots_client.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        tail.join(timeout=2)
+        for ring in rings:
+            ring.close()
+
+
+def main():
+    cameras = load_camera_config()
+    check_cameras(cameras)
+
+    # Spawn instead of fork: the workers load OpenCV, the model and their own threads
+    ctx = mp.get_context("spawn")
+    stop_event = ctx.Event()
+    inference_event = ctx.Event()
+    output_event = ctx.Event()
+    result_queue = ctx.Queue(RESULT_QUEUE_SIZE)
+    names_event = ctx.Event()
+    rings = [SharedFrameRing(f"birddet_{os.getpid()}_{camera['id']}", FRAME_RING_SLOTS,
+                             max_image_bytes=INPUT_SIDE * INPUT_SIDE * 3, create=True) for camera in cameras]
+    ring_names = [ring.name for ring in rings]
+
+    specs = {}
+    for camera, ring in zip(cameras, rings):
+        specs[f"capture-{camera['id']}"] = (run_capture, (camera, ring.name, [inference_event, output_event], stop_event))
+    specs["inference"] = (run_inference, (cameras, ring_names, inference_event, result_queue, names_event, stop_event))
+    specs["output"] = (run_output, (cameras, ring_names, output_event, result_queue, names_event, stop_event))
+    replays = {f"capture-{camera['id']}" for camera in cameras if camera.get("replay")}
+
+    processes = {}
+    backoff = RestartBackoff()
+    finished = set()
+
+    def start(name):
+        target, args = specs[name]
+        process = ctx.Process(target=target, args=args, name=name, daemon=False)
+        process.start()
+        processes[name] = process
+        backoff.started(name, time.time())
+        logger.info("Started %s (pid %d)", name, process.pid)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    try:
+        for name in specs:
+            start(name)
+        while not stop_event.wait(1):
+            now = time.time()
+            for name, process in list(processes.items()):
+                if process.is_alive() or name in finished:
+                    continue
+                if name in replays and process.exitcode == 0:
+                    # A replayed recording has ended
+                    finished.add(name)
+                    logger.info("%s finished", name)
+                    continue
+                delay = backoff.exited(name, now)
+                if delay is not None:
+                    logger.error("%s exited with code %s, restarting in %d s", name, process.exitcode, delay)
+                elif backoff.due(name, now):
+                    start(name)
+            if all(name in finished for name in specs if name.startswith("capture")):
+                logger.info("All camera streams finished, exiting")
+                break
+    except KeyboardInterrupt:
+        logger.info("Program interrupted by user")
+    finally:
+        stop_event.set()
+        for name, process in processes.items():
+            process.join(timeout=10)
+            if process.is_alive():
+                logger.warning("%s did not stop, terminating", name)
+                process.terminate()
+                process.join(timeout=2)
+        result_queue.cancel_join_thread()
+        for ring in rings:
+            ring.close()
+        logger.info("Resources cleaned up")
+
+
+if __name__ == "__main__":
+    main()
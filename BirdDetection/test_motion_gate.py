@@ -0,0 +1,15 @@
+import numpy as np
+from motion_gate import MotionGate
+
+
+def test_cpu_saved_is_averaged_over_model_invocations():
+    # A still scene with a keyframe every 2nd frame, 4 frames pass the gate and 4 are skipped
+    gate = MotionGate(keyframe_interval=2)
+    frame = np.zeros((90, 160, 3), dtype=np.uint8)
+    passed = [gate.check(frame) for _ in range(8)]
+    assert passed == [True, False] * 4
+    # The model runs on the first one only, the tracker serves the other 3
+    gate.record_inference(0.2)
+    stats = gate.stats()
+    assert stats["inferences"] == 1
+    assert abs(stats["cpu_saved_seconds"] - 4 * 0.2) < 1e-9
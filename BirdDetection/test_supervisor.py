@@ -0,0 +1,45 @@
+from supervisor import RestartBackoff
+
+
+def simulate(backoff, seconds, uptime=0):
+    """
+    Run the supervisor loop once per second for a worker that exits uptime seconds after every start.
+        :return: Times of the restarts
+    """
+    starts = []
+    backoff.started("inference", 0)
+    alive_until = uptime
+    for now in range(1, seconds + 1):
+        if now < alive_until:
+            continue
+        if backoff.exited("inference", now) is None and backoff.due("inference", now):
+            backoff.started("inference", now)
+            starts.append(now)
+            alive_until = now + uptime
+    return starts
+
+
+def test_crashing_worker_keeps_being_restarted_with_growing_delay():
+    starts = simulate(RestartBackoff(max_delay=30), 120)
+    assert starts[:5] == [2, 5, 10, 19, 36]
+    # Capped at the maximum delay from then on
+    assert [b - a for a, b in zip(starts[4:], starts[5:])] == [31, 31]
+
+
+def test_delay_starts_over_after_a_stable_run():
+    backoff = RestartBackoff(max_delay=30, stable_after=60)
+    for now in (0, 10, 20):
+        backoff.started("output", now)
+        backoff.exited("output", now + 1)
+    assert backoff.restarts["output"] == 3
+    backoff.started("output", 100)
+    assert backoff.exited("output", 200) == 1
+
+
+def test_restart_is_only_due_after_the_delay():
+    backoff = RestartBackoff()
+    backoff.started("output", 0)
+    assert backoff.exited("output", 5) == 1
+    assert not backoff.due("output", 5.5)
+    assert backoff.exited("output", 5.5) is None
+    assert backoff.due("output", 6)
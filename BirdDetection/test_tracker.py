@@ -0,0 +1,44 @@
+import numpy as np
+from detections import Detections
+from tracker import BirdTracker
+
+
+def bird(x, y, size=10, score=0.9):
+    return Detections(np.array([[x, y, x + size, y + size]], dtype=np.int32), np.array([score], dtype=np.float32),
+                      np.array([0], dtype=np.int32))
+
+
+def run(tracker, positions):
+    """
+    Feed one bird per frame, the detector only sees it when the tracker asks for a detection.
+        :return: All track ids that were reported as new
+    """
+    new_ids = []
+    for x, y in positions:
+        if tracker.needs_detection():
+            _, ids = tracker.update(bird(x, y))
+            new_ids.extend(ids.tolist())
+        else:
+            tracker.predict()
+    return new_ids
+
+
+def test_small_bird_moving_steadily_keeps_its_track_id():
+    # 1.2 px per frame is 6 px per detector run, the 10 px box overlaps its old position with IoU 0.25 only
+    tracker = BirdTracker(detect_interval=5, iou_threshold=0.3)
+    positions = [(100 + 1.2 * frame, 200) for frame in range(60)]
+    assert run(tracker, positions) == [1]
+    assert len(tracker.ids) == 1
+
+
+def test_velocity_is_set_by_the_first_match():
+    tracker = BirdTracker(detect_interval=5)
+    run(tracker, [(100 + 2 * frame, 200) for frame in range(10)])
+    np.testing.assert_allclose(tracker.velocities[0], [2, 0, 2, 0], atol=0.01)
+
+
+def test_distant_bird_starts_a_new_track():
+    tracker = BirdTracker(detect_interval=1)
+    tracker.update(bird(100, 200))
+    _, new_ids = tracker.update(bird(300, 50))
+    assert new_ids.tolist() == [2]
@@ -0,0 +1,164 @@
+import logging
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from detections import Detections, box_iou
+
+logger = logging.getLogger(__name__)
+
+
+class BirdTracker:
+    """
+    Lightweight SORT-style tracker. YOLO runs only every few frames; in
+    between, the tracks are carried forward with a constant-velocity model and
+    their confidence decays. Detections are associated to tracks by IoU, so
+    every bird keeps a stable track id while it stays in view. Small boxes
+    that moved too far for any overlap are associated by centre distance.
+    """
+    def __init__(self, detect_interval=5, iou_threshold=0.3, min_confidence=0.3, decay=0.9, max_missed=2, smoothing=0.5,
+                 center_gate=1.0):
+        """
+        :param detect_interval: Run the detector at least once every this many frames
+        :param iou_threshold: Minimum IoU to associate a detection with a track
+        :param center_gate: Pairs left over by IoU are associated when their centres are at most this many
+                            track box sizes apart, 0 disables it
+        :param min_confidence: Run the detector early when a track's confidence decays below this value
+        :param decay: Confidence decay per frame without detection
+        :param max_missed: Drop a track after this many detector runs without a match
+        :param smoothing: Weight of the newest velocity measurement (0-1)
+        """
+        self.detect_interval = detect_interval
+        self.iou_threshold = iou_threshold
+        self.min_confidence = min_confidence
+        self.decay = decay
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.center_gate = center_gate
+        self.next_id = 1
+        self.frames_since_detection = 0
+        self.boxes = np.empty((0, 4), dtype=np.float32)
+        self.velocities = np.empty((0, 4), dtype=np.float32)
+        self.scores = np.empty((0,), dtype=np.float32)
+        self.classes = np.empty((0,), dtype=np.int32)
+        self.ids = np.empty((0,), dtype=np.int64)
+        self.missed = np.empty((0,), dtype=np.int32)
+        self.age = np.empty((0,), dtype=np.int32)
+        self.hits = np.empty((0,), dtype=np.int32)
+
+    def needs_detection(self):
+        """
+        :return: True if the detector should run on the next frame
+        """
+        if self.frames_since_detection + 1 >= self.detect_interval:
+            return True
+        return bool(len(self.scores)) and bool(np.any(self.scores < self.min_confidence))
+
+    def _advance(self):
+        self.boxes += self.velocities
+        self.scores *= self.decay
+        self.age += 1
+
+    def current(self):
+        """
+        :return: Detections of the active tracks, including their track ids
+        """
+        return Detections(self.boxes.round().astype(np.int32), self.scores.copy(), self.classes.copy(), self.ids.copy())
+
+    def predict(self):
+        """
+        Carry the tracks forward on a frame without detection.
+            :return: Detections of the active tracks
+        """
+        self.frames_since_detection += 1
+        self._advance()
+        return self.current()
+
+    def update(self, detections):
+        """
+        Associate fresh detections with the tracks.
+            :param detections: Detections from the model
+            :return: Tuple (Detections of the active tracks, array of new track ids)
+        """
+        self._advance()
+        self.frames_since_detection = 0
+        det_boxes = detections.boxes.astype(np.float32)
+
+        matched_tracks = np.empty((0,), dtype=np.int64)
+        matched_dets = np.empty((0,), dtype=np.int64)
+        if len(self.boxes) and len(det_boxes):
+            iou = box_iou(self.boxes, det_boxes)
+            rows, cols = linear_sum_assignment(-iou)
+            keep = iou[rows, cols] >= self.iou_threshold
+            matched_tracks, matched_dets = rows[keep], cols[keep]
+            if self.center_gate:
+                tracks, dets = self._match_centers(det_boxes, matched_tracks, matched_dets)
+                matched_tracks = np.concatenate([matched_tracks, tracks])
+                matched_dets = np.concatenate([matched_dets, dets])
+
+        # Matched tracks: correct position, velocity and confidence
+        if len(matched_tracks):
+            elapsed = np.maximum(self.age[matched_tracks], 1)[:, None]
+            measured = (det_boxes[matched_dets] - (self.boxes[matched_tracks] - self.velocities[matched_tracks] * elapsed)) / elapsed
+            # The first match of a track sets its velocity, there is no estimate to smooth yet
+            weight = np.where(self.hits[matched_tracks] == 0, 1.0, self.smoothing)[:, None]
+            self.velocities[matched_tracks] = (1 - weight) * self.velocities[matched_tracks] + weight * measured
+            self.boxes[matched_tracks] = det_boxes[matched_dets]
+            self.scores[matched_tracks] = detections.scores[matched_dets]
+            self.missed[matched_tracks] = 0
+            self.age[matched_tracks] = 0
+            self.hits[matched_tracks] += 1
+
+        # Unmatched tracks: drop them after too many missed detector runs
+        unmatched = np.ones(len(self.boxes), dtype=bool)
+        unmatched[matched_tracks] = False
+        self.missed[unmatched] += 1
+        alive = self.missed <= self.max_missed
+        # A lost track must not keep drifting
+        self.velocities[unmatched] = 0
+        self._select(alive)
+
+        # Unmatched detections start new tracks
+        new = np.ones(len(det_boxes), dtype=bool)
+        new[matched_dets] = False
+        count = int(np.count_nonzero(new))
+        new_ids = np.arange(self.next_id, self.next_id + count, dtype=np.int64)
+        self.next_id += count
+        self.boxes = np.concatenate([self.boxes, det_boxes[new]])
+        self.velocities = np.concatenate([self.velocities, np.zeros((count, 4), dtype=np.float32)])
+        self.scores = np.concatenate([self.scores, detections.scores[new].astype(np.float32)])
+        self.classes = np.concatenate([self.classes, detections.classes[new].astype(np.int32)])
+        self.ids = np.concatenate([self.ids, new_ids])
+        self.missed = np.concatenate([self.missed, np.zeros(count, dtype=np.int32)])
+        self.age = np.concatenate([self.age, np.zeros(count, dtype=np.int32)])
+        self.hits = np.concatenate([self.hits, np.zeros(count, dtype=np.int32)])
+        if count:
+            logger.debug("New tracks: %s", new_ids.tolist())
+        return self.current(), new_ids
+
+    def _match_centers(self, det_boxes, matched_tracks, matched_dets):
+        """
+        Associate the tracks and detections that IoU left unmatched by the distance of their centres,
+        relative to the size of the track box.
+            :return: Tuple (track indices, detection indices) of the new pairs
+        """
+        tracks = np.setdiff1d(np.arange(len(self.boxes)), matched_tracks)
+        dets = np.setdiff1d(np.arange(len(det_boxes)), matched_dets)
+        if not len(tracks) or not len(dets):
+            return tracks[:0], dets[:0]
+        track_boxes = self.boxes[tracks]
+        track_centers = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+        det_centers = (det_boxes[dets, :2] + det_boxes[dets, 2:]) / 2
+        sizes = np.sqrt(np.prod(np.maximum(track_boxes[:, 2:] - track_boxes[:, :2], 1), axis=1))
+        distance = np.linalg.norm(track_centers[:, None] - det_centers[None], axis=2) / sizes[:, None]
+        rows, cols = linear_sum_assignment(distance)
+        keep = distance[rows, cols] <= self.center_gate
+        return tracks[rows[keep]], dets[cols[keep]]
+
+    def _select(self, mask):
+        self.boxes = self.boxes[mask]
+        self.velocities = self.velocities[mask]
+        self.scores = self.scores[mask]
+        self.classes = self.classes[mask]
+        self.ids = self.ids[mask]
+        self.missed = self.missed[mask]
+        self.age = self.age[mask]
+        self.hits = self.hits[mask]
@@ -1,6 +1,11 @@
-import requests
+import os
+import time
 import json
+import queue
 import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
 
 
 # Konfigurasi logger
@@ -15,8 +20,225 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Responses worth retrying later, every other 4xx means the payload or the token is wrong
+RETRY_STATUS = (408, 429)
+MAX_RETRY_DELAY = 60
+
+
+class UbidotsUploader(threading.Thread):
+    """
+    Background thread that sends the values to Ubidots. Callers only put
+    (variable, value, timestamp) into a bounded queue; the thread collects
+    them for flush_interval seconds and posts them as one bulk request over a
+    keep-alive session, at most max_rate requests per second.
+
+    When Ubidots cannot be reached the batches are appended to a JSON lines
+    backlog file and replayed once a request succeeds again, also after a restart.
+    """
+    def __init__(self, url, headers, flush_interval=1.0, max_batch=100, max_rate=4.0, timeout=5,
+                 max_pending=1000, backlog_path="ubidots_backlog.jsonl", max_backlog_bytes=10 * 1024 * 1024):
+        """
+        :param url: Device endpoint of the Ubidots API
+        :param headers: Request headers with the token
+        :param flush_interval: Seconds values are collected before a request
+        :param max_batch: Maximum values per request
+        :param max_rate: Maximum requests per second
+        :param timeout: Connect and read timeout of a request in seconds
+        :param max_pending: Values waiting in memory, further values are dropped
+        :param backlog_path: Backlog file for batches that could not be sent, None disables it
+        :param max_backlog_bytes: Batches are dropped when the backlog grows above this size
+        """
+        super().__init__(daemon=True, name="ubidots-uploader")
+        self.url = url
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.timeout = timeout
+        self.backlog_path = backlog_path
+        self.max_backlog_bytes = max_backlog_bytes
+        self.queue = queue.Queue(max_pending)
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.values_sent = 0
+        self.values_dropped = 0
+        self.requests_failed = 0
+        self.backlog_batches = 0
+        # Batches at the start of the backlog file that were sent but could not be removed from it
+        self._backlog_sent = 0
+        self._stopped = threading.Event()
+        self._last_request = 0.0
+        self._retry_delay = 0.0
+        self._retry_at = 0.0
+        if backlog_path and os.path.exists(backlog_path):
+            with open(backlog_path) as f:
+                self.backlog_batches = sum(1 for _ in f)
+            if self.backlog_batches:
+                logger.info("Ubidots backlog %s holds %d batches", backlog_path, self.backlog_batches)
+
+    def put(self, variable, value, timestamp=None):
+        """
+        Queue a value without blocking.
+            :param variable: Ubidots variable label
+            :param value: Value to send
+            :param timestamp: Time of the value in seconds, defaults to now
+        """
+        try:
+            self.queue.put_nowait((variable, value, int((timestamp or time.time()) * 1000)))
+        except queue.Full:
+            self.values_dropped += 1
+
+    def stop(self, timeout=10):
+        """
+        Send (or save) the queued values and stop the thread.
+        """
+        self._stopped.set()
+        self.join(timeout)
+        self.session.close()
+
+    def run(self):
+        while not self._stopped.is_set():
+            batch = self._collect(self.flush_interval)
+            if batch:
+                self._flush(batch)
+            elif self.backlog_batches and time.time() >= self._retry_at:
+                self._replay_backlog()
+        # Shutdown: whatever is left goes out now or into the backlog
+        while True:
+            batch = self._collect(0)
+            if not batch:
+                break
+            self._flush(batch)
+
+    def _collect(self, timeout):
+        values = []
+        deadline = time.time() + timeout
+        while len(values) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0 and not self._stopped.is_set():
+                    values.append(self.queue.get(timeout=remaining))
+                else:
+                    values.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return values
+
+    def _flush(self, values):
+        payload = {}
+        for variable, value, timestamp in values:
+            payload.setdefault(variable, []).append({"value": value, "timestamp": timestamp})
+        if time.time() < self._retry_at:
+            # Still offline, do not wait for the timeout of every batch
+            self._save(payload)
+        elif self._post(payload):
+            self.values_sent += len(values)
+            if self.backlog_batches:
+                self._replay_backlog()
+        else:
+            self._save(payload)
+
+    def _post(self, payload):
+        """
+        :return: True if the payload was accepted or cannot be sent at all, False to retry later
+        """
+        wait = self._last_request + self.min_interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_request = time.time()
+        try:
+            response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            return self._failed(f"{e}")
+        if response.status_code >= 500 or response.status_code in RETRY_STATUS:
+            return self._failed(f"HTTP {response.status_code}")
+        self._retry_delay = 0.0
+        self._retry_at = 0.0
+        if response.status_code >= 400:
+            # Retrying does not help, e.g. an invalid token
+            self.values_dropped += sum(len(dots) for dots in payload.values())
+            logger.error(f"Ubidots rejected the data with HTTP {response.status_code}: {response.text[:200]}")
+            return True
+        logger.debug("Ubidots data sent: %s", payload)
+        return True
+
+    def _failed(self, reason):
+        self.requests_failed += 1
+        self._retry_delay = min(max(self._retry_delay * 2, 1.0), MAX_RETRY_DELAY)
+        self._retry_at = time.time() + self._retry_delay
+        logger.warning(f"Error sending data to Ubidots ({reason}), retrying in {self._retry_delay:.0f} s")
+        return False
+
+    def _save(self, payload):
+        count = sum(len(dots) for dots in payload.values())
+        if not self.backlog_path:
+            self.values_dropped += count
+            return
+        try:
+            if os.path.exists(self.backlog_path) and os.path.getsize(self.backlog_path) >= self.max_backlog_bytes:
+                self.values_dropped += count
+                logger.warning("Ubidots backlog full, dropping %d values", count)
+                return
+            with open(self.backlog_path, "a") as f:
+                f.write(json.dumps(payload) + "\n")
+            self.backlog_batches += 1
+        except OSError as e:
+            self.values_dropped += count
+            logger.error(f"Error writing Ubidots backlog: {e}")
+
+    def _replay_backlog(self):
+        try:
+            with open(self.backlog_path) as f:
+                lines = f.readlines()
+        except OSError as e:
+            logger.error(f"Error reading Ubidots backlog: {e}")
+            self.backlog_batches = 0
+            return
+        sent = min(self._backlog_sent, len(lines))
+        logger.info("Replaying %d batches from the Ubidots backlog", len(lines) - sent)
+        for line in lines[sent:]:
+            if self._stopped.is_set():
+                break
+            try:
+                payload = json.loads(line)
+            except json.JSONDecodeError:
+                sent += 1
+                continue
+            if not self._post(payload):
+                break
+            self.values_sent += sum(len(dots) for dots in payload.values())
+            sent += 1
+        # Only this thread writes the backlog, keep the batches that were not sent
+        remaining = lines[sent:]
+        self.backlog_batches = len(remaining)
+        tmp_path = self.backlog_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.writelines(remaining)
+            os.replace(tmp_path, self.backlog_path)
+            self._backlog_sent = 0
+        except OSError as e:
+            # The next replay skips the sent batches and tries the rewrite again
+            self._backlog_sent = sent
+            logger.error(f"Error rewriting Ubidots backlog: {e}")
+
+    def stats(self):
+        return {
+            "pending": self.queue.qsize(),
+            "sent": self.values_sent,
+            "dropped": self.values_dropped,
+            "failed_requests": self.requests_failed,
+            "backlog_batches": self.backlog_batches,
+        }
+
+
 class ubidots():
-    def __init__(self, token, device_label):
+    def __init__(self, token, device_label, **uploader_options):
+        """
+        :param token: Ubidots token
+        :param device_label: Ubidots device label
+        :param uploader_options: Options of the UbidotsUploader, e.g. flush_interval or backlog_path
+        """
         self.token = token
         self.device_label = device_label
         self.url = f"https://industrial.api.ubidots.com/api/v1.6/devices/{self.device_label}"
@@ -24,25 +246,18 @@ class ubidots():
             "X-Auth-Token": self.token,
             "Content-Type": "application/json"
         }
-    def send_bird_detection(self, value):
+        self.uploader = UbidotsUploader(self.url, self.headers, **uploader_options)
+        self.uploader.start()
+
+    def send_bird_detection(self, value, variable="bird_detected"):
         """
-        Send bird detection data to Ubidots.
+        Queue bird detection data for Ubidots, the upload runs in the background.
             :param value: The value to send (1 for detected, 0 for not detected)
-            :return: Response from Ubidots API
+            :param variable: Ubidots variable label, one per camera
         """
-        if value not in [1, 3]: 
-            return None
-        data = {
-            "bird_detected": value
-            }
-        try:
-            response = requests.post(self.url, headers=self.headers, json=data)
-            response.raise_for_status()  # Raise an error for bad responses
-            logger.info(f"Bird detection data sent successfully: {data}")
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error sending bird detection data: {e}")
-            return None
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decoding JSON response: {e}")
-            return None
\ No newline at end of file
+        if value not in [1, 3]:
+            return
+        self.uploader.put(variable, value)
+
+    def close(self):
+        self.uploader.stop()
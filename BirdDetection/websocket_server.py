@@ -0,0 +1,499 @@
+import asyncio
+import json
+import os
+import logging
+import threading
+import time
+import numpy as np
+import cv2 as cv
+import websockets
+from mjpeg_stream import STREAM_CONTENT_TYPE, multipart_part
+from h264_output import HLS_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+
+# Channels selected by the request path:
+#   /      binary JPEG frames only
+#   /meta  JSON detection records only
+#   /live  each JSON detection record followed by its binary JPEG frame
+# and the HTTP viewers of the MJPEG stream (/stream on the HTTP port)
+CHANNEL_FRAMES = "frames"
+CHANNEL_META = "meta"
+CHANNEL_LIVE = "live"
+CHANNEL_MJPEG = "mjpeg"
+CHANNEL_PATHS = {"/": CHANNEL_FRAMES, "/meta": CHANNEL_META, "/live": CHANNEL_LIVE}
+
+HTTP_REASONS = {200: "OK", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+
+def request_path(websocket):
+    request = getattr(websocket, "request", None)
+    path = request.path if request is not None else getattr(websocket, "path", "/")
+    return path.split("?", 1)[0].rstrip("/") or "/"
+
+
+class ClientState:
+    """
+    Latest-frame slot and send statistics of one WebSocket viewer. A slow
+    viewer only ever has one pending frame, newer frames replace it.
+    """
+    def __init__(self, websocket, channel=CHANNEL_FRAMES):
+        self.websocket = websocket
+        self.channel = channel
+        self.address = websocket.remote_address if websocket is not None else None
+        self.pending = None
+        self.pending_meta = None
+        self.pending_time = 0.0
+        self.event = asyncio.Event()
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.queue_age = 0.0
+        self.send_latency = 0.0
+
+    @property
+    def wants_frames(self):
+        return self.channel != CHANNEL_META
+
+    def offer(self, jpeg, meta, frame_time):
+        if self.pending is not None or self.pending_meta is not None:
+            self.frames_skipped += 1
+        self.pending = jpeg if self.wants_frames else None
+        self.pending_meta = meta if self.channel != CHANNEL_FRAMES else None
+        self.pending_time = frame_time
+        self.event.set()
+
+    async def send(self, jpeg, meta):
+        if meta is not None:
+            await self.websocket.send(meta)
+        if jpeg is not None:
+            await self.websocket.send(jpeg)
+
+    def stats(self):
+        return {
+            "address": f"{self.address[0]}:{self.address[1]}" if self.address else "unknown",
+            "channel": self.channel,
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped,
+            "queue_age_ms": self.queue_age * 1000,
+            "send_latency_ms": self.send_latency * 1000,
+        }
+
+
+class MjpegClientState(ClientState):
+    """
+    Viewer of the HTTP MJPEG stream. It is offered the ready-made chunk of a
+    frame (see mjpeg_chunk), which all MJPEG viewers share.
+    """
+    def __init__(self, writer):
+        super().__init__(None, CHANNEL_MJPEG)
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+
+    async def send(self, chunk, meta):
+        if chunk is not None:
+            self.writer.write(chunk)
+            await self.writer.drain()
+
+
+def mjpeg_chunk(jpeg, timestamp):
+    """
+    One frame of the MJPEG stream as an HTTP chunk: multipart headers in the
+    ESP32-CAM format followed by the JPEG, so the stream can be read like a camera.
+        :param jpeg: JPEG bytes
+        :param timestamp: Frame time in seconds
+        :return: Bytes of the chunk
+    """
+    data = multipart_part(jpeg, timestamp) + jpeg
+    return b"%x\r\n" % len(data) + data + b"\r\n"
+
+
+class FrameBroadcaster:
+    """
+    WebSocket server that broadcasts the frames of one camera to all
+    connected viewers. The server runs its own asyncio loop in a background thread.
+    Every frame is JPEG-encoded once and sent as a binary message; each viewer
+    has its own sender task so one slow viewer never delays the others.
+    Detection records are pushed as compact JSON on the metadata channels, so
+    viewers can draw the overlays themselves.
+
+    With http_port the same loop serves the frames over HTTP for browsers and
+    NVRs: /stream as multipart/x-mixed-replace MJPEG and /snapshot as the
+    latest JPEG. Outputs (e.g. H264Encoder) receive the same frames; the HLS
+    files of hls_dir are served at /hls/. These viewers cannot read the
+    detection records, so they get the annotated frame of publish(), encoded
+    once for all of them, while WebSocket viewers keep the camera JPEG.
+    """
+    def __init__(self, host="localhost", port=8765, jpeg_quality=85, metrics=None, http_host="0.0.0.0",
+                 http_port=None, hls_dir=None):
+        """
+        :param host: Host to bind the WebSocket server
+        :param port: Port to bind the WebSocket server
+        :param jpeg_quality: JPEG quality of the broadcast frames
+        :param metrics: Optional CameraMetrics for the encode, queue and send stages
+        :param http_host: Host to bind the HTTP stream server
+        :param http_port: Port of the HTTP stream server, None to disable it
+        :param hls_dir: Directory of the HLS playlist and segments served at /hls/
+        """
+        self.host = host
+        self.port = port
+        self.http_host = http_host
+        self.http_port = http_port
+        self.hls_dir = hls_dir
+        self.outputs = []
+        self.jpeg_quality = jpeg_quality
+        self.metrics = metrics
+        self.clients = {}
+        self.loop = None
+        self.thread = None
+        self._frame = None
+        self._frame_jpeg = None
+        self._frame_annotated = None
+        self._frame_meta = None
+        self._frame_time = 0.0
+        self._frame_event = None
+        self._stop = None
+        # Latest frame of the HTTP viewers and its encoded JPEG, for /snapshot
+        self._latest = (None, 0.0)
+        self._latest_jpeg = (None, 0.0)
+        self.frames_encoded = 0
+
+    def encode(self, frame):
+        if frame is None or not isinstance(frame, np.ndarray) or frame.size == 0:
+            logger.warning("Invalid frame, skipping WebSocket send")
+            return None
+        start = time.perf_counter()
+        ret, buffer = cv.imencode('.jpg', frame, [int(cv.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+        if self.metrics is not None:
+            self.metrics.observe("encode", time.perf_counter() - start)
+        if not ret:
+            logger.warning("Failed to encode frame as JPEG")
+            return None
+        return buffer.tobytes()
+
+    async def _encode(self, frame):
+        try:
+            # Encode once in a worker thread, all viewers share the same bytes
+            jpeg = await self.loop.run_in_executor(None, self.encode, frame)
+        except Exception as e:
+            logger.error(f"Error encoding frame: {e}")
+            return None
+        if jpeg is not None:
+            self.frames_encoded += 1
+        return jpeg
+
+    def _set_frame(self, frame, jpeg, annotated, meta, frame_time):
+        # Runs on the event loop, a frame that has not been encoded yet is simply replaced
+        self._frame = frame
+        self._frame_jpeg = jpeg
+        self._frame_annotated = annotated
+        self._frame_meta = meta
+        self._frame_time = frame_time
+        self._frame_event.set()
+
+    async def frame_encoder(self):
+        while True:
+            await self._frame_event.wait()
+            self._frame_event.clear()
+            frame, jpeg, annotated = self._frame, self._frame_jpeg, self._frame_annotated
+            meta, frame_time = self._frame_meta, self._frame_time
+            self._frame = None
+            self._frame_jpeg = None
+            self._frame_annotated = None
+            self._frame_meta = None
+            clients = list(self.clients.values())
+            viewers = [state for state in clients if state.channel != CHANNEL_MJPEG]
+            mjpeg_viewers = [state for state in clients if state.channel == CHANNEL_MJPEG]
+            if not clients and not self.outputs:
+                continue
+            view = annotated if annotated is not None else frame
+            view_jpeg = None
+            if view is not None and (mjpeg_viewers or self.outputs):
+                # Always encoded from the model input, so the size does not change when a bird appears
+                view_jpeg = await self._encode(view)
+            if jpeg is None and frame is not None and any(state.wants_frames for state in viewers):
+                # Without a camera JPEG the plain frame is encoded, or shared with the HTTP viewers
+                jpeg = view_jpeg if annotated is None and view_jpeg is not None else await self._encode(frame)
+            if view_jpeg is not None:
+                self._latest_jpeg = (view_jpeg, frame_time)
+                for output in self.outputs:
+                    output.put(view_jpeg, frame_time)
+                # Built once per frame, all MJPEG viewers write the same bytes
+                chunk = mjpeg_chunk(view_jpeg, frame_time)
+                for state in mjpeg_viewers:
+                    state.offer(chunk, None, frame_time)
+            if jpeg is None and meta is None:
+                continue
+            for state in viewers:
+                state.offer(jpeg, meta, frame_time)
+
+    async def client_sender(self, state):
+        while True:
+            await state.event.wait()
+            state.event.clear()
+            jpeg, meta, frame_time = state.pending, state.pending_meta, state.pending_time
+            state.pending = None
+            state.pending_meta = None
+            if jpeg is None and meta is None:
+                continue
+            start = time.time()
+            state.queue_age = start - frame_time
+            await state.send(jpeg, meta)
+            state.send_latency = time.time() - start
+            state.frames_sent += 1
+            if self.metrics is not None:
+                self.metrics.observe("queue", state.queue_age)
+                self.metrics.observe("send", state.send_latency)
+
+    async def serve(self):
+        async def handle_connection(websocket):
+            channel = CHANNEL_PATHS.get(request_path(websocket))
+            if channel is None:
+                await websocket.close(code=1008, reason="Unknown channel")
+                return
+            logger.info(f"New WebSocket client connected to {channel} channel")
+            state = ClientState(websocket, channel)
+            self.clients[websocket] = state
+            sender = asyncio.ensure_future(self.client_sender(state))
+            reader = asyncio.ensure_future(self._drain(websocket))
+            try:
+                await asyncio.wait([sender, reader], return_when=asyncio.FIRST_COMPLETED)
+                if sender.done() and sender.exception():
+                    raise sender.exception()
+            except websockets.exceptions.ConnectionClosed:
+                logger.info("WebSocket client disconnected")
+            except Exception as e:
+                logger.error(f"Error in handle_connection: {e}")
+            finally:
+                sender.cancel()
+                reader.cancel()
+                self.clients.pop(websocket, None)
+                logger.info("Removed disconnected WebSocket client")
+        try:
+            server = await websockets.serve(handle_connection, self.host, self.port, ping_interval=10, ping_timeout=20)
+            logger.info(f"WebSocket server started on ws://{self.host}:{self.port}")
+            http_server = None
+            if self.http_port:
+                http_server = await asyncio.start_server(self.handle_http, self.http_host, self.http_port)
+                logger.info(f"MJPEG stream started on http://{self.http_host}:{self.http_port}/stream")
+            await self._stop.wait()
+            for running in (server, http_server):
+                if running is not None:
+                    running.close()
+                    await running.wait_closed()
+        except Exception as e:
+            logger.error(f"WebSocket server error: {e}")
+
+    async def handle_http(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the request headers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2:
+                return
+            method, path = parts[0], parts[1].split("?", 1)[0]
+            if method not in ("GET", "HEAD"):
+                await self._respond(writer, 405)
+            elif path == "/stream":
+                await self._stream(reader, writer)
+            elif path.startswith("/hls/") and self.hls_dir:
+                await self._hls_file(writer, path[len("/hls/"):])
+            elif path == "/snapshot":
+                jpeg = await self.snapshot()
+                if jpeg is None:
+                    await self._respond(writer, 503, b"No frame yet", "text/plain")
+                else:
+                    await self._respond(writer, 200, jpeg, "image/jpeg")
+            else:
+                await self._respond(writer, 404)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Shutdown; the stream server callback of Python 3.11 fails on a cancelled handler task
+            pass
+        except Exception as e:
+            logger.error(f"Error in handle_http: {e}")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, body=b"", content_type="text/html"):
+        writer.write((f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                      f"Content-Type: {content_type}\r\n"
+                      f"Content-Length: {len(body)}\r\n"
+                      "Cache-Control: no-store\r\n"
+                      "Access-Control-Allow-Origin: *\r\n"
+                      "Connection: close\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def _hls_file(self, writer, name):
+        content_type = HLS_EXTENSIONS.get(os.path.splitext(name)[1])
+        # Only the flat files of the HLS muxer, no paths
+        if content_type is None or name != os.path.basename(name):
+            await self._respond(writer, 404)
+            return
+        try:
+            body = await self.loop.run_in_executor(None, self._read_file, os.path.join(self.hls_dir, name))
+        except FileNotFoundError:
+            await self._respond(writer, 404)
+            return
+        await self._respond(writer, 200, body, content_type)
+
+    @staticmethod
+    def _read_file(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def _stream(self, reader, writer):
+        writer.write(("HTTP/1.1 200 OK\r\n"
+                      f"Content-Type: {STREAM_CONTENT_TYPE}\r\n"
+                      "Transfer-Encoding: chunked\r\n"
+                      "Cache-Control: no-store\r\n"
+                      "Access-Control-Allow-Origin: *\r\n\r\n").encode())
+        await writer.drain()
+        state = MjpegClientState(writer)
+        logger.info(f"New MJPEG client {state.address}")
+        self.clients[writer] = state
+        try:
+            # The latest frame first, so a viewer does not wait for the next detection loop
+            jpeg, frame_time = self._latest_jpeg
+            if jpeg is not None:
+                state.offer(mjpeg_chunk(jpeg, frame_time), None, frame_time)
+            sender = asyncio.ensure_future(self.client_sender(state))
+            # Clients do not send anything after the request, EOF means they disconnected
+            closed = asyncio.ensure_future(self._until_eof(reader))
+            try:
+                await asyncio.wait([sender, closed], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                sender.cancel()
+                closed.cancel()
+        finally:
+            self.clients.pop(writer, None)
+            logger.info(f"Removed MJPEG client {state.address}")
+
+    @staticmethod
+    async def _until_eof(reader):
+        while await reader.read(1024):
+            pass
+
+    async def snapshot(self):
+        """
+        Latest annotated frame as JPEG, encoded on demand when no HTTP viewer is connected.
+            :return: JPEG bytes, None before the first frame
+        """
+        frame, frame_time = self._latest
+        latest_jpeg, latest_time = self._latest_jpeg
+        if latest_jpeg is not None and latest_time >= frame_time:
+            return latest_jpeg
+        jpeg = None
+        if frame is not None:
+            jpeg = await self._encode(frame)
+        if jpeg is not None:
+            self._latest_jpeg = (jpeg, frame_time)
+        return jpeg or latest_jpeg
+
+    @staticmethod
+    async def _drain(websocket):
+        # Viewers do not send anything, reading only detects the disconnect
+        async for _ in websocket:
+            pass
+
+    def run_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            self._frame_event = asyncio.Event()
+            self._stop = asyncio.Event()
+            self.loop = loop
+            loop.create_task(self.frame_encoder())
+            loop.run_until_complete(self.serve())
+        except Exception as e:
+            logger.error(f"Async loop error: {e}")
+        finally:
+            # The encoder and the client tasks have to finish their cancellation before the loop closes
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+            logger.info("Async loop closed")
+
+    def start(self):
+        """
+        Start the WebSocket thread and wait until its event loop is ready.
+        """
+        self.thread = threading.Thread(target=self.run_loop, daemon=True, name=f"websocket-{self.port}")
+        self.thread.start()
+        for _ in range(10):
+            if self.loop is not None:
+                break
+            time.sleep(0.1)
+        else:
+            logger.error("Failed to initialize WebSocket loop")
+            raise RuntimeError("Failed to initialize WebSocket loop")
+        logger.info("WebSocket thread started")
+
+    def add_output(self, output):
+        """
+        Register an output that receives every encoded frame on the event loop.
+            :param output: Object with a non-blocking put(jpeg, frame_time) and stop()
+        """
+        self.outputs.append(output)
+
+    def has_frame_clients(self):
+        """
+        :return: True if at least one connected viewer or output receives frames
+        """
+        return bool(self.outputs) or any(state.wants_frames for state in list(self.clients.values()))
+
+    def wants_annotated(self):
+        """
+        :return: True if the annotated frame can be requested: /snapshot needs no connected viewer
+        """
+        return bool(self.http_port or self.outputs)
+
+    def publish(self, frame, record=None, jpeg=None, annotated=None):
+        """
+        Hand a frame and its detection record to the broadcaster without
+        blocking, a frame that has not been encoded yet is replaced by the newer one.
+            :param frame: Frame (BGR numpy array), None to only send the record
+            :param record: Detection record (dict) for the metadata channels
+            :param jpeg: Original JPEG bytes of the frame, sent to WebSocket viewers instead of encoding the frame
+            :param annotated: Copy of the frame with the detections drawn for the HTTP and HLS viewers,
+                              None when the frame has nothing to draw
+        """
+        frame_time = time.time()
+        # Kept by reference only, /snapshot encodes it when requested
+        self._latest = (annotated if annotated is not None else frame, frame_time)
+        if self.loop is None or not (self.clients or self.outputs):
+            return
+        meta = json.dumps(record, separators=(",", ":")) if record is not None else None
+        try:
+            self.loop.call_soon_threadsafe(self._set_frame, frame, jpeg, annotated, meta, frame_time)
+        except RuntimeError:
+            # Loop already closed
+            pass
+
+    def stats(self):
+        """
+        :return: List of per-client statistics (queue age, send latency, sent and skipped frames)
+        """
+        return [state.stats() for state in list(self.clients.values())]
+
+    def queue_depth(self):
+        """
+        :return: Number of frames waiting to be encoded or sent
+        """
+        waiting = sum(1 for state in list(self.clients.values()) if state.pending is not None or state.pending_meta is not None)
+        return waiting + (1 if self._frame is not None or self._frame_meta is not None else 0)
+
+    def close(self):
+        for output in self.outputs:
+            output.stop()
+        if self.loop is not None and self._stop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._stop.set)
+            except RuntimeError:
+                pass
@@ -1,12 +1,10 @@
+import os
+import sys
+# Modul yang dipakai bersama dengan detector ada di package common di root repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import streamlit as st
 import asyncio
-import websockets
-import base64
-from PIL import Image
-import io
 import logging
-import queue
-import threading
 import time
 import atexit
 import uuid
@@ -14,9 +12,10 @@ from utils.camera_util import get_wifi_ip, scan_camera, Camera
 from utils.display import display_dict_to_ui
 import pandas as pd
 from dotenv import load_dotenv
-import os
-from nodes.mqtt_client import MyMQTTClient
+from nodes.mqtt_client import MyMQTTClient, create_connection
+from common.mqtt_topics import TopicRegistry, parse_speakers
 from nodes.ubidots_client import ubidots
+from nodes.live_hub import LiveHub
 
 # Setup logging
 logging.basicConfig(
@@ -57,37 +56,38 @@ USERNAME = os.environ.get("BROKER_USERNAME")
 PASSWORD = os.environ.get("BROKER_PASSWORD")
 DEVICE_ID = os.environ.get("UBIDOTS_DEVICE_ID")
 TOKEN = os.environ.get("UBIDOTS_TOKEN")
-
-# Fungsi untuk membersihkan koneksi MQTT
-def cleanup_mqtt_client():
-    if "mqtt_client" in st.session_state and st.session_state.mqtt_client is not None:
-        try:
-            st.session_state.mqtt_client.client.loop_stop()
-            st.session_state.mqtt_client.client.disconnect()
-            logger.info("MQTT client disconnected and loop stopped")
-        except Exception as e:
-            logger.error("Error cleaning up MQTT client: %s", e)
-        finally:
-            st.session_state.mqtt_client = None
-
-# Daftarkan pembersihan saat aplikasi dihentikan
-atexit.register(cleanup_mqtt_client)
+# Channel /live mengirim metadata deteksi lalu frame tanpa anotasi
+WEBSOCKET_URI = os.environ.get("LIVE_WEBSOCKET_URI", "ws://localhost:8765/live")
+# Refresh live view per detik, sebaiknya sama dengan FPS detektor
+LIVE_FPS = float(os.environ.get("LIVE_FPS", 15))
+# Speaker per sawah, contoh "sawah1:mp3player,mp3player2;sawah2:mp3player"
+SPEAKER_REGISTRY = TopicRegistry(parse_speakers(os.environ.get("DETERRENT_SPEAKERS")))
+
+# Satu koneksi MQTT per proses server, dipakai bersama oleh semua session
+@st.cache_resource
+def get_mqtt_connection():
+    connection = create_connection(BROKER, int(PORT), USERNAME, PASSWORD)
+    # Tutup koneksi saat server dihentikan
+    atexit.register(connection.close)
+    return connection
+
+# Satu koneksi WebSocket ke detector per proses server, frame dibagi ke semua session
+@st.cache_resource
+def get_live_hub():
+    hub = LiveHub(WEBSOCKET_URI).start()
+    atexit.register(hub.close)
+    return hub
 
 # ***************** Util Function *******
 def start_camera():
     st.session_state.start_camera = True
     st.session_state.stop_camera = False
     st.session_state.frame_counter = 0
-    if "last_frame" in st.session_state:
-        del st.session_state.last_frame
 
 def stop_camera():
     st.session_state.start_camera = False
     st.session_state.stop_camera = True
-    if "frame_queue" in st.session_state:
-        st.session_state.frame_queue.queue.clear()
-    if "last_frame" in st.session_state:
-        del st.session_state.last_frame
+    get_live_hub().leave(st.session_state.viewer_id)
 
 async def st_scan_camera(ip):
     st.session_state.scan_camera = True
@@ -131,93 +131,27 @@ def set_camera_xclk():
     else:
         st.error("Gagal mengatur XCLK. Pastikan alamat IP benar dan kamera terhubung.")
 
-async def receive_frame(websocket_uri, frame_queue):
-    reconnect_delay = 1
-    max_reconnect_delay = 30
-    while not st.session_state.get("stop_camera", False):
-        try:
-            async with websockets.connect(websocket_uri, ping_interval=10, ping_timeout=20) as websocket:
-                logger.info("Connected to WebSocket")
-                reconnect_delay = 1
-                while not st.session_state.get("stop_camera", False):
-                    try:
-                        data = await asyncio.wait_for(websocket.recv(), timeout=10)
-                        if not data:
-                            logger.warning("Received empty data")
-                            continue
-                        try:
-                            img_bytes = base64.b64decode(data)
-                            if len(img_bytes) < 100:
-                                logger.warning("Received data too small to be an image")
-                                continue
-                            try:
-                                image = Image.open(io.BytesIO(img_bytes))
-                                image.verify()
-                                image = Image.open(io.BytesIO(img_bytes))
-                                while not frame_queue.empty():
-                                    try:
-                                        frame_queue.get_nowait()
-                                        frame_queue.task_done()
-                                    except queue.Empty:
-                                        break
-                                frame_queue.put_nowait((image, None))
-                                logger.debug("Frame queued")
-                            except Exception as e:
-                                logger.error(f"Invalid image data: {e}")
-                                frame_queue.put_nowait((None, f"Invalid image data: {e}"))
-                                continue
-                        except base64.binascii.Error as e:
-                            logger.error(f"Base64 decode error: {e}")
-                            frame_queue.put_nowait((None, f"Base64 decode error: {e}"))
-                            continue
-                    except asyncio.TimeoutError:
-                        logger.warning("WebSocket receive timeout")
-                        continue
-                    except websockets.exceptions.ConnectionClosed as e:
-                        logger.error(f"WebSocket connection closed: {e}")
-                        break
-                    except Exception as e:
-                        logger.error(f"Error processing frame: {e}")
-                        frame_queue.put_nowait((None, f"Error processing frame: {e}"))
-                        continue
-        except Exception as e:
-            logger.error(f"WebSocket connection failed: {e}")
-            if st.session_state.get("stop_camera", False):
-                break
-            await asyncio.sleep(reconnect_delay)
-            reconnect_delay = min(reconnect_delay * 2, max_reconnect_delay)
-            logger.info(f"Attempting to reconnect in {reconnect_delay} seconds...")
-
-def run_websocket_loop(websocket_uri, frame_queue):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(receive_frame(websocket_uri, frame_queue))
-    except Exception as e:
-        logger.error(f"Websocket loop error: {e}")
-    finally:
-        loop.close()
+def update_ui(placeholder, live_hub):
+    seq, jpeg, error = live_hub.read(st.session_state.viewer_id)
+    if error:
+        placeholder.error(error)
+    elif jpeg:
+        # Bytes JPEG asli langsung dikirim ke browser, tanpa decode dan encode ulang
+        placeholder.image(jpeg, output_format="JPEG", caption="Live Feed")
+        if seq != st.session_state.get("last_frame_seq"):
+            st.session_state.last_frame_seq = seq
+            st.session_state.frame_counter += 1
+    else:
+        placeholder.write("No frames received yet...")
 
-def update_ui(placeholder, frame_queue):
-    try:
-        if not frame_queue.empty():
-            image, error = frame_queue.get_nowait()
-            if error:
-                placeholder.error(error)
-            elif image:
-                st.session_state.last_frame = image
-                placeholder.image(image, channels="RGB", caption="Live Feed")
-                st.session_state.frame_counter += 1
-            frame_queue.task_done()
-        elif "last_frame" in st.session_state:
-            placeholder.image(st.session_state.last_frame, channels="RGB", caption="Live Feed")
-        else:
-            placeholder.write("No frames received yet...")
-    except queue.Empty:
-        if "last_frame" in st.session_state:
-            placeholder.image(st.session_state.last_frame, channels="RGB", caption="Live Feed")
-        else:
-            placeholder.write("No frames received yet...")
+# Hanya fragment ini yang dijalankan ulang setiap frame, bukan seluruh script
+@st.fragment(run_every=1 / LIVE_FPS)
+def live_feed():
+    live_hub = get_live_hub()
+    update_ui(st.empty(), live_hub)
+    hub_stats = live_hub.stats()
+    st.caption(f"{'Terhubung' if hub_stats['connected'] else 'Tidak terhubung'} ke detector · "
+               f"{hub_stats['viewers']} viewer")
 
 # Fungsi Speaker Config
 def display_notification(placeholder, notification_key):
@@ -231,14 +165,21 @@ def display_notification(placeholder, notification_key):
         else:
             del st.session_state[notification_key]
 
+def speaker_notification(result, success_text, error_text):
+    """
+    Notifikasi hasil perintah speaker, dengan jumlah speaker yang mengonfirmasi.
+    """
+    if result["success"]:
+        if result["total"] > 1:
+            success_text += f" ({result['acked']}/{result['total']} speaker)"
+        return success_text, "success", time.time()
+    return f"{error_text} {result['message']}", "error", time.time()
+
 def play_test_sound():
     if st.session_state.mqtt_client:
-        result = st.session_state.mqtt_client.publish_play_sound()
-        st.session_state.play_notification = (
-            "Playing test sound." if result["success"] else "Failed to play test sound.",
-            "success" if result["success"] else "error",
-            time.time()
-        )
+        result = st.session_state.mqtt_client.publish_play_sound(target=st.session_state.get("speaker_target"))
+        st.session_state.play_notification = speaker_notification(result, "Playing test sound.",
+                                                                          "Failed to play test sound.")
     else:
         st.session_state.play_notification = (
             "MQTT client not initialized.",
@@ -248,12 +189,9 @@ def play_test_sound():
 
 def stop_test_sound():
     if st.session_state.mqtt_client:
-        result = st.session_state.mqtt_client.publish_stop_sound()
-        st.session_state.stop_notification = (
-            "Stopping test sound." if result["success"] else "Failed to stop test sound.",
-            "success" if result["success"] else "error",
-            time.time()
-        )
+        result = st.session_state.mqtt_client.publish_stop_sound(target=st.session_state.get("speaker_target"))
+        st.session_state.stop_notification = speaker_notification(result, "Stopping test sound.",
+                                                                          "Failed to stop test sound.")
     else:
         st.session_state.stop_notification = (
             "MQTT client not initialized.",
@@ -264,12 +202,9 @@ def stop_test_sound():
 def set_volume():
     if st.session_state.mqtt_client:
         volume = st.session_state.volume_slider
-        result = st.session_state.mqtt_client.publish_set_volume_speaker(volume)
-        st.session_state.volume_notification = (
-            f"Volume set to {volume}." if result["success"] else "Failed to set volume.",
-            "success" if result["success"] else "error",
-            time.time()
-        )
+        result = st.session_state.mqtt_client.publish_set_volume_speaker(volume, target=st.session_state.get("speaker_target"))
+        st.session_state.volume_notification = speaker_notification(result, f"Volume set to {volume}.",
+                                                                            "Failed to set volume.")
         st.session_state.ubidots_client.send_data({
             "speaker_volume": volume
         })
@@ -283,12 +218,9 @@ def set_volume():
 def set_sound_file():
     if st.session_state.mqtt_client:
         sound_file = st.session_state.sound_file_number
-        result = st.session_state.mqtt_client.publish_set_default_sound(sound_file)
-        st.session_state.set_sound_notification = (
-            f"Sound file set to {sound_file}." if result["success"] else "Failed to set sound file.",
-            "success" if result["success"] else "error",
-            time.time()
-        )
+        result = st.session_state.mqtt_client.publish_set_default_sound(sound_file, target=st.session_state.get("speaker_target"))
+        st.session_state.set_sound_notification = speaker_notification(result, f"Sound file set to {sound_file}.",
+                                                                               "Failed to set sound file.")
         st.session_state.ubidots_client.send_data({
             "current_audio": sound_file
         })
@@ -302,12 +234,9 @@ def set_sound_file():
 def play_sound_file():
     if st.session_state.mqtt_client:
         sound_file = st.session_state.play_sound_file_number
-        result = st.session_state.mqtt_client.publish_play_sound_file(sound_file)
-        st.session_state.play_file_notification = (
-            f"Playing sound file {sound_file}." if result["success"] else "Failed to play sound file.",
-            "success" if result["success"] else "error",
-            time.time()
-        )
+        result = st.session_state.mqtt_client.publish_play_sound_file(sound_file, target=st.session_state.get("speaker_target"))
+        st.session_state.play_file_notification = speaker_notification(result, f"Playing sound file {sound_file}.",
+                                                                               "Failed to play sound file.")
     else:
         st.session_state.play_file_notification = (
             "MQTT client not initialized.",
@@ -326,14 +255,13 @@ if "start_camera" not in st.session_state:
     st.session_state.start_camera = False
 if "stop_camera" not in st.session_state:
     st.session_state.stop_camera = False
-if "frame_queue" not in st.session_state:
-    st.session_state.frame_queue = queue.Queue(maxsize=10)
+if "viewer_id" not in st.session_state:
+    st.session_state.viewer_id = uuid.uuid4().hex
 if "frame_counter" not in st.session_state:
     st.session_state.frame_counter = 0
 
 # **************** Variable ***************
 wifi_ip = get_wifi_ip()
-websocket_uri = "ws://localhost:8765"
 
 if "ubidots_client" not in st.session_state:
     st.session_state.ubidots_client = ubidots(
@@ -341,19 +269,14 @@ if "ubidots_client" not in st.session_state:
         device_label=DEVICE_ID
     )
 
-# Inisiasi MQTT Client dengan Client ID unik
+# Handle MQTT per session di atas koneksi bersama
 if "mqtt_client" not in st.session_state or st.session_state.mqtt_client is None:
-    cleanup_mqtt_client()  # Bersihkan instance lama
     try:
         if not all([BROKER, PORT, USERNAME, PASSWORD]):
             logger.error("Missing MQTT credentials")
             st.error("Konfigurasi MQTT tidak lengkap. Periksa file .env.")
             raise ValueError("Incomplete MQTT configuration")
-        # Tambahkan Client ID unik ke logger untuk tracking
-        client_id = f"dashboard-{uuid.uuid4()}"
-        logger.info("Initializing MQTT client with Client ID: %s", client_id)
-        st.session_state.mqtt_client = MyMQTTClient(BROKER, int(PORT), USERNAME, PASSWORD)
-        logger.info("MQTT client initialized successfully")
+        st.session_state.mqtt_client = MyMQTTClient(get_mqtt_connection(), SPEAKER_REGISTRY)
     except Exception as e:
         logger.error("Failed to initialize MQTT client: %s", e)
         st.error(f"Gagal menginisiasi koneksi MQTT: {e}")
@@ -378,6 +301,17 @@ with st.sidebar:
     sidebar_button("Live Cam")
     sidebar_button("Speaker Config")
     sidebar_button("Camera Config")
+    # Status koneksi MQTT, reconnect berjalan di background
+    if st.session_state.mqtt_client:
+        mqtt_stats = st.session_state.mqtt_client.stats()
+        status = f"MQTT: {mqtt_stats['state']}"
+        if mqtt_stats["reconnects"]:
+            status += f" · {mqtt_stats['reconnects']} reconnect, terakhir {mqtt_stats['last_reconnect_seconds']:.1f} s"
+        if mqtt_stats["buffered"]:
+            status += f" · {mqtt_stats['buffered']} pesan antre"
+        if mqtt_stats["in_flight"]:
+            status += f" · {mqtt_stats['in_flight']} menunggu PUBACK"
+        st.caption(status)
 
 # *************** MAIN AREA ***************
 st.title("Smart Farmer Dashboard")
@@ -395,31 +329,18 @@ elif selected == "Live Cam":
         st.button("Start Camera", key="start_camera_button", on_click=start_camera)
     with col2:
         st.button("Stop Camera", key="stop_camera_button", on_click=stop_camera)
-    placeholder = st.empty()
 
     if st.session_state.start_camera and not st.session_state.get("stop_camera", False):
-        if "websocket_thread" not in st.session_state or not st.session_state.websocket_thread.is_alive():
-            st.session_state.frame_queue = queue.Queue(maxsize=10)
-            st.session_state.websocket_thread = threading.Thread(
-                target=run_websocket_loop,
-                args=(websocket_uri, st.session_state.frame_queue),
-                daemon=True
-            )
-            st.session_state.websocket_thread.start()
-            logger.info("WebSocket thread started")
-        
-        update_ui(placeholder, st.session_state.frame_queue)
-        
-        if not st.session_state.get("stop_camera", False):
-            time.sleep(0.2)
-            st.rerun()
-
+        live_feed()
     else:
-        placeholder.write("Camera feed stopped.")
+        st.write("Camera feed stopped.")
 
 elif selected == "Speaker Config":
     st.subheader("🔊 Speaker Configuration")
     
+    # Tujuan perintah: satu sawah, satu speaker atau semua speaker
+    st.selectbox("Target speaker", SPEAKER_REGISTRY.groups(), key="speaker_target")
+
     # Speaker Test
     st.write("## Speaker Test")
     play_placeholder = st.empty()
@@ -452,6 +373,13 @@ elif selected == "Speaker Config":
     st.number_input("Sound File Number", 0, 100, 1, key="play_sound_file_number")
     st.button("Play Sound File", key="play_sound_file_button", on_click=play_sound_file)
 
+    # Latensi publish sampai PUBACK per topic dari koneksi MQTT bersama
+    if st.session_state.mqtt_client:
+        ack_rows = st.session_state.mqtt_client.ack_latency()
+        if ack_rows:
+            st.write("## MQTT Acknowledgements")
+            st.dataframe(pd.DataFrame(ack_rows), hide_index=True)
+
 elif selected == "Camera Config":
     if "camera_configuration" not in st.session_state:
         st.session_state.camera_configuration = {}
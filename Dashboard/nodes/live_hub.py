@@ -0,0 +1,141 @@
+import json
+import time
+import base64
+import asyncio
+import logging
+import threading
+import websockets
+from utils.frames import FrameSlot, is_jpeg, overlay_jpeg
+
+logger = logging.getLogger(__name__)
+
+
+class LiveHub:
+    """
+    One WebSocket subscription to the detector per Streamlit server process.
+    A single background thread receives the frames and detection metadata
+    and keeps the newest frame in a FrameSlot; every session reads the same
+    bytes object from it, so neither threads nor frame copies grow with the
+    number of viewers.
+
+    Sessions register as viewers by reading. Without a read for
+    idle_timeout seconds the hub closes the upstream connection and opens it
+    again when the next viewer reads.
+    """
+    def __init__(self, uri, idle_timeout=30, max_reconnect_delay=30):
+        """
+        :param uri: WebSocket URI of the detector, e.g. "ws://localhost:8765/live"
+        :param idle_timeout: Seconds without any read after which the connection is closed
+        :param max_reconnect_delay: Upper bound of the reconnect delay in seconds
+        """
+        self.uri = uri
+        self.idle_timeout = idle_timeout
+        self.max_reconnect_delay = max_reconnect_delay
+        self.slot = FrameSlot()
+        self.record = None
+        self.connected = False
+        self.frames = 0
+        self.connects = 0
+        self._viewers = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="live-hub")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self, timeout=5):
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def read(self, viewer):
+        """
+        Newest frame for a viewer, registers the viewer as active.
+            :param viewer: Id of the session
+            :return: Tuple (seq, JPEG bytes or None, error message or None)
+        """
+        with self._lock:
+            self._viewers[viewer] = time.time()
+        return self.slot.get()
+
+    def leave(self, viewer):
+        with self._lock:
+            self._viewers.pop(viewer, None)
+
+    def viewers(self):
+        """
+        :return: Number of sessions that read within idle_timeout
+        """
+        expire = time.time() - self.idle_timeout
+        with self._lock:
+            for viewer in [viewer for viewer, last in self._viewers.items() if last < expire]:
+                del self._viewers[viewer]
+            return len(self._viewers)
+
+    def stats(self):
+        return {"connected": self.connected, "viewers": self.viewers(), "frames": self.frames,
+                "connects": self.connects}
+
+    def _run(self):
+        try:
+            asyncio.run(self._receive())
+        except Exception as e:
+            logger.error(f"Live hub loop error: {e}")
+
+    async def _receive(self):
+        reconnect_delay = 1
+        while not self._stopped.is_set():
+            if not self.viewers():
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                async with websockets.connect(self.uri, ping_interval=10, ping_timeout=20) as websocket:
+                    logger.info("Live hub connected to %s", self.uri)
+                    self.connected = True
+                    self.connects += 1
+                    reconnect_delay = 1
+                    await self._receive_frames(websocket)
+                    logger.info("Live hub closed the connection, no viewers left")
+            except Exception as e:
+                logger.error(f"Live hub connection failed: {e}")
+                self.slot.put(error=f"WebSocket connection failed: {e}")
+                await asyncio.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, self.max_reconnect_delay)
+            finally:
+                self.connected = False
+
+    async def _receive_frames(self, websocket):
+        detection_record = None
+        while not self._stopped.is_set() and self.viewers():
+            try:
+                data = await asyncio.wait_for(websocket.recv(), timeout=10)
+            except asyncio.TimeoutError:
+                logger.warning("WebSocket receive timeout")
+                continue
+            if not data:
+                continue
+            if isinstance(data, str) and data.startswith("{"):
+                # Metadata deteksi dikirim sebelum frame-nya
+                detection_record = json.loads(data)
+                continue
+            try:
+                # The detector sends binary JPEG frames, older versions send base64 text
+                jpeg = data if isinstance(data, bytes) else base64.b64decode(data)
+            except base64.binascii.Error as e:
+                logger.error(f"Base64 decode error: {e}")
+                self.slot.put(error=f"Base64 decode error: {e}")
+                continue
+            if not is_jpeg(jpeg):
+                logger.warning("Received data is not a complete JPEG frame")
+                continue
+            try:
+                # The overlay is drawn once here for all viewers
+                self.slot.put(overlay_jpeg(jpeg, detection_record))
+            except Exception as e:
+                logger.error(f"Invalid image data: {e}")
+                self.slot.put(error=f"Invalid image data: {e}")
+                continue
+            self.record = detection_record
+            self.frames += 1
+            detection_record = None
@@ -1,9 +1,14 @@
-import time
-import paho.mqtt.client as paho
-from paho import mqtt
 import os
-from dotenv import load_dotenv
+import time
+import uuid
+import socket
 import logging
+from collections import deque
+from concurrent.futures import wait
+from dotenv import load_dotenv
+from common.histograms import bucket_quantile
+from common.mqtt_connection import MqttConnection
+from common.mqtt_topics import TopicRegistry
 
 # Konfigurasi logger
 logging.basicConfig(
@@ -18,155 +23,124 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-class MyMQTTClient:
-    def __init__(self, broker, port, username, password):
-        self.broker = broker
-        self.port = port
-        self.username = username
-        self.password = password
-        self.client = self.connect_mqtt()
-        self.client.loop_start()
-        self.timer = time.time()
-        self.max_time = 5
-
-    def connect_mqtt(self):
-        def on_connect(client, userdata, flags, rc, properties=None):
-            if rc == 0:
-                logger.info("Connected to MQTT broker with code %s", rc)
-            else:
-                logger.error("CONNACK received with code %s", rc)
-
-        def on_publish(client, userdata, mid, properties=None):
-            logger.debug("Published message with mid: %s", mid)
-
-        def on_subscribe(client, userdata, mid, granted_qos, properties=None):
-            logger.info("Subscribed: mid=%s, granted_qos=%s", mid, granted_qos)
-
-        def on_message(client, userdata, msg):
-            logger.info("Received message: topic=%s, qos=%s, payload=%s", 
-                       msg.topic, msg.qos, msg.payload.decode())
-
-        def on_disconnect(client, userdata, rc, properties=None):
-            FIRST_RECONNECT_DELAY = 1
-            RECONNECT_RATE = 2
-            MAX_RECONNECT_COUNT = 12
-            MAX_RECONNECT_DELAY = 60
-            logger.warning("Disconnected with result code: %s", rc)
-            reconnect_count, reconnect_delay = 0, FIRST_RECONNECT_DELAY
-            while reconnect_count < MAX_RECONNECT_COUNT:
-                logger.info("Reconnecting in %d seconds...", reconnect_delay)
-                time.sleep(reconnect_delay)
-
-                try:
-                    client.reconnect()
-                    logger.info("Reconnected successfully!")
-                    return
-                except Exception as err:
-                    logger.error("Reconnect failed: %s. Retrying...", err)
+def create_connection(broker, port, username, password, client_id=None):
+    """
+    Open the MQTT connection shared by all sessions of the Streamlit server.
+        :param client_id: MQTT client id, defaults to a unique "dashboard-<host>-<pid>-<random>"
+        :return: Started MqttConnection
+    """
+    if client_id is None:
+        # Client id tetap "dashboard" membuat beberapa server saling memutus koneksi
+        client_id = f"dashboard-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    logger.info("Opening shared MQTT connection with Client ID: %s", client_id)
+    return MqttConnection(broker, port, username, password, client_id=client_id).start()
 
-                reconnect_delay *= RECONNECT_RATE
-                reconnect_delay = min(reconnect_delay, MAX_RECONNECT_DELAY)
-                reconnect_count += 1
-            logger.critical("Reconnect failed after %s attempts. Exiting...", reconnect_count)
 
-        client = paho.Client(client_id="dashboard", userdata=None, protocol=paho.MQTTv5)
-        client.on_connect = on_connect
-
-        # Enable TLS for secure connection
-        client.tls_set(tls_version=mqtt.client.ssl.PROTOCOL_TLS)
-        # Set username and password
-        client.username_pw_set(self.username, self.password)
-        # Connect to broker
-        try:
-            client.connect(self.broker, int(self.port))
-            logger.info("Initiated connection to broker %s:%s", self.broker, self.port)
-        except Exception as e:
-            logger.error("Failed to connect to broker: %s", e)
-            raise
-
-        # Setting callbacks
-        client.on_subscribe = on_subscribe
-        client.on_message = on_message
-        client.on_publish = on_publish
-        return client
-
-    def publish_play_sound(self):
-        topic = "control/sawah1/mp3player/play"
-        payload = "{\"action\": \"play sound test\"}"
-        try:
-            result = self.client.publish(topic, payload, qos=1)
-            self.timer = time.time()
-            status = result[0]
-            if status == 0:
-                logger.info("Successfully published to %s", topic)
-                return {"success": True, "message": "Success play test sound"}
-            else:
-                logger.error("Failed to publish to %s, status: %s", topic, status)
-                return {"success": False, "message": "Failed to send message to topic " + topic}
-        except Exception as e:
-            logger.error("Error publishing to %s: %s", topic, e)
-            return {"success": False, "message": "Error publishing message"}
-        
-    def publish_stop_sound(self):
-        topic = "control/sawah1/mp3player/stop"
-        payload = "{\"action\": \"stop sound\"}"
-        try:
-            result = self.client.publish(topic, payload, qos=1)
-            status = result[0]
-            if status == 0:
-                logger.info("Successfully stopped sound")
-                return {"success": True, "message": "Success stop sound"}
-            else:
-                logger.error("Failed to publish to %s, status: %s", topic, status)
-                return {"success": False, "message": "Failed to send message to topic " + topic}
-        except Exception as e:
-            logger.error("Error publishing to %s: %s", topic, e)
-            return {"success": False, "message": "Error publishing message"}
-
-    def publish_set_default_sound(self, filenumber):
-        topic = "setting/sawah1/mp3player/default_filenumber"
-        payload = "{\"filenumber\":%d}" % filenumber
-        try:
-            result = self.client.publish(topic, payload, qos=1)
-            status = result[0]
-            if status == 0:
-                logger.info("Successfully set default sound to filenumber %d", filenumber)
-                return {"success": True, "message": "Success set default sound"}
-            else:
-                logger.error("Failed to publish to %s, status: %s", topic, status)
-                return {"success": False, "message": "Failed to send message to topic " + topic}
-        except Exception as e:
-            logger.error("Error publishing to %s: %s", topic, e)
-            return {"success": False, "message": "Error publishing message"}
-
-    def publish_set_volume_speaker(self, volume):
-        topic = "control/sawah1/mp3player/set_volume"
-        payload = "{\"value\":%d}" % volume
-        try:
-            result = self.client.publish(topic, payload, qos=1)
-            status = result[0]
-            if status == 0:
-                logger.info("Successfully set volume to %d", volume)
-                return {"success": True, "message": "Success set volume speaker"}
-            else:
-                logger.error("Failed to publish to %s, status: %s", topic, status)
-                return {"success": False, "message": "Failed to send message to topic " + topic}
-        except Exception as e:
-            logger.error("Error publishing to %s: %s", topic, e)
-            return {"success": False, "message": "Error publishing message"}
-
-    def publish_play_sound_file(self, filenumber):
-        topic = "control/sawah1/mp3player/play"
-        payload = "{\"action\": \"play sound file\", \"filenumber\":%d}" % filenumber
-        try:
-            result = self.client.publish(topic, payload, qos=1)
-            status = result[0]
-            if status == 0:
-                logger.info("Successfully played sound file %d", filenumber)
-                return {"success": True, "message": "Success play sound with file number " + str(filenumber)}
+class MyMQTTClient:
+    """
+    Handle of one Streamlit session on the shared MqttConnection. Creating a
+    handle costs no broker connection; publishing from several sessions at
+    the same time is safe. Every handle keeps the results of its own commands.
+
+    A command goes to a target group of the TopicRegistry (a field, one
+    speaker or all speakers): all QoS 1 messages are published back to back
+    and their PUBACK futures are awaited together, so a command only reports
+    success when the broker acknowledged every message.
+    """
+    def __init__(self, connection, registry=None, ack_timeout=2.0):
+        """
+        :param connection: Shared MqttConnection, see create_connection
+        :param registry: TopicRegistry of the fields and speakers, defaults to sawah1/mp3player
+        :param ack_timeout: Seconds to wait for the PUBACKs of a command
+        """
+        self.connection = connection
+        self.registry = registry or TopicRegistry()
+        self.ack_timeout = ack_timeout
+        self.results = deque(maxlen=50)
+
+    def stats(self):
+        return self.connection.stats()
+
+    def publish_command(self, command, target=None, success_message="Success", **params):
+        """
+        Publish a command to every speaker of the target group.
+            :param command: Command name of the TopicRegistry, e.g. "play" or "set_volume"
+            :param target: Target group, see TopicRegistry.resolve
+            :param success_message: Message of the result when every speaker acknowledged
+            :param params: Parameters of the payload template, e.g. value=20
+            :return: Dict with success, message, total, acked, queued and failed (topics)
+        """
+        payload = self.registry.payload(command, **params)
+        topics = [self.registry.topic(field, speaker, command) for field, speaker in self.registry.resolve(target)]
+        futures = []
+        failed = []
+        # Semua pesan dikirim dulu, baru menunggu PUBACK, jadi waktu tunggu satu round trip
+        for topic in topics:
+            try:
+                futures.append(self.connection.publish(topic, payload, qos=1))
+            except Exception as e:
+                logger.error("Error publishing to %s: %s", topic, e)
+                failed.append(topic)
+        # Pesan yang di-buffer juga bisa selesai jika broker tersambung kembali sebelum timeout
+        wait(futures, timeout=self.ack_timeout)
+        acked = 0
+        queued = 0
+        for future in futures:
+            if future.done() and future.exception() is None:
+                acked += 1
+            elif future.buffered and future.sent_at is None:
+                queued += 1
             else:
-                logger.error("Failed to publish to %s, status: %s", topic, status)
-                return {"success": False, "message": "Failed to send message to topic " + topic}
-        except Exception as e:
-            logger.error("Error publishing to %s: %s", topic, e)
-            return {"success": False, "message": "Error publishing message"}
\ No newline at end of file
+                if future.done():
+                    logger.error("Publish to %s failed: %s", future.topic, future.exception())
+                failed.append(future.topic)
+        result = self._result(command, success_message, len(topics), acked, queued, failed)
+        self.results.append((time.time(), command, target, result))
+        return result
+
+    def _result(self, command, success_message, total, acked, queued, failed):
+        result = {"success": acked == total, "total": total, "acked": acked, "queued": queued, "failed": failed}
+        if acked == total:
+            result["message"] = success_message
+            logger.info("%s acknowledged by %d speakers", command, acked)
+        elif queued and not failed:
+            result["message"] = f"Queued for {queued} speakers until MQTT reconnects"
+            logger.warning("%s queued for %d speakers, MQTT disconnected", command, queued)
+        else:
+            result["message"] = f"No acknowledgement from {len(failed)} of {total} speakers: {', '.join(failed)}"
+            logger.error("%s not acknowledged by %s", command, failed)
+        return result
+
+    def ack_latency(self):
+        """
+        Publish-to-ack latency of every topic of the shared connection.
+            :return: List of dicts with topic, acked, in_flight, p50_ms and p95_ms
+        """
+        rows = []
+        for topic, stats in sorted(self.connection.ack_stats().items()):
+            p50 = bucket_quantile(stats["buckets"], stats["counts"], 0.5)
+            p95 = bucket_quantile(stats["buckets"], stats["counts"], 0.95)
+            rows.append({
+                "topic": topic,
+                "acked": stats["count"],
+                "in_flight": stats["in_flight"],
+                "p50_ms": None if p50 is None else round(p50 * 1000, 1),
+                "p95_ms": None if p95 is None else round(p95 * 1000, 1),
+            })
+        return rows
+
+    def publish_play_sound(self, target=None):
+        return self.publish_command("play", target, "Success play test sound")
+
+    def publish_stop_sound(self, target=None):
+        return self.publish_command("stop", target, "Success stop sound")
+
+    def publish_set_default_sound(self, filenumber, target=None):
+        return self.publish_command("set_default_sound", target, "Success set default sound", filenumber=filenumber)
+
+    def publish_set_volume_speaker(self, volume, target=None):
+        return self.publish_command("set_volume", target, "Success set volume speaker", value=volume)
+
+    def publish_play_sound_file(self, filenumber, target=None):
+        return self.publish_command("play_file", target, "Success play sound with file number " + str(filenumber),
+                                    filenumber=filenumber)
@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+from PIL import ImageDraw
 
 def display_dict_to_ui(data_dict, title="Dictionary Data", expandable=True):
     """
@@ -54,4 +55,27 @@ def _render_dict(data_dict):
                 </div>
                 """,
                 unsafe_allow_html=True
-            )
\ No newline at end of file
+            )
+
+def draw_detection_overlay(image, record, color=(0, 255, 0)):
+    """
+    Menggambar kotak deteksi dari metadata detector di atas frame
+
+    Parameters:
+    - image: PIL Image dari frame kamera
+    - record: Dictionary metadata deteksi (boxes, scores, track_ids, width, height)
+    - color: Warna kotak dan label
+    """
+    if not record or not record.get("boxes"):
+        return image
+    # Koordinat kotak mengikuti ukuran frame di detector
+    sx = image.width / record.get("width", image.width)
+    sy = image.height / record.get("height", image.height)
+    track_ids = record.get("track_ids") or [None] * len(record["boxes"])
+    draw = ImageDraw.Draw(image)
+    for (x1, y1, x2, y2), score, track_id in zip(record["boxes"], record["scores"], track_ids):
+        box = (x1 * sx, y1 * sy, x2 * sx, y2 * sy)
+        label = f"bird {score:.2f}" if track_id is None else f"#{track_id} bird {score:.2f}"
+        draw.rectangle(box, outline=color, width=2)
+        draw.text((box[0], max(0, box[1] - 12)), label, fill=color)
+    return image
@@ -0,0 +1,57 @@
+import io
+import threading
+from PIL import Image
+from utils.display import draw_detection_overlay
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+
+
+def is_jpeg(data):
+    """
+    Cek cepat frame JPEG dari marker SOI di awal dan EOI di akhir, tanpa decode
+    (beberapa encoder menambahkan padding setelah EOI)
+    """
+    return len(data) > 100 and data[:2] == JPEG_SOI and JPEG_EOI in data[-32:]
+
+
+def overlay_jpeg(jpeg, record, quality=85):
+    """
+    Menggambar kotak deteksi di atas frame JPEG
+
+    Parameters:
+    - jpeg: Bytes JPEG dari detector
+    - record: Dictionary metadata deteksi, frame tanpa kotak atau yang sudah digambar detector
+      dikembalikan apa adanya
+    - quality: Kualitas JPEG hasil encode ulang
+    """
+    if not record or not record.get("boxes") or record.get("annotated"):
+        return jpeg
+    # Hanya frame dengan deteksi yang di-decode dan di-encode ulang
+    image = draw_detection_overlay(Image.open(io.BytesIO(jpeg)).convert("RGB"), record)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class FrameSlot:
+    """
+    Buffer satu slot untuk frame terbaru: thread WebSocket menimpa frame lama,
+    UI selalu membaca frame terbaru tanpa antrean frame basi.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seq = 0
+        self.jpeg = None
+        self.error = None
+
+    def put(self, jpeg=None, error=None):
+        with self._lock:
+            self.seq += 1
+            self.jpeg = jpeg if jpeg is not None else self.jpeg
+            self.error = error
+
+    def get(self):
+        """Mengembalikan tuple (seq, bytes JPEG atau None, pesan error atau None)"""
+        with self._lock:
+            return self.seq, self.jpeg, self.error
@@ -0,0 +1,4 @@
+"""
+Modules shared by the detector (BirdDetection) and the Dashboard. Both apps
+put the repository root on sys.path in their entry module.
+"""
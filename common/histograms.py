@@ -0,0 +1,21 @@
+def bucket_quantile(buckets, counts, q):
+    """
+    Estimate a quantile from per-bucket counts by linear interpolation inside the bucket.
+        :param buckets: Upper bounds of the buckets
+        :param counts: Per-bucket counts, one more than buckets for values above the largest bucket
+        :param q: Quantile (0-1)
+        :return: Estimated value, None without observations
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if index == len(buckets):
+                return buckets[-1]
+            lower = buckets[index - 1] if index else 0.0
+            return lower + (buckets[index] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
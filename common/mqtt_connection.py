@@ -0,0 +1,342 @@
+import time
+import bisect
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+import paho.mqtt.client as paho
+from .histograms import bucket_quantile
+
+logger = logging.getLogger(__name__)
+
+# Used by BirdDetection (paho-mqtt 1.6) and the Dashboard (paho-mqtt 2.x)
+
+# Upper bounds of the publish-to-ack latency buckets in seconds
+ACK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _code(rc):
+    # paho passes plain ints or ReasonCode objects depending on the version and protocol
+    return getattr(rc, "value", rc)
+
+
+class PublishError(RuntimeError):
+    """
+    The message could not be handed to paho, e.g. the outgoing queue is full.
+    """
+
+
+class PublishFuture(Future):
+    """
+    Future of one publish. It resolves with the publish-to-ack latency in
+    seconds when the broker acknowledged the message (QoS 0: right after it
+    was handed to paho), and fails with PublishError or TimeoutError.
+    """
+    def __init__(self, topic, qos):
+        super().__init__()
+        self.topic = topic
+        self.qos = qos
+        self.mid = None
+        self.buffered = False
+        self.sent_at = None
+
+
+class AckHistogram:
+    """
+    Publish-to-ack latencies of one topic with fixed buckets.
+    """
+    def __init__(self, buckets=ACK_BUCKETS):
+        self.buckets = buckets
+        # The last slot counts the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        return bucket_quantile(self.buckets, self.counts, q)
+
+
+class MqttConnection:
+    """
+    MQTT connection with its own network thread. The thread drives the paho
+    loop and reconnects with jittered exponential backoff, so a broker outage
+    never blocks the callers: while disconnected, publish() puts the messages
+    into a bounded buffer that is sent after the next CONNACK, dropping the
+    oldest messages when it is full. Subscriptions are renewed on every connect.
+
+    Every publish returns a PublishFuture that resolves on the PUBACK. The
+    connection keeps per-topic histograms of the publish-to-ack latency and
+    fails the futures of messages not acknowledged within ack_timeout.
+    """
+    def __init__(self, broker, port, username=None, password=None, client_id="", tls=True, keepalive=60,
+                 protocol=paho.MQTTv5, max_buffer=100, min_delay=1.0, max_delay=60.0, ack_timeout=30.0):
+        """
+        :param broker: Broker host
+        :param port: Broker port
+        :param username: Broker username, None without authentication
+        :param password: Broker password
+        :param client_id: MQTT client id, must be unique per connection
+        :param tls: Connect with TLS
+        :param keepalive: Keepalive interval in seconds
+        :param protocol: MQTT protocol version, paho.MQTTv5 or paho.MQTTv311
+        :param max_buffer: Messages kept while disconnected
+        :param min_delay: First reconnect delay in seconds
+        :param max_delay: Upper bound of the reconnect delay in seconds
+        :param ack_timeout: Seconds after which an unacknowledged message counts as lost
+        """
+        self.broker = broker
+        self.port = int(port)
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.ack_timeout = ack_timeout
+        self.connected = False
+        self.connects = 0
+        self.reconnects = 0
+        self.disconnects = 0
+        self.messages_buffered = 0
+        self.messages_dropped = 0
+        self.messages_acked = 0
+        self.ack_timeouts = 0
+        self.last_reconnect_seconds = 0.0
+        self.ack_latency = {}
+        self.message_callbacks = []
+        self.subscriptions = {}
+        self._buffer = deque()
+        self._max_buffer = max_buffer
+        self._lock = threading.Lock()
+        # mid -> PublishFuture until the PUBACK arrives; acks that arrive before
+        # publish() returned are parked in _early_acks
+        self._in_flight = {}
+        self._early_acks = {}
+        self._ack_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._disconnected_at = time.time()
+        self._attempt = 0
+
+        if hasattr(paho, "CallbackAPIVersion"):
+            self.client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=protocol)
+        else:
+            self.client = paho.Client(client_id=client_id, protocol=protocol)
+        if tls:
+            self.client.tls_set()
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_message = self._on_message
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"mqtt-{client_id or 'client'}")
+
+    def start(self):
+        """
+        Start the network thread, the first connection is made in the background.
+        """
+        self._thread.start()
+        return self
+
+    def close(self, timeout=5):
+        self._stopped.set()
+        try:
+            self.client.disconnect()
+        except Exception as e:
+            logger.debug("MQTT disconnect failed: %s", e)
+        self._thread.join(timeout)
+
+    @property
+    def state(self):
+        if self._stopped.is_set():
+            return "closed"
+        return "connected" if self.connected else "disconnected"
+
+    def publish(self, topic, payload, qos=1, retain=False, buffer=True):
+        """
+        Publish a message, or buffer it while the broker is not connected.
+            :param buffer: False fails the message right away while disconnected instead of sending it
+                           after the reconnect, for commands that are useless when late
+            :return: PublishFuture, resolves with the ack latency in seconds
+        """
+        future = PublishFuture(topic, qos)
+        with self._lock:
+            if not self.connected:
+                if not buffer:
+                    future.set_exception(PublishError("MQTT is disconnected"))
+                    return future
+                if len(self._buffer) >= self._max_buffer:
+                    dropped = self._buffer.popleft()[-1]
+                    dropped.set_exception(PublishError("Dropped from the full offline buffer"))
+                    self.messages_dropped += 1
+                future.buffered = True
+                self._buffer.append((topic, payload, qos, retain, future))
+                self.messages_buffered += 1
+                return future
+        self._send(topic, payload, qos, retain, future)
+        return future
+
+    def _send(self, topic, payload, qos, retain, future):
+        future.sent_at = time.time()
+        try:
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        except ValueError as e:
+            future.set_exception(PublishError(f"{e}"))
+            return
+        # Not connected or queued by paho, QoS 1/2 messages are still sent on reconnect
+        if info.rc not in (paho.MQTT_ERR_SUCCESS, paho.MQTT_ERR_NO_CONN):
+            future.set_exception(PublishError(paho.error_string(info.rc)))
+            return
+        if qos == 0:
+            future.set_result(0.0)
+            return
+        future.mid = info.mid
+        with self._ack_lock:
+            acked_at = self._early_acks.pop(info.mid, None)
+            if acked_at is None:
+                self._in_flight[info.mid] = future
+        if acked_at is not None:
+            self._acked(future, acked_at)
+
+    def _acked(self, future, acked_at):
+        latency = max(acked_at - future.sent_at, 0.0)
+        with self._ack_lock:
+            histogram = self.ack_latency.get(future.topic)
+            if histogram is None:
+                histogram = self.ack_latency[future.topic] = AckHistogram()
+            histogram.observe(latency)
+            self.messages_acked += 1
+        if not future.done():
+            future.set_result(latency)
+
+    def _expire_acks(self):
+        expire = time.time() - self.ack_timeout
+        with self._ack_lock:
+            expired = [mid for mid, future in self._in_flight.items() if future.sent_at < expire]
+            futures = [self._in_flight.pop(mid) for mid in expired]
+            self.ack_timeouts += len(futures)
+        for future in futures:
+            future.set_exception(TimeoutError(f"No PUBACK for {future.topic} within {self.ack_timeout:.0f} s"))
+
+    def subscribe(self, topic, qos=1):
+        self.subscriptions[topic] = qos
+        if self.connected:
+            self.client.subscribe(topic, qos)
+
+    def add_message_callback(self, callback):
+        """
+        Register a function called with every received paho message.
+        """
+        self.message_callbacks.append(callback)
+
+    def ack_stats(self):
+        """
+        :return: Dict topic -> dict with the publish-to-ack latency histogram (buckets, counts, sum,
+                 count) and the messages of the topic waiting for their PUBACK (in_flight)
+        """
+        with self._ack_lock:
+            stats = {topic: {"buckets": histogram.buckets, "counts": list(histogram.counts),
+                             "sum": histogram.sum, "count": histogram.count, "in_flight": 0}
+                     for topic, histogram in self.ack_latency.items()}
+            for future in self._in_flight.values():
+                topic_stats = stats.get(future.topic)
+                if topic_stats is None:
+                    topic_stats = stats[future.topic] = {"buckets": ACK_BUCKETS, "counts": [0] * (len(ACK_BUCKETS) + 1),
+                                                         "sum": 0.0, "count": 0, "in_flight": 0}
+                topic_stats["in_flight"] += 1
+            return stats
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "connected": self.connected,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "disconnects": self.disconnects,
+            "last_reconnect_seconds": self.last_reconnect_seconds,
+            "buffered": len(self._buffer),
+            "dropped": self.messages_dropped,
+            "in_flight": len(self._in_flight),
+            "acked": self.messages_acked,
+            "ack_timeouts": self.ack_timeouts,
+        }
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self.client.socket() is None:
+                try:
+                    self.client.connect(self.broker, self.port, self.keepalive)
+                except (OSError, ValueError) as e:
+                    self._backoff(f"{e}")
+                    continue
+            rc = self.client.loop(timeout=1.0)
+            self._expire_acks()
+            if rc != paho.MQTT_ERR_SUCCESS and not self._stopped.is_set():
+                self._set_disconnected()
+                self._backoff(paho.error_string(rc))
+
+    def _backoff(self, reason):
+        # Exponential delay with jitter, so many clients do not reconnect in lockstep
+        delay = min(self.min_delay * 2 ** self._attempt, self.max_delay)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self._attempt += 1
+        logger.warning("MQTT %s not connected (%s), retrying in %.1f s", self.client_id, reason, delay)
+        self._stopped.wait(delay)
+        self._expire_acks()
+
+    def _set_disconnected(self):
+        with self._lock:
+            if self.connected:
+                self.connected = False
+                self.disconnects += 1
+                self._disconnected_at = time.time()
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if _code(rc) != 0:
+            logger.error("MQTT %s connection refused: %s", self.client_id, rc)
+            return
+        for topic, qos in self.subscriptions.items():
+            client.subscribe(topic, qos)
+        with self._lock:
+            self.connected = True
+            self.connects += 1
+            if self.connects > 1:
+                self.reconnects += 1
+                self.last_reconnect_seconds = time.time() - self._disconnected_at
+            self._attempt = 0
+            buffered, self._buffer = self._buffer, deque()
+        if self.connects > 1:
+            logger.info("MQTT %s reconnected after %.1f s, sending %d buffered messages",
+                        self.client_id, self.last_reconnect_seconds, len(buffered))
+        else:
+            logger.info("MQTT %s connected to %s:%s", self.client_id, self.broker, self.port)
+        for topic, payload, qos, retain, future in buffered:
+            self._send(topic, payload, qos, retain, future)
+
+    def _on_disconnect(self, client, userdata, *args):
+        # paho 1.6: (rc, properties), paho 2.x: (flags, reason_code, properties)
+        rc = args[1] if len(args) == 3 else args[0]
+        self._set_disconnected()
+        if not self._stopped.is_set():
+            logger.warning("MQTT %s disconnected: %s", self.client_id, rc)
+
+    def _on_publish(self, client, userdata, mid, *args):
+        # Network thread, paho holds its outgoing message lock here
+        now = time.time()
+        with self._ack_lock:
+            future = self._in_flight.pop(mid, None)
+            if future is None:
+                self._early_acks[mid] = now
+                # QoS 0 messages are reported here too and never collected
+                if len(self._early_acks) > 1000:
+                    self._early_acks.pop(next(iter(self._early_acks)))
+        if future is not None:
+            self._acked(future, now)
+
+    def _on_message(self, client, userdata, message):
+        for callback in self.message_callbacks:
+            callback(message)
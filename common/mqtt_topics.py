@@ -0,0 +1,101 @@
+import json
+from functools import lru_cache
+
+DEFAULT_FIELD = "sawah1"
+DEFAULT_SPEAKER = "mp3player"
+
+# Command -> (topic prefix, topic suffix, payload template); the topic is
+# "<prefix>/<field>/<device>/<suffix>"; templates of commands with parameters use
+# str.format, the others are plain JSON
+COMMANDS = {
+    "play": ("control", "play", json.dumps({"action": "play sound test"})),
+    "stop": ("control", "stop", json.dumps({"action": "stop sound"})),
+    "play_file": ("control", "play", '{{"action": "play sound file", "filenumber":{filenumber:d}}}'),
+    "set_volume": ("control", "set_volume", '{{"value":{value:d}}}'),
+    "set_default_sound": ("setting", "default_filenumber", '{{"filenumber":{filenumber:d}}}'),
+}
+
+
+def parse_speakers(config):
+    """
+    Parse the speakers of every field, e.g. "sawah1:mp3player,mp3player2;sawah2:mp3player".
+    The format of DETERRENT_SPEAKERS for the detector and the Dashboard; a field without
+    speaker names ("sawah1:") is skipped and keeps the default speaker.
+        :param config: Speaker configuration string, empty for the single default speaker
+        :return: Dict field -> list of speaker names
+    """
+    speakers = {}
+    for entry in (config or "").split(";"):
+        if ":" not in entry:
+            continue
+        field, names = entry.split(":", 1)
+        names = [name.strip() for name in names.split(",") if name.strip()]
+        if names:
+            speakers[field.strip()] = names
+    return speakers or {DEFAULT_FIELD: [DEFAULT_SPEAKER]}
+
+
+@lru_cache(maxsize=256)
+def _render(template, params):
+    if not params:
+        return template.encode()
+    return template.format(**dict(params)).encode()
+
+
+class TopicRegistry:
+    """
+    Topics and payloads of the speaker commands for every field and speaker.
+    Topics are built once, payloads without parameters are encoded once and
+    payloads with parameters are cached per value.
+
+    Targets are addressed by group: a field name selects all speakers of the
+    field, "field/speaker" a single speaker and "all" every speaker.
+    """
+    def __init__(self, speakers=None):
+        """
+        :param speakers: Dict field -> list of speaker names, see parse_speakers
+        """
+        self.speakers = speakers or {DEFAULT_FIELD: [DEFAULT_SPEAKER]}
+        self.topics = {}
+        for field, names in self.speakers.items():
+            for name in names:
+                for command, (prefix, suffix, _) in COMMANDS.items():
+                    self.topics[(field, name, command)] = f"{prefix}/{field}/{name}/{suffix}"
+
+    def groups(self):
+        """
+        :return: Group names for a target selection, fields first
+        """
+        groups = list(self.speakers)
+        if len(groups) > 1:
+            groups.append("all")
+        for field, names in self.speakers.items():
+            if len(names) > 1:
+                groups.extend(f"{field}/{name}" for name in names)
+        return groups
+
+    def resolve(self, group=None):
+        """
+        :param group: Field name, "field/speaker" or "all"; None selects the first field
+        :return: List of (field, speaker) tuples
+        """
+        group = group or next(iter(self.speakers))
+        if group == "all":
+            return [(field, name) for field, names in self.speakers.items() for name in names]
+        if "/" in group:
+            field, name = group.split("/", 1)
+            return [(field, name)]
+        return [(group, name) for name in self.speakers.get(group, [DEFAULT_SPEAKER])]
+
+    def topic(self, field, speaker, command):
+        topic = self.topics.get((field, speaker, command))
+        if topic is None:
+            prefix, suffix, _ = COMMANDS[command]
+            topic = self.topics[(field, speaker, command)] = f"{prefix}/{field}/{speaker}/{suffix}"
+        return topic
+
+    def payload(self, command, **params):
+        """
+        :return: Encoded payload of the command
+        """
+        return _render(COMMANDS[command][2], tuple(sorted(params.items())))